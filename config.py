@@ -59,6 +59,10 @@ NAME_EXACT = "name_exact"
 ITEMID = "itemid"
 REVID = "revid"
 DATAID = "dataid"
+# how the data is stored (not present: plain, see the stores backend for others)
+DATALAYOUT = "datalayout"
+# small data stored inline in the meta record (never visible in retrieved metadata)
+DATAINLINE = "datainline"
 WIKINAME = "wikiname"
 CONTENT = "content"
 
@@ -0,0 +1,119 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - store migration tests
+"""
+
+
+from __future__ import absolute_import, division
+
+from StringIO import StringIO
+
+import pytest
+
+from .. import migration
+from ..migration import copy_store, migrate_backend
+
+from storage.backends.stores import MutableBackend
+from storage.stores import memory, fs, sqlite
+
+
+def make_stores(tmpdir, Src, Dst):
+    src = Src(str(tmpdir.join('src')), 'src_table')
+    dst = Dst(str(tmpdir.join('dst')))
+    for store in src, dst:
+        store.create()
+        store.open()
+    return src, dst
+
+
+def test_copy_bytes(tmpdir):
+    src, dst = make_stores(tmpdir, sqlite.BytesStore, fs.BytesStore)
+    kvs = dict(('%04d' % i, 'value %d' % i) for i in range(250))
+    src.set_many(kvs)
+    state = copy_store(src, dst, batch_size=10)
+    assert state['count'] == 250
+    assert state['bytes'] == sum(len(v) for v in kvs.values())
+    assert dst.get_many(kvs) == kvs
+
+
+def test_copy_files(tmpdir):
+    src, dst = make_stores(tmpdir, sqlite.FileStore, fs.FileStore)
+    kvs = dict(('%04d' % i, 'value %d' % i) for i in range(25))
+    src.set_many((k, StringIO(v)) for k, v in kvs.items())
+    state = copy_store(src, dst, readers=2, writers=2, batch_size=3)
+    assert state['count'] == 25
+    for k, v in kvs.items():
+        assert dst[k].read() == v
+
+
+def test_resume(tmpdir):
+    checkpoint = str(tmpdir.join('checkpoint'))
+    src, dst = make_stores(tmpdir, sqlite.BytesStore, fs.BytesStore)
+    kvs = dict(('%04d' % i, 'value %d' % i) for i in range(100))
+    src.set_many(kvs)
+
+    def interrupt(state):
+        if state['count'] >= 30:
+            raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        copy_store(src, dst, batch_size=10, checkpoint=checkpoint, progress=interrupt)
+    assert len(dst) == 30
+    state = copy_store(src, dst, batch_size=10, checkpoint=checkpoint)
+    assert state['count'] == 100
+    assert dst.get_many(kvs) == kvs
+
+
+def test_resume_after_unsaved_checkpoint(tmpdir, monkeypatch):
+    checkpoint = str(tmpdir.join('checkpoint'))
+    src = sqlite.BytesStore(str(tmpdir.join('src')))
+    dst = sqlite.BytesStore(str(tmpdir.join('dst')))
+    for store in src, dst:
+        store.create()
+        store.open()
+    kvs = dict(('%04d' % i, 'value %d' % i) for i in range(100))
+    src.set_many(kvs)
+    save_checkpoint = migration._save_checkpoint
+
+    def crash(path, state):
+        # the batch is written, but we crash before saving the checkpoint
+        if state['count'] >= 30:
+            raise KeyboardInterrupt
+        save_checkpoint(path, state)
+    monkeypatch.setattr(migration, '_save_checkpoint', crash)
+    with pytest.raises(KeyboardInterrupt):
+        copy_store(src, dst, batch_size=10, checkpoint=checkpoint)
+    monkeypatch.undo()
+    assert len(dst) == 30
+    state = copy_store(src, dst, batch_size=10, checkpoint=checkpoint)
+    assert state['count'] == 90 # the 10 keys written after the checkpoint were skipped
+    assert dst.get_many(kvs) == kvs
+
+
+def make_backend():
+    be = MutableBackend(memory.BytesStore(), memory.FileStore(), refs_store=memory.BytesStore(),
+                        chunk_store=memory.BytesStore())
+    be.create()
+    be.open()
+    return be
+
+
+def test_migrate_backend():
+    src, dst = make_backend(), make_backend()
+    revids = [src.store(dict(name=u'foo%d' % i), StringIO('data %d' % i)) for i in range(10)]
+    states = migrate_backend(src, dst)
+    assert sorted(states) == ['chunk_store', 'data_store', 'meta_store', 'refs_store']
+    for revid in revids:
+        assert dst.retrieve(revid)[0] == src.retrieve(revid)[0]
+        assert dst.retrieve(revid)[1].read() == src.retrieve(revid)[1].read()
+    for store in src._stores():
+        assert len(store)
+    assert [len(store) for store in dst._stores()] == [len(store) for store in src._stores()]
+
+
+def test_migrate_backend_missing_store():
+    src = make_backend()
+    dst = MutableBackend(memory.BytesStore(), memory.FileStore())
+    with pytest.raises(ValueError):
+        migrate_backend(src, dst)
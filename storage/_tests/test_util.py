@@ -0,0 +1,49 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - storage utilities tests
+"""
+
+
+from __future__ import absolute_import, division
+
+import re
+import time
+
+from .._util import make_uuid, make_time_uuid, time_uuid_bound, LRUCache
+
+ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def test_make_uuid():
+    ids = set(make_uuid() for i in range(100))
+    assert len(ids) == 100
+    assert all(ID_RE.match(id) for id in ids)
+
+
+def test_make_time_uuid():
+    start = time_uuid_bound(time.time())
+    ids = [make_time_uuid() for i in range(1000)]
+    assert all(ID_RE.match(id) for id in ids)
+    assert all(isinstance(id, unicode) for id in ids)
+    # strictly ordered, even within the same millisecond
+    assert ids == sorted(set(ids))
+    assert start <= ids[0]
+    assert ids[-1] < time_uuid_bound(time.time() + 1)
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1 # now 'b' is the least recently used one
+    cache['c'] = 3
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    cache['a'] = 4
+    assert cache.get('a') == 4
+    cache.clear()
+    assert cache.get('a', 0) == 0
@@ -0,0 +1,254 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - storage utilities (used by stores, backends and middleware)
+"""
+
+
+from __future__ import absolute_import, division
+
+import os
+import sys
+import time
+import threading
+from uuid import uuid4
+from itertools import islice
+from collections import deque, OrderedDict
+from multiprocessing.pool import ThreadPool
+
+# default number of worker threads of the shared executor
+DEFAULT_WORKERS = 8
+
+
+def make_uuid():
+    """
+    return a random id (uuid4, 32 hex digits)
+    """
+    return unicode(uuid4().hex)
+
+
+_last_time_uuid = [0, 0] # ms, random part
+_time_uuid_lock = threading.Lock()
+
+
+def make_time_uuid():
+    """
+    return a time ordered id (32 hex digits, like uuid4 ids): 48 bits of
+    milliseconds since the epoch, then 80 random bits.
+
+    Ids made later sort after ids made before (in this process, within the
+    same millisecond the random part is incremented), so new keys get
+    appended to b-tree based stores instead of being scattered all over.
+    """
+    ms = int(time.time() * 1000)
+    with _time_uuid_lock:
+        last_ms, last_random = _last_time_uuid
+        if ms > last_ms:
+            random = int(os.urandom(10).encode('hex'), 16)
+        elif last_random < 2 ** 80 - 1:
+            # same millisecond (or the clock went back): keep the order
+            ms, random = last_ms, last_random + 1
+        else:
+            ms, random = last_ms + 1, int(os.urandom(10).encode('hex'), 16)
+        _last_time_uuid[:] = ms, random
+    return u'%012x%020x' % (ms, random)
+
+
+def time_uuid_bound(timestamp):
+    """
+    return the lowest time ordered id made at or after timestamp (UNIX time),
+    e.g. to range scan a store for recent keys: store.iter_range(start=time_uuid_bound(t))
+
+    Note: random ids (uuid4) are scattered over the whole range.
+    """
+    return u'%012x%020x' % (int(timestamp * 1000), 0)
+
+
+def batches(iterable, size):
+    """
+    yield lists of (at most) size items taken from iterable
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def slice_range(value, offset, length=None):
+    """
+    return length bytes (None: all up to the end) of value, starting at offset
+    """
+    if length is None:
+        return value[offset:]
+    return value[offset:offset + length]
+
+
+def read_range(f, offset, length=None):
+    """
+    read length bytes (None: all up to the end) of file f, starting at offset, then close f
+    """
+    try:
+        f.seek(offset)
+        return f.read(-1 if length is None else length)
+    finally:
+        f.close()
+
+
+class LRUCache(object):
+    """
+    A thread safe cache keeping the maxsize most recently used entries.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value # now it is the most recently used one
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DoneResult(object):
+    """
+    An already computed result, same API as multiprocessing's AsyncResult.
+    """
+    def __init__(self, func, args=(), kw=None):
+        try:
+            self._value = func(*args, **(kw or {}))
+            self._success = True
+        except Exception:
+            self._value = sys.exc_info()
+            self._success = False
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return self._success
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        if self._success:
+            return self._value
+        exc_type, exc_value, exc_tb = self._value
+        raise exc_type, exc_value, exc_tb
+
+
+class Executor(object):
+    """
+    A bounded pool of worker threads to run blocking calls in.
+
+    submit() returns a future (an AsyncResult, call .get() to wait for the
+    result or to get the exception re-raised). Calls made from one of our own
+    worker threads are run synchronously, so nested usage can't deadlock the
+    pool by having all workers wait for each other.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, initializer=None):
+        """
+        :param workers: maximum number of worker threads
+        :param initializer: callable, called in each worker thread when it starts
+        """
+        self.workers = workers
+        self._initializer = initializer
+        self._pool = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _init_worker(self):
+        self._local.worker = True
+        if self._initializer is not None:
+            self._initializer()
+
+    def _get_pool(self):
+        # threads are only started when we really need them
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers, self._init_worker)
+            return self._pool
+
+    def in_worker(self):
+        """
+        are we running in one of our worker threads?
+        """
+        return getattr(self._local, 'worker', False)
+
+    def submit(self, func, *args, **kw):
+        """
+        run func(*args, **kw) in a worker thread, return a future
+        """
+        if self.in_worker():
+            return DoneResult(func, args, kw)
+        return self._get_pool().apply_async(func, args, kw)
+
+    def map(self, func, iterable, prefetch=None):
+        """
+        like itertools.imap, but func is run in the worker threads.
+
+        Results are yielded in the order of iterable. At most prefetch calls
+        are in flight (default: number of workers), so iterable is consumed
+        lazily and memory usage stays bounded.
+        """
+        if self.in_worker():
+            for item in iterable:
+                yield func(item)
+            return
+        if prefetch is None:
+            prefetch = self.workers
+        prefetch = max(prefetch, 1)
+        pool = self._get_pool()
+        pending = deque()
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item, )))
+            if len(pending) >= prefetch:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def shutdown(self):
+        """
+        stop the worker threads (after they have finished their work)
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    return the executor shared by all stores / backends (created on first use)
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = Executor()
+        return _executor
@@ -10,6 +10,18 @@ MoinMoin - backend base classes
 from __future__ import absolute_import, division
 
 from abc import abstractmethod, ABCMeta
+from itertools import imap
+
+from storage._util import get_executor, read_range
+
+from ._util import LazyData
+
+
+def _open_data(item):
+    metaid, meta, data = item
+    if isinstance(data, LazyData):
+        data.open()
+    return item
 
 
 class BackendBase(object):
@@ -49,6 +61,96 @@ class BackendBase(object):
         return meta, data related to metaid
         """
 
+    def retrieve_meta(self, metaid):
+        """
+        return meta related to metaid (without accessing the data)
+
+        backends that can fetch the meta alone override this.
+        """
+        meta, data = self.retrieve(metaid)
+        data.close()
+        return meta
+
+    def retrieve_range(self, metaid, offset, length=None):
+        """
+        return length bytes (None: all up to the end) of the data related to
+        metaid, starting at offset (e.g. for http range requests)
+
+        backends that can read a part of the data override this.
+        """
+        meta, data = self.retrieve(metaid)
+        return read_range(data, offset, length)
+
+    def iter_meta(self):
+        """
+        iterate over (metaid, meta) of all revisions
+
+        backends that can scan metaids and meta in one pass override this.
+        """
+        for metaid in self:
+            try:
+                meta = self.retrieve_meta(metaid)
+            except KeyError:
+                continue # removed meanwhile
+            yield metaid, meta
+
+    def iter_revisions(self):
+        """
+        iterate over (metaid, meta, data) of all revisions (data: see retrieve)
+        """
+        for metaid in self:
+            try:
+                meta, data = self.retrieve(metaid)
+            except KeyError:
+                continue # removed meanwhile
+            yield metaid, meta, data
+
+    def _retrieve_item(self, metaid):
+        meta, data = self.retrieve(metaid)
+        return metaid, meta, data
+
+    def retrieve_many(self, metaids, prefetch=None, prefetch_data=False):
+        """
+        yield (metaid, meta, data) for all given metaids (in the same order),
+        raise KeyError if some metaid does not exist.
+
+        backends that can fetch many revisions in one operation override this.
+
+        :param prefetch: retrieve up to this many revisions concurrently
+                         (None: one after the other)
+        :param prefetch_data: also open the data (of lazy data handles) concurrently
+        """
+        items = self._prefetch(self._retrieve_item, metaids, prefetch)
+        if prefetch_data:
+            items = self._prefetch(_open_data, items, prefetch)
+        return items
+
+    def _executor(self):
+        """
+        return the executor the a* methods run their blocking calls in
+        """
+        return get_executor()
+
+    def _prefetch(self, func, iterable, prefetch):
+        """
+        like imap(func, iterable), running up to prefetch calls concurrently
+        """
+        if prefetch:
+            return self._executor().map(func, iterable, prefetch)
+        return imap(func, iterable)
+
+    def aiter(self):
+        """
+        return a future for the list of metaids
+        """
+        return self._executor().submit(list, self)
+
+    def aretrieve(self, metaid):
+        """
+        same as retrieve(metaid), but return a future (call .get() on it for the result)
+        """
+        return self._executor().submit(self.retrieve, metaid)
+
 
 class MutableBackendBase(BackendBase):
     """
@@ -72,6 +174,12 @@ class MutableBackendBase(BackendBase):
         store meta, data into the backend, return the metaid
         """
 
+    def astore(self, meta, data):
+        """
+        same as store(meta, data), but return a future for the metaid
+        """
+        return self._executor().submit(self.store, meta, data)
+
     @abstractmethod
     def remove(self, metaid):
         """
@@ -0,0 +1,218 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - content defined chunking of revision data
+
+Data is cut into chunks at positions that only depend on the content near
+them, so inserting or removing some bytes only changes the chunk(s) where
+that happened, the other chunks stay the same (and are stored only once).
+
+Candidate cut positions are found with a regex (fast, runs in C): after
+each ANCHOR byte. We cut at a candidate if the crc32 of the WINDOW bytes
+before it has its MASK bits cleared (so on average every (MASK + 1)th
+candidate is a cut), obeying the min/max chunk size.
+
+The chunks are stored by their HASH_ALGORITHM hexdigest into a chunk store,
+a manifest (listing the chunk digests and sizes) is stored as the data.
+"""
+
+
+from __future__ import absolute_import, division
+
+import re
+import zlib
+import hashlib
+from bisect import bisect_right
+
+from config import HASH_ALGORITHM
+
+from storage._util import slice_range
+
+# meta[DATALAYOUT] value for chunked data
+LAYOUT_CHUNKED = u'chunked'
+
+ANCHOR_RE = re.compile('[\n\x00]')
+WINDOW = 48
+MASK = 0x7f
+MIN_SIZE = 2 * 1024
+MAX_SIZE = 64 * 1024
+
+READ_SIZE = 64 * 1024
+
+MANIFEST_MAGIC = 'CHUNKS1\n'
+
+# how many chunks ChunkedFile fetches with one store operation
+PREFETCH = 8
+
+
+def _find_cut(buf, start, end):
+    """
+    return the first cut position in buf[start:end] (or None)
+    """
+    for m in ANCHOR_RE.finditer(buf, start, end):
+        pos = m.end()
+        if not zlib.crc32(buf[pos-WINDOW:pos]) & MASK:
+            return pos
+
+
+def iter_chunks(f, min_size=MIN_SIZE, max_size=MAX_SIZE):
+    """
+    read file f and yield its content as content defined chunks
+    """
+    assert min_size >= WINDOW
+    buf = ''
+    eof = False
+    while True:
+        while not eof and len(buf) < max_size:
+            data = f.read(READ_SIZE)
+            if data:
+                buf += data
+            else:
+                eof = True
+        if not buf:
+            return
+        cut = None
+        if len(buf) > min_size:
+            cut = _find_cut(buf, min_size, min(max_size, len(buf)))
+        if cut is None:
+            cut = min(max_size, len(buf))
+        yield buf[:cut]
+        buf = buf[cut:]
+
+
+def make_manifest(chunks):
+    """
+    :param chunks: list of (digest, size)
+    """
+    return MANIFEST_MAGIC + ''.join('%s %d\n' % (digest, size) for digest, size in chunks)
+
+
+def parse_manifest(manifest):
+    """
+    return list of (digest, size)
+    """
+    if not manifest.startswith(MANIFEST_MAGIC):
+        raise ValueError("invalid chunk manifest")
+    chunks = []
+    for line in manifest[len(MANIFEST_MAGIC):].splitlines():
+        digest, size = line.split()
+        chunks.append((digest, int(size)))
+    return chunks
+
+
+def read_range(manifest, chunk_store, offset, length=None):
+    """
+    return length bytes (None: all up to the end) of chunked data, starting
+    at offset, only fetching the chunks overlapping that range
+    """
+    end = None if length is None else offset + length
+    digests, start, pos = [], None, 0
+    for digest, size in parse_manifest(manifest):
+        if pos + size > offset and (end is None or pos < end):
+            if start is None:
+                start = pos
+            digests.append(digest)
+        pos += size
+    if not digests:
+        return ''
+    values = chunk_store.get_many(set(digests))
+    missing = set(digests) - set(values)
+    if missing:
+        raise IOError("missing data chunk(s) %s" % ', '.join(sorted(missing)))
+    return slice_range(''.join(values[digest] for digest in digests), offset - start, length)
+
+
+def store_chunks(f, chunk_store, lock=None, min_size=MIN_SIZE, max_size=MAX_SIZE, touch=None):
+    """
+    cut f into chunks, store the chunks we do not have yet into chunk_store
+
+    :param lock: lock to hold while checking / storing chunks (for stores
+                 that can't handle concurrently storing the same key)
+    :param touch: callable, called with each chunk digest before we check
+                  whether we have it (e.g. to keep the gc from removing it)
+    :returns: manifest (str)
+    """
+    chunks = []
+    for chunk in iter_chunks(f, min_size, max_size):
+        digest = hashlib.new(HASH_ALGORITHM, chunk).hexdigest()
+        chunks.append((digest, len(chunk)))
+        if touch is not None:
+            touch(digest)
+        if lock is not None:
+            with lock:
+                if digest not in chunk_store:
+                    chunk_store[digest] = chunk
+        elif digest not in chunk_store:
+            chunk_store[digest] = chunk
+    return make_manifest(chunks)
+
+
+class ChunkedFile(object):
+    """
+    readonly file-like for chunked data, fetches the chunks when needed
+    """
+    def __init__(self, manifest, chunk_store):
+        self._chunks = parse_manifest(manifest)
+        self._store = chunk_store
+        self._offsets = [] # start offset of each chunk
+        offset = 0
+        for digest, size in self._chunks:
+            self._offsets.append(offset)
+            offset += size
+        self._size = offset
+        self._pos = 0
+        self._index = 0 # index of the chunk containing _pos
+        self._cache = {} # chunk index -> chunk
+        self.closed = False
+
+    def _chunk(self, index):
+        try:
+            return self._cache[index]
+        except KeyError:
+            pass
+        # fetch this and the next chunks with one store operation
+        indexes = range(index, min(index + PREFETCH, len(self._chunks)))
+        values = self._store.get_many([self._chunks[i][0] for i in indexes])
+        self._cache = {}
+        for i in indexes:
+            digest = self._chunks[i][0]
+            try:
+                self._cache[i] = values[digest]
+            except KeyError:
+                raise IOError("missing data chunk %s" % digest)
+        return self._cache[index]
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if size is None or size < 0:
+            size = self._size - self._pos
+        result = []
+        while size > 0 and self._pos < self._size:
+            while self._offsets[self._index] + self._chunks[self._index][1] <= self._pos:
+                self._index += 1
+            chunk = self._chunk(self._index)
+            start = self._pos - self._offsets[self._index]
+            block = chunk[start:start+size]
+            result.append(block)
+            self._pos += len(block)
+            size -= len(block)
+        return ''.join(result)
+
+    def seek(self, offset, whence=0):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._size
+        self._pos = max(0, offset)
+        self._index = max(0, bisect_right(self._offsets, self._pos) - 1)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._cache = {}
+        self.closed = True
@@ -0,0 +1,156 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - metadata codecs (meta dict <-> bytes)
+
+The first byte of an encoded meta record tells its format:
+
+- '{' - legacy JSON record (json text, utf-8, no format byte)
+- FORMAT_JSON - format byte + json text, utf-8
+- FORMAT_BINARY - format byte + marshal serialization of a tuple
+  (key mask, values, extra dict). The well-known meta keys (INTERNED_KEYS)
+  are not stored, just a bit per present key in the mask. Other keys go
+  into the extra dict.
+
+Inline data (DATAINLINE, bytes) is base64 encoded in the JSON formats.
+
+Use decode() to decode a record of any format.
+
+The backends use the JSON codec by default, the binary codec is opt-in:
+marshal is not guaranteed to be stable across Python versions (and code not
+knowing FORMAT_BINARY can't read it), so only use it if all code reading
+the stores runs on the same Python version. Both codecs decode to the same
+values: the binary codec stores bytestrings (except DATAINLINE) as unicode
+and tuples as lists, like JSON does.
+
+Note: marshal is fast, but not secure against maliciously constructed data,
+      so only use it for data we have written ourselves.
+"""
+
+
+from __future__ import absolute_import, division
+
+import marshal
+import base64
+
+from config import NAME, NAME_OLD, MTIME, SIZE, DATAID, REVID, ITEMID, HASH_ALGORITHM, \
+                   CONTENTTYPE, ACL, COMMENT, ACTION, ADDRESS, HOSTNAME, USERID, LANGUAGE, \
+                   TAGS, ITEMLINKS, ITEMTRANSCLUSIONS, EXTRA, REVERTED_TO, IS_SYSITEM, \
+                   SYSITEM_VERSION, USERGROUP, SOMEDICT, WIKINAME, EMAIL, OPENID, DATALAYOUT, \
+                   DATAINLINE
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+FORMAT_LEGACY_JSON = '{'
+FORMAT_JSON = '\x01'
+FORMAT_BINARY = '\x02'
+
+MARSHAL_VERSION = 2
+
+# the position of a key in this list is its bit in the key mask of stored
+# records, so NEVER remove or reorder keys, only append new ones.
+INTERNED_KEYS = [
+    NAME, NAME_OLD, MTIME, SIZE, DATAID, REVID, ITEMID, HASH_ALGORITHM,
+    CONTENTTYPE, ACL, COMMENT, ACTION, ADDRESS, HOSTNAME, USERID, LANGUAGE,
+    TAGS, ITEMLINKS, ITEMTRANSCLUSIONS, EXTRA, REVERTED_TO, IS_SYSITEM,
+    SYSITEM_VERSION, USERGROUP, SOMEDICT, WIKINAME, EMAIL, OPENID,
+    DATALAYOUT, DATAINLINE,
+]
+INTERNED_KEYS_SET = frozenset(INTERNED_KEYS)
+
+
+class JsonCodec(object):
+    """
+    portable, human readable (but slow)
+    """
+    format = FORMAT_JSON
+
+    def encode(self, meta):
+        if DATAINLINE in meta:
+            meta = dict(meta)
+            meta[DATAINLINE] = base64.b64encode(meta[DATAINLINE])
+        text = json.dumps(meta, ensure_ascii=False)
+        return self.format + text.encode('utf-8')
+
+    def decode(self, meta_str):
+        if meta_str[:1] == self.format:
+            meta_str = meta_str[1:]
+        meta = json.loads(meta_str.decode('utf-8'))
+        if DATAINLINE in meta:
+            meta[DATAINLINE] = base64.b64decode(meta[DATAINLINE])
+        return meta
+
+
+def _normalize(value):
+    """
+    return value with the types JSON would decode it to (bytestrings are
+    utf-8 decoded to unicode, tuples become lists)
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_normalize(key), _normalize(item)) for key, item in value.iteritems())
+    return value
+
+
+class BinaryCodec(object):
+    """
+    fast and compact (opt-in, see module docstring)
+    """
+    format = FORMAT_BINARY
+
+    def __init__(self):
+        self._mask_keys = {} # cache: key mask -> tuple of keys
+
+    def encode(self, meta):
+        mask, values = 0, []
+        for bit, key in enumerate(INTERNED_KEYS):
+            if key in meta:
+                mask |= 1 << bit
+                value = meta[key]
+                values.append(value if key == DATAINLINE else _normalize(value))
+        extra = dict((_normalize(key), _normalize(value))
+                     for key, value in meta.iteritems() if key not in INTERNED_KEYS_SET)
+        return self.format + marshal.dumps((mask, tuple(values), extra or None), MARSHAL_VERSION)
+
+    def _keys(self, mask):
+        try:
+            return self._mask_keys[mask]
+        except KeyError:
+            keys = tuple(unicode(key) for bit, key in enumerate(INTERNED_KEYS) if mask & (1 << bit))
+            self._mask_keys[mask] = keys
+            return keys
+
+    def decode(self, meta_str):
+        mask, values, extra = marshal.loads(meta_str[1:])
+        meta = dict(zip(self._keys(mask), values))
+        if extra:
+            meta.update(extra)
+        return meta
+
+
+json_codec = JsonCodec()
+binary_codec = BinaryCodec()
+
+CODECS = {
+    FORMAT_LEGACY_JSON: json_codec,
+    FORMAT_JSON: json_codec,
+    FORMAT_BINARY: binary_codec,
+}
+
+
+def decode(meta_str):
+    """
+    decode a meta record of any format
+    """
+    try:
+        codec = CODECS[meta_str[:1]]
+    except KeyError:
+        raise ValueError("unknown meta format %r" % meta_str[:1])
+    return codec.decode(meta_str)
@@ -0,0 +1,122 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - delta encoding of text revision data
+
+Revisions of the same item are usually nearly identical, so instead of the
+full text, only a line delta against the previous revision of the item is
+stored. Every KEYFRAME_INTERVAL-th revision of an item (and the first one)
+is stored in full (a keyframe), so no chain of deltas gets longer than
+KEYFRAME_INTERVAL - 1.
+
+A delta record lists its whole chain (the keyframe dataid, then the dataids
+of the deltas between it and this one), so a revision can be reconstructed
+with 2 store operations (read the record, then get_many the chain), no
+matter how long the chain is.
+
+The deltas are forward deltas (against the previous revision), records are
+never changed once written. To not slow down reading the latest revision,
+the full text of the latest delta encoded revision of an item (the head) is
+kept in the heads store, too (key: dataid + HEAD_TEXT_SUFFIX), so reading
+the head (and delta encoding the next revision against it) does not apply
+any deltas. Only older revisions apply up to KEYFRAME_INTERVAL - 1 deltas.
+
+Delta record format: DELTA_MAGIC + marshal serialization of (chain, ops),
+ops is a list of (start, end) tuples (copy these lines of the base text)
+and lists of lines (insert these lines).
+
+Note: marshal is fast, but not secure against maliciously constructed data,
+      so only use it for data we have written ourselves.
+"""
+
+
+from __future__ import absolute_import, division
+
+import marshal
+from difflib import SequenceMatcher
+
+from config import ITEMID, CONTENTTYPE, SIZE
+
+# meta[DATALAYOUT] values for data stored by the delta encoder
+LAYOUT_KEYFRAME = u'keyframe' # full text, but maybe the base of other revisions' deltas
+LAYOUT_DELTA = u'delta'
+LAYOUTS = frozenset([LAYOUT_KEYFRAME, LAYOUT_DELTA])
+
+KEYFRAME_INTERVAL = 10
+
+# bigger data is stored as usual (we need it in memory for diffing)
+MAX_SIZE = 1024 * 1024
+
+DELTA_MAGIC = 'DELTA1\n'
+
+# heads store key suffix for the full text of the head
+HEAD_TEXT_SUFFIX = '.text'
+
+MARSHAL_VERSION = 2
+
+
+def deltifiable(meta):
+    """
+    check whether data with this metadata shall be delta encoded
+    """
+    return (ITEMID in meta and
+            meta.get(CONTENTTYPE, u'').startswith(u'text/') and
+            meta.get(SIZE, 0) <= MAX_SIZE)
+
+
+def make_delta(base_lines, lines):
+    """
+    compute ops that transform base_lines into lines
+    """
+    ops = []
+    sm = SequenceMatcher(None, base_lines, lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+        if tag == 'equal':
+            ops.append((i1, i2))
+        elif j1 < j2: # replace, insert
+            ops.append(lines[j1:j2])
+    return ops
+
+
+def apply_delta(base_lines, ops):
+    """
+    apply ops (see make_delta) to base_lines
+    """
+    lines = []
+    for op in ops:
+        if isinstance(op, tuple):
+            lines.extend(base_lines[op[0]:op[1]])
+        else:
+            lines.extend(op)
+    return lines
+
+
+def encode_record(chain, ops):
+    """
+    :param chain: list of dataids (keyframe first) this delta is based on
+    :param ops: delta against the text of chain[-1]
+    """
+    return DELTA_MAGIC + marshal.dumps((chain, ops), MARSHAL_VERSION)
+
+
+def decode_record(record):
+    """
+    return chain, ops
+    """
+    if not record.startswith(DELTA_MAGIC):
+        raise ValueError("invalid delta record")
+    chain, ops = marshal.loads(record[len(DELTA_MAGIC):])
+    return chain, ops
+
+
+def encode_head(dataid, depth):
+    return '%s %d' % (dataid, depth)
+
+
+def decode_head(head):
+    """
+    return dataid, depth (0 for a keyframe)
+    """
+    dataid, depth = head.split()
+    return unicode(dataid), int(depth)
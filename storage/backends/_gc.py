@@ -0,0 +1,369 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - garbage collection for the stores backend
+
+Removes data that is not referenced by any meta record any more (left over
+by failed stores, destroyed revisions, ...):
+
+- mark: stream all meta records and put a fingerprint of every referenced
+  dataid into a sorted array (compact and with O(log n) lookup, a false
+  positive only means some garbage is kept until the next run).
+- scan: every data store key not in the referenced array is a candidate.
+- verify: stream all meta records once more and drop all candidates that
+  are referenced now (data written concurrently, its meta arrived after
+  the mark phase had passed by).
+- sweep: remove the remaining candidates, except the keys the backend
+  touched (wrote or reused) since the gc started: data is stored before its
+  meta, so the meta of an in-flight store may not be visible yet. Keys carry
+  no time (chunk digests, random ids), so this protects stores done by this
+  process (through this backend object) only, do not run the gc while other
+  processes store into the same stores.
+
+Delta encoded data references the data it is based on (its chain), so that
+is marked, too. Heads pointing to removed data are removed after the sweep.
+
+If the backend has a chunk store, the same is done for the chunks afterwards,
+using the chunk lists in the manifests of the chunked data as references.
+
+All phases work in batches, so the collector can be run incrementally (see
+GarbageCollector.step) with a time budget per increment and a pause after
+each batch, to not disturb normal operation too much.
+"""
+
+
+from __future__ import absolute_import, division
+
+import time
+import heapq
+import struct
+import hashlib
+from array import array
+from bisect import bisect_left
+
+from config import DATAID, DATALAYOUT
+
+from storage._util import batches
+
+from ._chunking import LAYOUT_CHUNKED, parse_manifest
+from ._delta import LAYOUT_DELTA, HEAD_TEXT_SUFFIX, decode_record, decode_head
+
+# how many keys we process with one store operation
+BATCH_SIZE = 100
+
+# how many fingerprints we sort in memory at once while building the array
+SORT_CHUNK_SIZE = 64 * 1024
+
+FINGERPRINT_TYPECODE = 'L'
+FINGERPRINT_SIZE = array(FINGERPRINT_TYPECODE).itemsize
+FINGERPRINT_FORMAT = {4: '<I', 8: '<Q'}[FINGERPRINT_SIZE]
+
+
+def fingerprint(dataid):
+    """
+    compute a fixed size integer fingerprint of a dataid
+    """
+    if isinstance(dataid, unicode):
+        dataid = dataid.encode('utf-8')
+    return struct.unpack(FINGERPRINT_FORMAT, hashlib.sha1(dataid).digest()[:FINGERPRINT_SIZE])[0]
+
+
+class FingerprintSet(object):
+    """
+    A compact, readonly set of dataids, built from an iterable of dataids (or
+    incrementally, see add_many and freeze).
+
+    Only fingerprints are kept (not the dataids themselves), thus it may give
+    false positives for __contains__.
+    """
+    def __init__(self, dataids=None):
+        self._chunks = [] # sorted arrays of fingerprints
+        self._pending = array(FINGERPRINT_TYPECODE)
+        self._fingerprints = None
+        if dataids is not None:
+            self.add_many(dataids)
+            self.freeze()
+
+    def _sort_pending(self):
+        self._chunks.append(array(FINGERPRINT_TYPECODE, sorted(self._pending)))
+        self._pending = array(FINGERPRINT_TYPECODE)
+
+    def add_many(self, dataids):
+        """
+        add dataids (only possible before freeze)
+        """
+        assert self._fingerprints is None, "can't add to a frozen set"
+        for batch in batches(dataids, SORT_CHUNK_SIZE):
+            self._pending.extend(fingerprint(dataid) for dataid in batch)
+            if len(self._pending) >= SORT_CHUNK_SIZE:
+                self._sort_pending()
+
+    def freeze(self):
+        """
+        merge the sorted chunks into the lookup array, no more adds after this
+        """
+        if self._fingerprints is None:
+            self._sort_pending()
+            chunks, self._chunks = self._chunks, None
+            self._fingerprints = array(FINGERPRINT_TYPECODE, heapq.merge(*chunks))
+        return self
+
+    def __len__(self):
+        return len(self.freeze()._fingerprints)
+
+    def __contains__(self, dataid):
+        fp = fingerprint(dataid)
+        fps = self.freeze()._fingerprints
+        pos = bisect_left(fps, fp)
+        return pos < len(fps) and fps[pos] == fp
+
+
+def _data_size(f):
+    try:
+        f.seek(0, 2)
+        return f.tell()
+    finally:
+        f.close()
+
+
+class GarbageCollector(object):
+    """
+    mark and sweep garbage collector for a stores backend
+    """
+    def __init__(self, backend, dry_run=False, batch_size=BATCH_SIZE, pause=0.0):
+        """
+        :param backend: a (opened) stores MutableBackend
+        :param dry_run: just find the garbage, do not remove it
+        :param batch_size: number of keys processed with one store operation
+        :param pause: seconds to sleep after each batch (throttling)
+        """
+        self.backend = backend
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.pause = pause
+        self.report = self._new_report()
+        if getattr(backend, 'chunk_store', None) is not None:
+            self.report['chunks'] = self._new_report()
+        self._steps = self._run()
+        self.finished = False
+
+    def _new_report(self):
+        return dict(phase=None, referenced=0, data=0, garbage=[], garbage_bytes=0, removed=0, kept=[])
+
+    def _iter_metas(self):
+        """
+        yield batches of meta dicts of all revisions
+        """
+        backend = self.backend
+        for metaids in batches(backend.meta_store, self.batch_size):
+            metas = backend.meta_store.get_many(metaids)
+            yield [backend._deserialize(meta) for meta in metas.values()]
+
+    def referenced_dataids(self, meta):
+        """
+        return the dataids referenced by this meta record
+        """
+        return [meta[DATAID]]
+
+    def _delta_bases(self, dataids):
+        """
+        return the dataids the delta encoded data dataids is based on
+        """
+        bases = []
+        for f in self.backend.data_store.get_many(dataids).values():
+            try:
+                record = f.read()
+            finally:
+                f.close()
+            bases.extend(decode_record(record)[0])
+        return bases
+
+    def _iter_referenced_dataids(self):
+        """
+        yield batches of referenced dataids
+        """
+        backend = self.backend
+        if DATAID in getattr(backend.meta_store, 'column_names', []) and \
+           getattr(backend, 'heads_store', None) is None:
+            # no need to read and decode the meta records
+            for items in batches(backend.meta_store.iter_column(DATAID), self.batch_size):
+                yield [dataid for metaid, dataid in items if dataid is not None]
+            return
+        for metas in self._iter_metas():
+            referenced = []
+            for meta in metas:
+                referenced.extend(self.referenced_dataids(meta))
+            deltas = [meta[DATAID] for meta in metas if meta.get(DATALAYOUT) == LAYOUT_DELTA]
+            if deltas:
+                referenced.extend(self._delta_bases(deltas))
+            yield referenced
+
+    def _iter_referenced_chunks(self):
+        """
+        yield batches of referenced chunk digests (from the manifests of chunked data)
+        """
+        data_store = self.backend.data_store
+        for metas in self._iter_metas():
+            dataids = [meta[DATAID] for meta in metas if meta.get(DATALAYOUT) == LAYOUT_CHUNKED]
+            manifests = data_store.get_many(dataids)
+            referenced = []
+            for f in manifests.values():
+                try:
+                    manifest = f.read()
+                finally:
+                    f.close()
+                referenced.extend(digest for digest, size in parse_manifest(manifest))
+            yield referenced
+
+    def _mark_and_sweep(self, store, iter_referenced, report, files=True):
+        """
+        remove all keys from store that are not referenced, a generator yielding after each batch
+
+        :param iter_referenced: callable, returns iterator over batches of referenced keys
+        :param files: whether store is a file store (else bytes store)
+        """
+        # mark
+        report['phase'] = 'mark'
+        referenced = FingerprintSet()
+        for keys in iter_referenced():
+            referenced.add_many(keys)
+            yield
+        report['referenced'] = len(referenced.freeze())
+        # scan
+        report['phase'] = 'scan'
+        candidates = set()
+        for keys in batches(store, self.batch_size):
+            report['data'] += len(keys)
+            candidates.update(key for key in keys if key not in referenced)
+            yield
+        referenced = None # free memory
+        # verify
+        report['phase'] = 'verify'
+        if candidates:
+            for keys in iter_referenced():
+                candidates.difference_update(keys)
+                yield
+        # sweep
+        report['phase'] = 'sweep'
+        garbage = sorted(candidates)
+        report['garbage'] = garbage
+        backend = self.backend
+        for keys in batches(garbage, self.batch_size):
+            values = store.get_many(keys)
+            if files:
+                sizes = dict((key, _data_size(f)) for key, f in values.items())
+            else:
+                sizes = dict((key, len(value)) for key, value in values.items())
+            report['garbage_bytes'] += sum(sizes.values())
+            if not self.dry_run:
+                # a store touching a key waits for us, or we see it touched
+                with backend._gc_lock:
+                    touched = [key for key in keys if backend._is_touched(key)]
+                    if touched:
+                        keys = [key for key in keys if key not in touched]
+                    store.delete_many(keys)
+                report['kept'].extend(touched)
+                report['garbage_bytes'] -= sum(sizes.get(key, 0) for key in touched)
+                report['removed'] += len(keys)
+            yield
+        report['phase'] = 'done'
+
+    def _run(self):
+        """
+        the gc, a generator yielding after each batch
+        """
+        backend = self.backend
+        report = self.report
+        backend._track_touched(True)
+        try:
+            for _ in self._mark_and_sweep(backend.data_store, self._iter_referenced_dataids, report):
+                yield
+            removed = set(report['garbage']) - set(report['kept'])
+            if not self.dry_run and removed and getattr(backend, 'refs_store', None) is not None:
+                for _ in self._sweep_refs(removed):
+                    yield
+            if not self.dry_run and removed and getattr(backend, 'heads_store', None) is not None:
+                for _ in self._sweep_heads(removed):
+                    yield
+            if 'chunks' in report:
+                # after the data, so chunks only used by garbage manifests are garbage now, too
+                for _ in self._mark_and_sweep(backend.chunk_store, self._iter_referenced_chunks, report['chunks'],
+                                              files=False):
+                    yield
+        finally:
+            backend._track_touched(False)
+
+    def _sweep_stale(self, store, lock, find_stale):
+        """
+        remove stale keys of store, a generator yielding after each batch
+        (holding the lock per batch only)
+
+        :param find_stale: callable, list of keys -> list of stale keys
+        """
+        for keys in batches(list(store), self.batch_size):
+            with lock:
+                # the values may have changed since we listed the keys
+                stale = find_stale(keys)
+                if stale:
+                    store.delete_many(stale)
+            yield
+
+    def _sweep_refs(self, removed):
+        # dedup refs pointing to data we just removed are stale
+        refs_store = self.backend.refs_store
+        def find_stale(keys):
+            return [key for key, ref in refs_store.get_many(keys).items() if ref.split()[0] in removed]
+        return self._sweep_stale(refs_store, self.backend._refs_lock, find_stale)
+
+    def _sweep_heads(self, removed):
+        # the next revision of these items will be a keyframe
+        heads_store = self.backend.heads_store
+        def find_stale(keys):
+            # do not read the head texts, their key tells the dataid
+            texts = [key for key in keys if key.endswith(HEAD_TEXT_SUFFIX)]
+            stale = [key for key in texts if key[:-len(HEAD_TEXT_SUFFIX)] in removed]
+            heads = heads_store.get_many(set(keys) - set(texts))
+            return stale + [key for key, head in heads.items() if decode_head(head)[0] in removed]
+        return self._sweep_stale(heads_store, self.backend._heads_lock, find_stale)
+
+    def step(self, time_budget=None):
+        """
+        run the gc for (about) time_budget seconds (None: until finished)
+
+        :returns: True if the gc has finished
+        """
+        if self.finished:
+            return True
+        start = time.time()
+        for _ in self._steps:
+            if self.pause:
+                time.sleep(self.pause)
+            if time_budget is not None and time.time() - start >= time_budget:
+                return False
+        self.finished = True
+        return True
+
+    def run(self):
+        """
+        run the gc until it has finished
+
+        :returns: report dict
+        """
+        self.step()
+        return self.report
+
+
+def collect_garbage(backend, dry_run=False, **kw):
+    """
+    collect garbage in stores backend, return a report dict:
+
+    - referenced: number of referenced dataids
+    - data: number of dataids in the data store
+    - garbage: list of unreferenced dataids
+    - garbage_bytes: size of the unreferenced data
+    - removed: number of removed dataids (0 for a dry run)
+    - kept: garbage dataids not removed, as they were touched by a store meanwhile
+    - chunks: same for the chunk store (only if the backend has one)
+    """
+    return GarbageCollector(backend, dry_run=dry_run, **kw).run()
@@ -0,0 +1,179 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - watch a directory tree for changes (Linux inotify, via ctypes)
+
+A Watcher collects the relative paths of changed files / directories below
+its root directory, see Watcher.changes. Creating a Watcher raises OSError
+if inotify is not available (not Linux, too many watches, ...), callers are
+expected to fall back to scanning the tree.
+"""
+
+
+from __future__ import absolute_import, division
+
+import os
+import sys
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+READ_SIZE = 64 * 1024
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library('c')
+        if name is None:
+            raise OSError(errno.ENOSYS, "no libc found")
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not supported")
+        _libc = libc
+    return _libc
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class Watcher(object):
+    """
+    watches a directory tree, collecting changed paths
+    """
+    def __init__(self, root):
+        """
+        :param root: directory to watch (including all subdirectories)
+        """
+        self.root = root
+        self._libc = _get_libc()
+        self._fd = _check(self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        self._paths = {} # wd -> relative directory path
+        self._overflow = False
+        try:
+            self._watch_tree(u'')
+        except OSError:
+            self.close()
+            raise
+
+    def _watch(self, relpath):
+        path = os.path.join(self.root, relpath)
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = _check(self._libc.inotify_add_watch(self._fd, path, WATCH_MASK))
+        self._paths[wd] = relpath
+
+    def _watch_tree(self, relpath):
+        """
+        watch relpath and all directories below it
+        """
+        self._watch(relpath)
+        top = os.path.join(self.root, relpath)
+        for dirpath, dirnames, filenames in os.walk(top):
+            for dirname in dirnames:
+                self._watch(os.path.relpath(os.path.join(dirpath, dirname), self.root))
+
+    def _unwatch_tree(self, relpath):
+        prefix = relpath + u'/'
+        for wd, path in self._paths.items():
+            if path == relpath or path.startswith(prefix):
+                del self._paths[wd]
+                self._libc.inotify_rm_watch(self._fd, wd) # may fail if already gone, that's fine
+
+    def _read_events(self):
+        """
+        yield (wd, mask, name) of all queued events (without blocking)
+        """
+        while True:
+            try:
+                buf = os.read(self._fd, READ_SIZE)
+            except OSError as err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, pos)
+                pos += EVENT_HEADER.size
+                name = buf[pos:pos+length].rstrip('\0')
+                pos += length
+                yield wd, mask, name.decode(sys.getfilesystemencoding())
+
+    def changes(self):
+        """
+        return the changes since the last call as dict relpath -> subtree:
+        relpath was created, modified or removed, subtree is True if the
+        whole tree below relpath needs to be rescanned (new directory).
+
+        Return None if events were lost (queue overflow), the caller needs
+        to rescan everything then.
+        """
+        changed = {}
+        for wd, mask, name in self._read_events():
+            if mask & IN_Q_OVERFLOW:
+                self._overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+            dirpath = self._paths.get(wd)
+            if dirpath is None:
+                continue # already unwatched
+            if not name:
+                path = dirpath # event for the watched directory itself
+            elif dirpath:
+                path = u'%s/%s' % (dirpath, name)
+            else:
+                path = name
+            if dirpath:
+                changed.setdefault(dirpath, False) # the directory listing / mtime changed
+            subtree = False
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._watch_tree(path)
+                    except OSError:
+                        self._overflow = True # can't watch it, caller has to rescan
+                    subtree = True
+                elif mask & IN_MOVED_FROM:
+                    self._unwatch_tree(path)
+            changed[path] = changed.get(path, False) or subtree
+        if self._overflow:
+            self._overflow = False
+            return None
+        return changed
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._paths = {}
@@ -8,6 +8,7 @@ MoinMoin - backend tests
 
 from __future__ import absolute_import, division
 
+import os
 from StringIO import StringIO
 
 import pytest
@@ -30,6 +31,8 @@ class BackendTestBase(object):
     def test_getrevision_raises(self):
         with pytest.raises(KeyError):
             self.be.retrieve('doesnotexist')
+        with pytest.raises(KeyError):
+            self.be.retrieve_meta('doesnotexist')
 
     def test_iter(self):
         assert list(self.be) == []
@@ -52,6 +55,8 @@ class MutableBackendTestBase(BackendTestBase):
     def test_getrevision_raises(self):
         with pytest.raises(KeyError):
             self.be.retrieve('doesnotexist')
+        with pytest.raises(KeyError):
+            self.be.retrieve_meta('doesnotexist')
 
     def test_store_get_del(self):
         meta = dict(foo='bar')
@@ -60,10 +65,58 @@ class MutableBackendTestBase(BackendTestBase):
         m, d = self.be.retrieve(metaid)
         assert m == meta
         assert d.read() == data
+        assert self.be.retrieve_meta(metaid) == meta
         self.be.remove(metaid)
         with pytest.raises(KeyError):
             self.be.retrieve(metaid)
 
+    def test_retrieve_range(self):
+        data = os.urandom(200 * 1000)
+        metaid = self.be.store(dict(name=u'big'), StringIO(data))
+        assert self.be.retrieve_range(metaid, 0, 10) == data[:10]
+        assert self.be.retrieve_range(metaid, 150000, 20000) == data[150000:170000]
+        assert self.be.retrieve_range(metaid, 199990) == data[199990:]
+        assert self.be.retrieve_range(metaid, 300000, 10) == ''
+        metaid = self.be.store(dict(name=u'small'), StringIO('small'))
+        assert self.be.retrieve_range(metaid, 1, 3) == 'mal'
+        with pytest.raises(KeyError):
+            self.be.retrieve_range('doesnotexist', 0, 1)
+
+    def test_retrieve_many(self):
+        metaids = [self.be.store(dict(name=name), StringIO(name)) for name in ['one', 'two', 'three']]
+        result = [(metaid, m['name'], d.read()) for metaid, m, d in self.be.retrieve_many(metaids)]
+        assert result == zip(metaids, ['one', 'two', 'three'], ['one', 'two', 'three'])
+        with pytest.raises(KeyError):
+            list(self.be.retrieve_many(metaids[:1] + ['doesnotexist']))
+
+    def test_iter_meta(self):
+        metaids = [self.be.store(dict(name=name), StringIO(name)) for name in ['one', 'two', 'three']]
+        result = dict((metaid, meta['name']) for metaid, meta in self.be.iter_meta())
+        assert result == dict(zip(metaids, ['one', 'two', 'three']))
+        result = dict((metaid, (meta['name'], data.read())) for metaid, meta, data in self.be.iter_revisions())
+        assert result == dict(zip(metaids, zip(['one', 'two', 'three'], ['one', 'two', 'three'])))
+
+    def test_retrieve_many_prefetch(self):
+        names = [unicode(i) for i in range(50)]
+        metaids = [self.be.store(dict(name=name), StringIO(str(name))) for name in names]
+        for prefetch_data in False, True:
+            revs = self.be.retrieve_many(metaids, prefetch=4, prefetch_data=prefetch_data)
+            result = [(metaid, m['name'], d.read()) for metaid, m, d in revs]
+            assert result == zip(metaids, names, names)
+        with pytest.raises(KeyError):
+            list(self.be.retrieve_many(metaids[:10] + ['doesnotexist'], prefetch=4))
+
+    def test_astore_aretrieve(self):
+        meta = dict(foo='bar')
+        data = 'baz'
+        metaid = self.be.astore(meta, StringIO(data)).get()
+        assert self.be.aiter().get() == [metaid]
+        m, d = self.be.aretrieve(metaid).get()
+        assert m == meta
+        assert d.read() == data
+        with pytest.raises(KeyError):
+            self.be.aretrieve('doesnotexist').get()
+
     def test_store_check_size(self):
         # no size
         meta = dict(name='foo')
@@ -0,0 +1,64 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - chunking tests
+"""
+
+
+from __future__ import absolute_import, division
+
+import os
+import random
+from StringIO import StringIO
+
+import pytest
+
+from .._chunking import iter_chunks, store_chunks, parse_manifest, ChunkedFile, MIN_SIZE, MAX_SIZE
+
+from storage.stores.memory import BytesStore as MemoryBytesStore
+
+random.seed(42)
+TEXT = '\n'.join(' '.join(random.choice(['foo', 'bar', 'baz', 'some', 'words']) for j in range(random.randint(0, 20)))
+                 for i in range(20000))
+BINARY = os.urandom(1000 * 1000)
+
+
+@pytest.mark.parametrize('data', [TEXT, BINARY, '', 'x', '\x00' * 300000],
+                         ids=['text', 'binary', 'empty', 'one', 'zeros'])
+def test_chunks(data):
+    chunks = list(iter_chunks(StringIO(data)))
+    assert ''.join(chunks) == data
+    assert all(len(chunk) <= MAX_SIZE for chunk in chunks)
+    assert all(len(chunk) >= MIN_SIZE for chunk in chunks[:-1])
+
+
+@pytest.mark.parametrize('data', [TEXT, BINARY], ids=['text', 'binary'])
+def test_chunks_shift(data):
+    # inserting some data only changes the chunk(s) near to it
+    chunks = set(iter_chunks(StringIO(data)))
+    pos = len(data) // 2
+    changed = set(iter_chunks(StringIO(data[:pos] + 'inserted' + data[pos:])))
+    assert len(chunks) > 10
+    assert len(changed - chunks) <= 2
+
+
+def test_chunked_file():
+    store = MemoryBytesStore()
+    store.create()
+    manifest = store_chunks(StringIO(BINARY), store)
+    assert sum(size for digest, size in parse_manifest(manifest)) == len(BINARY)
+    f = ChunkedFile(manifest, store)
+    assert f.read() == BINARY
+    assert f.read() == ''
+    f.seek(12345)
+    assert f.read(100000) == BINARY[12345:112345]
+    assert f.tell() == 112345
+    f.seek(-10, 2)
+    assert f.read() == BINARY[-10:]
+    f.seek(0)
+    blocks = iter(lambda: f.read(8192), '')
+    assert ''.join(blocks) == BINARY
+    f.close()
+    with pytest.raises(ValueError):
+        f.read()
@@ -0,0 +1,43 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - delta encoding tests
+"""
+
+
+from __future__ import absolute_import, division
+
+import pytest
+
+from .._delta import make_delta, apply_delta, encode_record, decode_record
+
+BASE = ''.join('line %d\n' % i for i in range(100))
+
+
+@pytest.mark.parametrize('text', [
+    BASE,
+    '',
+    BASE + 'appended\n',
+    'prepended\n' + BASE,
+    BASE.replace('line 50\n', 'changed\n').replace('line 7\n', ''),
+    'no newline at end',
+    BASE[:-1],
+], ids=['same', 'empty', 'append', 'prepend', 'change', 'other', 'no-eol'])
+def test_roundtrip(text):
+    base_lines = BASE.splitlines(True)
+    ops = make_delta(base_lines, text.splitlines(True))
+    chain, ops = decode_record(encode_record([u'keyframe'], ops))
+    assert chain == [u'keyframe']
+    assert ''.join(apply_delta(base_lines, ops)) == text
+
+
+def test_small_delta():
+    text = BASE.replace('line 50\n', 'changed\n')
+    record = encode_record([u'keyframe'], make_delta(BASE.splitlines(True), text.splitlines(True)))
+    assert len(record) < 100
+
+
+def test_invalid_record():
+    with pytest.raises(ValueError):
+        decode_record('CHUNKS1\n')
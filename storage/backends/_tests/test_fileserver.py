@@ -9,21 +9,36 @@ MoinMoin - fileserver backend tests
 from __future__ import absolute_import, division
 
 import os
+import shutil
 import tempfile
 
 import pytest
 
-from config import MTIME
+from config import NAME, ITEMID, MTIME
+from .. import fileserver
 from ..fileserver import Backend
 from . import BackendTestBase
 
 
 class TestFileServerBackend(BackendTestBase):
+    watch = False
+
     def setup_method(self, method):
         self.path = path = tempfile.mkdtemp()
-        self.be = Backend(path)
+        self.be = Backend(path, watch=self.watch)
         self.be.open()
 
+    def teardown_method(self, method):
+        self.be.close()
+        shutil.rmtree(self.path)
+
+    def _write(self, name, data, mtime=None):
+        fn = os.path.join(self.path, name)
+        with open(fn, 'wb') as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(fn, (mtime, mtime))
+
     def _prepare(self, items):
         expected_result = set()
         for name, meta, data in items:
@@ -50,8 +65,10 @@ class TestFileServerBackend(BackendTestBase):
         result = set()
         for i in self.be:
             meta, data = self.be.retrieve(i)
-            # we don't want to check mtime
+            assert self.be.retrieve_meta(i) == meta
+            # we don't want to check mtime, name and itemid are the path
             del meta[MTIME]
+            assert meta.pop(NAME) == meta.pop(ITEMID) == i.rsplit(u'/', 1)[0]
             meta = tuple(sorted(meta.items()))
             data = data.read()
             result.add((meta, data))
@@ -76,11 +93,95 @@ class TestFileServerBackend(BackendTestBase):
         result = set()
         for i in self.be:
             meta, data = self.be.retrieve(i)
-            # we don't want to check mtime
+            # we don't want to check mtime, name and itemid are the path
             del meta[MTIME]
+            assert meta.pop(NAME) == meta.pop(ITEMID) == i.rsplit(u'/', 1)[0]
             meta = tuple(sorted(meta.items()))
             data = data.read()
             result.add((meta, data))
         assert result == expected_result
 
+    def test_revid_changes(self):
+        self._write('foo.txt', 'old', mtime=1000)
+        revid, = list(self.be)
+        assert revid == u'foo.txt/1000000000'
+        assert self.be.retrieve_meta(revid)[NAME] == u'foo.txt'
+        self._write('foo.txt', 'new', mtime=2000)
+        with pytest.raises(KeyError):
+            self.be.retrieve_meta(revid) # outdated
+        new_revid, = list(self.be)
+        meta, data = self.be.retrieve(new_revid)
+        assert data.read() == 'new'
+        assert self.be.retrieve_range(new_revid, 1, 1) == 'e'
+        with pytest.raises(KeyError):
+            self.be.retrieve(u'foo.txt')
+        with pytest.raises(KeyError):
+            self.be.retrieve(u'bar.txt/1000000000')
+
+    def test_changes(self):
+        self._write('foo.txt', 'foo', mtime=1000)
+        token, added, removed = self.be.changes()
+        assert added is None and removed is None # unknown state, compare everything
+        token, added, removed = self.be.changes(token)
+        assert (added, removed) == ([], [])
+        os.mkdir(os.path.join(self.path, 'dir'))
+        self._write('dir/bar.txt', 'bar', mtime=1000)
+        self._write('foo.txt', 'new foo', mtime=2000)
+        token, added, removed = self.be.changes(token)
+        assert set(added) == set(list(self.be)) - set([u'foo.txt/1000000000'])
+        assert removed == [u'foo.txt/1000000000']
+        dir_revid = [revid for revid in self.be if revid.startswith(u'dir/')][0]
+        shutil.rmtree(os.path.join(self.path, 'dir'))
+        token, added, removed = self.be.changes(token)
+        assert added == []
+        assert set(removed) == set([u'dir/bar.txt/1000000000', dir_revid])
+        # a token that is not the latest one
+        assert self.be.changes(u'outdated')[1:] == (None, None)
+
+    def test_changes_cache(self):
+        cache_path = os.path.join(self.path, '.cache')
+        be = Backend(os.path.join(self.path, 'files'), cache_path=cache_path)
+        os.mkdir(be.path)
+        be.open()
+        self._write('files/foo.txt', 'foo', mtime=1000)
+        token = be.changes()[0]
+        be.close()
+        be = Backend(os.path.join(self.path, 'files'), cache_path=cache_path)
+        be.open()
+        self._write('files/bar.txt', 'bar', mtime=1000)
+        token, added, removed = be.changes(token)
+        assert (added, removed) == ([u'bar.txt/1000000000'], [])
+        be.close()
+
+    def test_dir_page_cache(self, monkeypatch):
+        os.mkdir(os.path.join(self.path, 'dir'))
+        self._write('dir/foo.txt', 'foo')
+        os.utime(os.path.join(self.path, 'dir'), (1000, 1000))
+        revid = u'dir/1000000000'
+        page = self.be.retrieve(revid)[1].read()
+        assert u'foo.txt' in page
+        listed = []
+        def scandir(path):
+            listed.append(path)
+            return fileserver._listdir_scandir(path)
+        monkeypatch.setattr(fileserver, 'scandir', scandir)
+        assert self.be.retrieve(revid)[1].read() == page
+        assert listed == [] # cached
+        self._write('dir/bar.txt', 'bar')
+        os.utime(os.path.join(self.path, 'dir'), (2000, 2000))
+        page = self.be.retrieve(u'dir/2000000000')[1].read()
+        assert u'bar.txt' in page and u'foo.txt' in page
+        assert len(listed) == 1
+
+    def test_walk_fallback(self, monkeypatch):
+        # the listdir + stat based scandir replacement
+        monkeypatch.setattr(fileserver, 'scandir', fileserver._listdir_scandir)
+        os.makedirs(os.path.join(self.path, 'dir/sub'))
+        self._write('dir/sub/foo.txt', 'foo', mtime=1000)
+        os.symlink(os.path.join(self.path, 'dir'), os.path.join(self.path, 'link'))
+        keys = sorted(revid.rsplit(u'/', 1)[0] for revid in self.be)
+        assert keys == [u'dir', u'dir/sub', u'dir/sub/foo.txt'] # symlinked dirs are skipped
+
 
+class TestFileServerBackendWatched(TestFileServerBackend):
+    watch = True
@@ -0,0 +1,109 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - garbage collector tests
+"""
+
+
+from __future__ import absolute_import, division
+
+from StringIO import StringIO
+
+from config import DATAID
+
+from ..stores import MutableBackend
+from .. import _gc
+from .._gc import GarbageCollector, FingerprintSet
+
+from storage.stores.memory import BytesStore as MemoryBytesStore
+from storage.stores.memory import FileStore as MemoryFileStore
+
+
+class TestGarbageCollector(object):
+    def setup_method(self, method):
+        self.be = MutableBackend(MemoryBytesStore(), MemoryFileStore(), refs_store=MemoryBytesStore())
+        self.be.create()
+        self.be.open()
+        self.metaids = [self.be.store(dict(name=unicode(i)), StringIO(str(i))) for i in range(10)]
+        self.be.data_store[u'orphan1'] = StringIO('garbage')
+        self.be.data_store[u'orphan2'] = StringIO('more garbage')
+
+    def teardown_method(self, method):
+        self.be.close()
+        self.be.destroy()
+
+    def test_fingerprint_set(self):
+        fps = FingerprintSet(unicode(i) for i in range(1000))
+        assert len(fps) == 1000
+        assert u'123' in fps
+        assert u'foo' not in fps
+
+    def test_dry_run(self):
+        report = self.be.collect_garbage(dry_run=True)
+        assert report['referenced'] == 10
+        assert report['data'] == 12
+        assert report['garbage'] == [u'orphan1', u'orphan2']
+        assert report['garbage_bytes'] == len('garbage') + len('more garbage')
+        assert report['removed'] == 0
+        assert len(list(self.be.data_store)) == 12
+
+    def test_collect(self):
+        report = self.be.collect_garbage()
+        assert report['removed'] == 2
+        assert sorted(self.be.data_store) == sorted(self.be.retrieve(metaid)[0][DATAID] for metaid in self.metaids)
+        assert self.be.collect_garbage()['removed'] == 0
+
+    def test_incremental(self):
+        gc = GarbageCollector(self.be, batch_size=3)
+        steps = 1
+        while not gc.step(time_budget=0):
+            steps += 1
+            if gc.report['phase'] == 'scan' and u'late' not in self.be.data_store:
+                # referenced by a meta stored after the mark phase
+                self.be.data_store[u'late'] = StringIO('late')
+                self.be.store(dict(name=u'late', dataid=u'late'), None)
+        assert steps > 5
+        assert gc.report['garbage'] == [u'orphan1', u'orphan2']
+        assert u'late' in self.be.data_store
+
+    def test_inflight_store(self):
+        gc = GarbageCollector(self.be, batch_size=3)
+        gc.step(time_budget=0)
+        # data stored after the gc started, its meta is not stored yet
+        pending = []
+        self.be._store_meta = lambda meta, inline: pending.append((meta, inline))
+        self.be.store(dict(name=u'inflight'), StringIO('inflight'))
+        del self.be._store_meta
+        gc.step()
+        meta, inline = pending[0]
+        assert gc.report['kept'] == [meta[DATAID]]
+        assert gc.report['removed'] == 2
+        assert self.be._touched is None
+        metaid = self.be._store_meta(meta, inline)
+        assert self.be.retrieve(metaid)[1].read() == 'inflight'
+
+    def test_fingerprint_set_incremental(self, monkeypatch):
+        monkeypatch.setattr(_gc, 'SORT_CHUNK_SIZE', 7)
+        fps = FingerprintSet()
+        for i in range(0, 100, 10):
+            fps.add_many(unicode(j) for j in range(i, i + 10))
+        assert len(fps._chunks) > 1
+        assert len(fps.freeze()) == 100
+        assert list(fps._fingerprints) == sorted(fps._fingerprints)
+        assert u'42' in fps
+        assert u'foo' not in fps
+
+    def test_sweep_refs_incremental(self):
+        for i in range(10):
+            self.be.refs_store['stale%d' % i] = 'orphan1 1'
+        gc = GarbageCollector(self.be, batch_size=3)
+        stale_counts = set()
+        while not gc.step(time_budget=0):
+            # the refs are only locked while a batch is processed
+            assert not self.be._refs_lock.locked()
+            stale_counts.add(len([key for key in self.be.refs_store if key.startswith('stale')]))
+        # the stale refs were removed batch by batch, in several steps
+        assert len(stale_counts - set([0, 10])) > 1
+        assert not [key for key in self.be.refs_store if key.startswith('stale')]
+        assert len(list(self.be.refs_store)) == 10
@@ -0,0 +1,94 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - sqlite backend tests
+"""
+
+
+from __future__ import absolute_import, division
+
+import os
+import tempfile
+import shutil
+import threading
+from StringIO import StringIO
+from sqlite3 import ProgrammingError
+
+import pytest
+
+from ..sqlite import MutableBackend
+from . import MutableBackendTestBase
+
+
+class TestSqliteBackend(MutableBackendTestBase):
+    def setup_method(self, method):
+        self.tempdir = tempfile.mkdtemp()
+        self.be = MutableBackend(os.path.join(self.tempdir, 'backend.db'))
+        self.be.create()
+        self.be.open()
+
+    def teardown_method(self, method):
+        super(TestSqliteBackend, self).teardown_method(method)
+        shutil.rmtree(self.tempdir)
+
+    def _count(self, table):
+        return list(self.be.conn.execute('select count(*) from %s' % table))[0][0]
+
+    def test_store_atomic(self):
+        # wrong size: neither data nor meta are stored
+        with pytest.raises(ValueError):
+            self.be.store(dict(name=u'foo', size=42), StringIO('bar'))
+        assert self._count('meta') == self._count('data') == 0
+
+    def test_batch(self):
+        with self.be.batch():
+            metaids = [self.be.store(dict(name=unicode(i)), StringIO(str(i))) for i in range(10)]
+        assert sorted(self.be) == sorted(metaids)
+        with pytest.raises(ValueError):
+            with self.be.batch():
+                self.be.store(dict(name=u'new'), StringIO('new'))
+                self.be.remove(metaids[0])
+                raise ValueError("rolls back the whole batch")
+        assert sorted(self.be) == sorted(metaids)
+        assert self._count('data') == 10
+
+    def test_shared_data(self):
+        metaid1 = self.be.store(dict(name=u'foo'), StringIO('bar'))
+        meta = self.be.retrieve_meta(metaid1)
+        del meta['revid']
+        metaid2 = self.be.store(meta, None)
+        self.be.remove(metaid1)
+        assert self.be.retrieve(metaid2)[1].read() == 'bar'
+        self.be.remove(metaid2)
+        assert self._count('data') == 0
+
+    def test_iter_metaids(self):
+        metaids = [self.be.store(dict(itemid=u'item', name=u'foo', mtime=i), StringIO(str(i))) for i in range(3)]
+        other = self.be.store(dict(itemid=u'other', name=u'foo', mtime=1), StringIO('other'))
+        assert list(self.be.iter_metaids(itemid=u'item')) == metaids
+        assert sorted(self.be.iter_metaids(name=u'foo')) == sorted(metaids + [other])
+        assert list(self.be.iter_metaids(itemid=u'other', name=u'foo')) == [other]
+        assert list(self.be.iter_metaids(name=u'bar')) == []
+
+    def test_latest_revisions(self):
+        foo = [self.be.store(dict(itemid=u'foo', mtime=mtime), StringIO('foo')) for mtime in [1, 3, 2]]
+        bar = self.be.store(dict(itemid=u'bar', mtime=1, contenttype=u'text/plain'), StringIO('bar'))
+        assert list(self.be.latest_revisions()) == [(u'bar', bar), (u'foo', foo[1])]
+        assert list(self.be.item_revisions(u'foo')) == [foo[0], foo[2], foo[1]]
+        dataid = self.be.retrieve_meta(bar)['dataid']
+        assert list(self.be.metaids_by_dataid(dataid)) == [bar]
+
+    def test_close_thread_connections(self):
+        conns = []
+        thread = threading.Thread(target=lambda: conns.append(self.be.conn))
+        thread.start()
+        thread.join()
+        self.be.close()
+        with pytest.raises(ProgrammingError): # closed
+            conns[0].execute('select 1')
+        self.be.open()
+
+    def test_memory_db_rejected(self):
+        with pytest.raises(ValueError):
+            MutableBackend(':memory:')
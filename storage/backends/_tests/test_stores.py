@@ -11,13 +11,21 @@ Note: theoretically, it should be enough to test with one kind of store,
 
 from __future__ import absolute_import, division
 
+import json
+import shutil
+import threading
+from StringIO import StringIO
+
 import pytest
 
-from ..stores import MutableBackend
+from ..stores import MutableBackend, PROJECTED_COLUMNS, project_meta
+from .. import _codec, _delta, _util
 from . import MutableBackendTestBase
 
 from storage.stores.memory import BytesStore as MemoryBytesStore
 from storage.stores.memory import FileStore as MemoryFileStore
+from storage.stores.sqlite import BytesStore as SqliteBytesStore
+from storage.stores.wrappers import DictCompressingBytesStore, DICT_MAGIC
 
 class TestMemoryBackend(MutableBackendTestBase):
     def setup_method(self, method):
@@ -27,6 +35,52 @@ class TestMemoryBackend(MutableBackendTestBase):
         self.be.create()
         self.be.open()
 
+    def test_time_ordered_ids(self):
+        self.be.close()
+        self.be.destroy()
+        self.be = MutableBackend(MemoryBytesStore(), MemoryFileStore(), time_ordered_ids=True)
+        self.be.create()
+        self.be.open()
+        metaids = [self.be.store(dict(name=unicode(i)), StringIO(str(i))) for i in range(10)]
+        assert metaids == sorted(metaids)
+        dataids = [self.be.retrieve_meta(metaid)['dataid'] for metaid in metaids]
+        assert dataids == sorted(dataids)
+
+    def test_lazy_data(self):
+        metaid = self.be.store(dict(name=u'foo'), StringIO('bar'))
+        meta, data = self.be.retrieve(metaid)
+        del self.be.data_store[meta['dataid']]
+        # data is not opened yet, but we know size and hash
+        assert data.size == 3
+        assert data.hexdigest == meta['sha1']
+        assert data.tell() == 0
+        assert not data.opened
+        with pytest.raises(KeyError):
+            data.read()
+        self.be.data_store[meta['dataid']] = StringIO('bar')
+        assert data.read() == 'bar'
+        data.seek(1)
+        assert data.read() == 'ar'
+        data.close()
+        with pytest.raises(ValueError):
+            data.read()
+
+    def test_failing_write(self, monkeypatch):
+        monkeypatch.setattr(_util, 'cpu_count', lambda: 2) # hash in the background
+        class FailingFileStore(MemoryFileStore):
+            def __setitem__(self, key, stream):
+                stream.read(_util.BACKGROUND_MINSIZE)
+                raise IOError("disk full")
+        self.be.data_store = FailingFileStore()
+        self.be.data_store.create()
+        self.be.data_store.open()
+        data = StringIO('x' * 10 * _util.BACKGROUND_MINSIZE)
+        with pytest.raises(IOError):
+            self.be.store(dict(name=u'foo'), data)
+        assert not [t for t in threading.enumerate() if t.name == 'hashing' and t.is_alive()]
+        # the caller's file is left open
+        data.seek(0)
+
 import os
 import tempfile
 
@@ -46,3 +100,350 @@ class TestFSBackend(MutableBackendTestBase):
         self.be.open()
 
 
+class TestMetaCodecs(object):
+    def setup_method(self, method):
+        self.be = MutableBackend(MemoryBytesStore(), MemoryFileStore())
+        self.be.create()
+        self.be.open()
+
+    def teardown_method(self, method):
+        self.be.close()
+        self.be.destroy()
+
+    def test_roundtrip(self):
+        meta = dict(name=u'foo', size=3, tags=[u'a', u'b'], somethingelse=u'\xe4')
+        for codec in _codec.json_codec, _codec.binary_codec:
+            meta_str = codec.encode(meta)
+            assert meta_str[0] == codec.format
+            assert _codec.decode(meta_str) == meta
+
+    def test_inline_data(self):
+        meta = dict(name=u'foo', datainline='\x00\xff binary')
+        for codec in _codec.json_codec, _codec.binary_codec:
+            assert _codec.decode(codec.encode(meta)) == meta
+
+    def test_same_types(self):
+        meta = {'name': 'foo', 'acl': 'plain', 'tags': ('a', u'b'), 'extra': {'k': ['v']}}
+        decoded = [_codec.decode(codec.encode(meta)) for codec in _codec.json_codec, _codec.binary_codec]
+        assert decoded[0] == decoded[1] == {u'name': u'foo', u'acl': u'plain', u'tags': [u'a', u'b'],
+                                            u'extra': {u'k': [u'v']}}
+        for meta in decoded:
+            assert all(isinstance(key, unicode) for key in meta)
+            assert isinstance(meta['acl'], unicode)
+            assert isinstance(meta['extra'].keys()[0], unicode)
+
+    def test_default_codec(self):
+        metaid = self.be.store(dict(name=u'foo'), StringIO('bar'))
+        assert self.be.meta_store[metaid][:1] == _codec.FORMAT_JSON
+
+    def test_legacy_json(self):
+        meta = dict(name=u'foo', dataid=u'bar')
+        self.be.data_store[u'bar'] = StringIO('baz')
+        self.be.meta_store[u'legacy'] = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+        m, d = self.be.retrieve(u'legacy')
+        assert m == meta
+        assert d.read() == 'baz'
+
+    def test_unknown_format(self):
+        with pytest.raises(ValueError):
+            _codec.decode('\xffwhatever')
+
+
+class TestDedupMemoryStore(MutableBackendTestBase):
+    def setup_method(self, method):
+        self.be = MutableBackend(MemoryBytesStore(), MemoryFileStore(), refs_store=MemoryBytesStore())
+        self.be.create()
+        self.be.open()
+
+    def test_shared_data(self):
+        metaid1 = self.be.store(dict(name=u'one'), StringIO('same'))
+        metaid2 = self.be.store(dict(name=u'two'), StringIO('same'))
+        metaid3 = self.be.store(dict(name=u'three'), StringIO('other'))
+        m1, d1 = self.be.retrieve(metaid1)
+        m2, d2 = self.be.retrieve(metaid2)
+        assert m1['dataid'] == m2['dataid']
+        assert len(list(self.be.data_store)) == 2
+        # a revision given with the dataid of existing data is another reference
+        meta = dict(m1)
+        del meta['revid']
+        metaid4 = self.be.store(meta, None)
+        self.be.remove(metaid1)
+        self.be.remove(metaid2)
+        assert self.be.retrieve(metaid4)[1].read() == 'same'
+        self.be.remove(metaid4)
+        assert list(self.be.data_store) == [self.be.retrieve(metaid3)[0]['dataid']]
+        self.be.remove(metaid3)
+        assert list(self.be.data_store) == []
+        assert list(self.be.refs_store) == []
+
+    def test_given_untracked_dataid(self):
+        # data stored before deduplication was enabled
+        be = MutableBackend(self.be.meta_store, self.be.data_store)
+        metaid1 = be.store(dict(name=u'one'), StringIO('same'))
+        metaid2 = self.be.store(dict(name=u'two'), StringIO('same'))
+        meta = self.be.retrieve_meta(metaid1)
+        del meta['revid']
+        metaid3 = self.be.store(meta, None)
+        # the given dataid is used as it is, no data is removed
+        assert self.be.retrieve_meta(metaid3)['dataid'] == meta['dataid']
+        for metaid in [metaid1, metaid2, metaid3]:
+            assert self.be.retrieve(metaid)[1].read() == 'same'
+        # removing a revision using the untracked data keeps it for the others
+        self.be.remove(metaid3)
+        assert self.be.retrieve(metaid1)[1].read() == 'same'
+        # it is removed by the gc when no revision uses it any more
+        self.be.remove(metaid1)
+        assert self.be.collect_garbage()['removed'] == 1
+        assert self.be.retrieve(metaid2)[1].read() == 'same'
+
+    def test_ref_update_interrupted(self, monkeypatch):
+        metaid1 = self.be.store(dict(name=u'one'), StringIO('same'))
+        metaid2 = self.be.store(dict(name=u'two'), StringIO('same'))
+        refs_store = self.be.refs_store
+        hexdigest = self.be.retrieve_meta(metaid1)['sha1']
+        set_item = MemoryBytesStore.__setitem__
+        def crash(store, key, value):
+            if key == hexdigest:
+                raise KeyboardInterrupt
+            set_item(store, key, value)
+        # crash after the old ref was deleted, before the new one was written
+        monkeypatch.setattr(MemoryBytesStore, '__setitem__', crash)
+        with pytest.raises(KeyboardInterrupt):
+            self.be.store(dict(name=u'three'), StringIO('same'))
+        monkeypatch.undo()
+        assert hexdigest not in refs_store
+        assert self.be._get_ref(hexdigest)[1] == 3
+        # the pending ref is used, so the shared data stays while it is referenced
+        self.be.remove(metaid1)
+        self.be.remove(metaid2)
+        assert self.be._get_ref(hexdigest)[1] == 1
+        assert sorted(refs_store) == [hexdigest]
+
+    def test_layout_change(self):
+        # plain data is not shared with chunked data and vice versa
+        metaid1 = self.be.store(dict(name=u'one'), StringIO('same'))
+        chunk_store = MemoryBytesStore()
+        chunk_store.create()
+        chunk_store.open()
+        be = MutableBackend(self.be.meta_store, self.be.data_store, refs_store=self.be.refs_store,
+                            chunk_store=chunk_store)
+        metaid2 = be.store(dict(name=u'two'), StringIO('same'))
+        metaid3 = self.be.store(dict(name=u'three'), StringIO('same'))
+        assert be.retrieve_meta(metaid2)['dataid'] != be.retrieve_meta(metaid1)['dataid']
+        assert be.retrieve_meta(metaid3)['dataid'] == be.retrieve_meta(metaid1)['dataid']
+        for metaid in [metaid1, metaid2, metaid3]:
+            assert be.retrieve(metaid)[1].read() == 'same'
+        be.remove(metaid2)
+        be.remove(metaid1)
+        assert be.retrieve(metaid3)[1].read() == 'same'
+
+    def test_concurrent_stores(self):
+        results = [self.be.astore(dict(name=unicode(i)), StringIO('same')) for i in range(20)]
+        metaids = [result.get() for result in results]
+        assert len(list(self.be.data_store)) == 1
+        for metaid in metaids:
+            self.be.remove(metaid)
+        assert list(self.be.data_store) == []
+
+
+class TestChunkedMemoryStore(MutableBackendTestBase):
+    def setup_method(self, method):
+        self.be = MutableBackend(MemoryBytesStore(), MemoryFileStore(), chunk_store=MemoryBytesStore())
+        self.be.create()
+        self.be.open()
+
+    def test_shared_chunks(self):
+        data = os.urandom(500 * 1000)
+        metaid1 = self.be.store(dict(name=u'foo'), StringIO(data))
+        chunks = len(list(self.be.chunk_store))
+        changed = data[:1000] + 'changed' + data[1000:]
+        metaid2 = self.be.store(dict(name=u'foo'), StringIO(changed))
+        assert len(list(self.be.chunk_store)) <= chunks + 2
+        assert self.be.retrieve(metaid1)[1].read() == data
+        assert self.be.retrieve(metaid2)[1].read() == changed
+        # only the chunks overlapping the range are fetched
+        fetched = []
+        get_many = self.be.chunk_store.get_many
+        self.be.chunk_store.get_many = lambda keys: fetched.extend(keys) or get_many(keys)
+        assert self.be.retrieve_range(metaid2, 300000, 10) == changed[300000:300010]
+        assert 1 <= len(fetched) <= 2
+        del self.be.chunk_store.get_many
+        # chunks are not removed with the revision, but by the gc
+        self.be.remove(metaid1)
+        report = self.be.collect_garbage()
+        assert 1 <= report['chunks']['removed'] <= 2
+        assert self.be.retrieve(metaid2)[1].read() == changed
+        self.be.remove(metaid2)
+        self.be.collect_garbage()
+        assert list(self.be.chunk_store) == []
+
+
+class TestDeltaMemoryStore(MutableBackendTestBase):
+    def setup_method(self, method):
+        self.be = MutableBackend(MemoryBytesStore(), MemoryFileStore(), refs_store=MemoryBytesStore(),
+                                 heads_store=MemoryBytesStore(), keyframe_interval=4)
+        self.be.create()
+        self.be.open()
+
+    def _store_revisions(self, count):
+        texts, metaids = [], []
+        for i in range(count):
+            text = ''.join('line %d of revision %d\n' % (j, j < i and j or 0) for j in range(100))
+            meta = dict(name=u'foo', itemid=u'item', contenttype=u'text/plain;charset=utf-8')
+            texts.append(text)
+            metaids.append(self.be.store(meta, StringIO(text)))
+        return texts, metaids
+
+    def test_delta_chain(self):
+        texts, metaids = self._store_revisions(10)
+        layouts = [self.be.retrieve_meta(metaid).get('datalayout') for metaid in metaids]
+        assert layouts == ['keyframe', 'delta', 'delta', 'delta'] * 2 + ['keyframe', 'delta']
+        for metaid, text in zip(metaids, texts):
+            meta, data = self.be.retrieve(metaid)
+            assert data.read() == text
+            assert meta['size'] == len(text)
+            assert self.be.retrieve_range(metaid, 100, 50) == text[100:150]
+        # the deltas are much smaller than the full text
+        sizes = [len(self.be._read_data(self.be.retrieve_meta(metaid)['dataid'])) for metaid in metaids]
+        assert max(sizes[1:4]) < sizes[0] // 4
+
+    def test_head_read(self):
+        texts, metaids = self._store_revisions(7)
+        # only the head (a delta) has its full text in the heads store
+        assert len(list(self.be.heads_store)) == 2
+        reads = []
+        get_many = self.be.data_store.get_many
+        self.be.data_store.get_many = lambda keys: reads.extend(keys) or get_many(keys)
+        get_data = self.be._get_data
+        self.be._get_data = lambda dataid: reads.append(dataid) or get_data(dataid)
+        # reading the latest revision does not touch the data store (no deltas applied)
+        assert self.be.retrieve(metaids[-1])[1].read() == texts[-1]
+        assert self.be.retrieve_range(metaids[-1], 100, 50) == texts[-1][100:150]
+        assert reads == []
+        assert self.be.retrieve(metaids[-2])[1].read() == texts[-2]
+        assert len(reads) == 2 # the record, then its chain (the keyframe)
+        # a new head replaces the full text of the old one
+        texts, metaids = self._store_revisions(1)
+        assert len(list(self.be.heads_store)) == 2
+
+    def test_remove_and_gc(self):
+        texts, metaids = self._store_revisions(6)
+        # removing a revision keeps data other revisions are based on
+        for metaid in metaids[:3] + metaids[4:]:
+            self.be.remove(metaid)
+        report = self.be.collect_garbage()
+        # revision 3 needs the keyframe 0 and the deltas 1, 2
+        assert report['removed'] == 2
+        assert self.be.retrieve(metaids[3])[1].read() == texts[3]
+        # the head (revision 5) was removed, next one starts a new chain
+        assert list(self.be.heads_store) == []
+        texts, metaids = self._store_revisions(2)
+        assert self.be.retrieve_meta(metaids[0])['datalayout'] == 'keyframe'
+        assert self.be.retrieve(metaids[1])[1].read() == texts[1]
+
+    def test_too_big(self, monkeypatch):
+        monkeypatch.setattr(_delta, 'MAX_SIZE', 1000)
+        texts, metaids = self._store_revisions(1)
+        big = 'x' * 5000
+        reads = []
+        class BigFile(StringIO):
+            def read(self, size=-1):
+                reads.append(size)
+                return StringIO.read(self, size)
+        meta = dict(name=u'foo', itemid=u'item', contenttype=u'text/plain;charset=utf-8')
+        metaid = self.be.store(meta, BigFile(big))
+        # only MAX_SIZE + 1 bytes are read by us, the rest is read by the data store
+        assert reads[0] == 1001
+        assert 'datalayout' not in self.be.retrieve_meta(metaid)
+        assert self.be.retrieve(metaid)[1].read() == big
+        assert list(self.be.heads_store) == []
+
+    def test_not_deltified(self):
+        metaid1 = self.be.store(dict(name=u'foo', itemid=u'item', contenttype=u'image/png'), StringIO('binary'))
+        metaid2 = self.be.store(dict(name=u'foo'), StringIO('no itemid'))
+        for metaid in [metaid1, metaid2]:
+            assert 'datalayout' not in self.be.retrieve_meta(metaid)
+        assert list(self.be.heads_store) == []
+
+
+class TestInlineMemoryStore(MutableBackendTestBase):
+    def setup_method(self, method):
+        self.be = MutableBackend(MemoryBytesStore(), MemoryFileStore(), refs_store=MemoryBytesStore(),
+                                 inline_size=100)
+        self.be.create()
+        self.be.open()
+
+    @pytest.mark.parametrize('codec', [_codec.json_codec, _codec.binary_codec], ids=['json', 'binary'])
+    def test_inline(self, codec):
+        self.be.meta_codec = codec
+        small, big = '\x00small\xff', 'x' * 101
+        meta = dict(name=u'foo')
+        metaid1 = self.be.store(meta, StringIO(small))
+        assert 'datainline' not in meta
+        metaid2 = self.be.store(dict(name=u'bar'), StringIO(big))
+        # only the big data went into the data store
+        assert len(list(self.be.data_store)) == 1
+        m, d = self.be.retrieve(metaid1)
+        assert m['datalayout'] == 'inline'
+        assert 'datainline' not in m
+        assert m['size'] == len(small)
+        assert d.read() == small
+        assert 'datainline' not in self.be.retrieve_meta(metaid1)
+        datas = dict((metaid, d.read()) for metaid, m, d in self.be.iter_revisions())
+        assert datas == {metaid1: small, metaid2: big}
+        assert all('datainline' not in m for metaid, m in self.be.iter_meta())
+        assert self.be.retrieve(metaid2)[1].read() == big
+        self.be.remove(metaid1)
+        self.be.remove(metaid2)
+        assert list(self.be.data_store) == []
+
+
+class TestProjectedSqliteStore(MutableBackendTestBase):
+    def setup_method(self, method):
+        self.tempdir = tempfile.mkdtemp()
+        meta_store = SqliteBytesStore(os.path.join(self.tempdir, 'meta.db'), 'meta',
+                                      columns=PROJECTED_COLUMNS, projector=project_meta)
+        self.be = MutableBackend(meta_store, MemoryFileStore())
+        self.be.create()
+        self.be.open()
+
+    def teardown_method(self, method):
+        super(TestProjectedSqliteStore, self).teardown_method(method)
+        shutil.rmtree(self.tempdir)
+
+    def test_queries(self):
+        foo = [self.be.store(dict(name=u'foo', itemid=u'foo', mtime=mtime), StringIO('foo')) for mtime in [1, 3, 2]]
+        bar = self.be.store(dict(name=u'bar', itemid=u'bar', mtime=1), StringIO('bar'))
+        assert list(self.be.item_revisions(u'foo')) == [foo[0], foo[2], foo[1]]
+        assert sorted(self.be.latest_revisions()) == [(u'bar', bar), (u'foo', foo[1])]
+        dataid = self.be.retrieve_meta(bar)['dataid']
+        assert list(self.be.metaids_by_dataid(dataid)) == [bar]
+        self.be.data_store[u'orphan'] = StringIO('garbage')
+        report = self.be.collect_garbage()
+        assert report['garbage'] == [u'orphan']
+        assert report['referenced'] == 4
+
+    def test_not_queryable(self):
+        self.be.meta_store = MemoryBytesStore()
+        with pytest.raises(NotImplementedError):
+            list(self.be.latest_revisions())
+
+
+class TestDictCompressedSqliteStore(TestProjectedSqliteStore):
+    def setup_method(self, method):
+        self.tempdir = tempfile.mkdtemp()
+        self.sqlite_store = SqliteBytesStore(os.path.join(self.tempdir, 'meta.db'), 'meta',
+                                             columns=PROJECTED_COLUMNS, projector=project_meta)
+        meta_store = DictCompressingBytesStore(self.sqlite_store, MemoryBytesStore())
+        self.be = MutableBackend(meta_store, MemoryFileStore())
+        self.be.create()
+        self.be.open()
+
+    def test_projected_compressed(self):
+        metaids = [self.be.store(dict(name=u'foo', itemid=u'foo', mtime=mtime), StringIO('foo')) for mtime in [1, 2]]
+        self.be.meta_store.train()
+        metaids.append(self.be.store(dict(name=u'foo', itemid=u'foo', mtime=3), StringIO('foo')))
+        for metaid in metaids:
+            assert self.sqlite_store[metaid].startswith(DICT_MAGIC)
+        assert list(self.be.item_revisions(u'foo')) == metaids
+        assert list(self.be.latest_revisions()) == [(u'foo', metaids[-1])]
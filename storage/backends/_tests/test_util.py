@@ -0,0 +1,79 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - backend utilities tests
+"""
+
+
+from __future__ import absolute_import, division
+
+import io
+import os
+import shutil
+import hashlib
+import tempfile
+from StringIO import StringIO
+
+import pytest
+
+from .._util import TrackingFileWrapper
+
+from storage.stores.fs import FileStore as FSFileStore
+
+DATA = os.urandom(1000 * 1000)
+
+
+def read_all(tfw, use_readinto, blocksize=64 * 1024):
+    result = []
+    if use_readinto:
+        buf = bytearray(blocksize)
+        while True:
+            count = tfw.readinto(buf)
+            if not count:
+                break
+            result.append(str(buf[:count]))
+    else:
+        while True:
+            block = tfw.read(blocksize)
+            if not block:
+                break
+            result.append(block)
+    return ''.join(result)
+
+
+@pytest.mark.parametrize(('stream_class', 'use_readinto', 'background'), [
+    (StringIO, False, False),
+    (StringIO, True, False),
+    (io.BytesIO, True, False),
+    (io.BytesIO, True, True),
+    (io.BytesIO, False, True),
+])
+def test_tracking(stream_class, use_readinto, background):
+    tfw = TrackingFileWrapper(stream_class(DATA), hash_method=['sha1', 'md5'], background=background)
+    with pytest.raises(AttributeError):
+        tfw.size
+    assert read_all(tfw, use_readinto) == DATA
+    assert tfw.size == len(DATA)
+    assert tfw.hash.hexdigest() == hashlib.sha1(DATA).hexdigest()
+    assert tfw.hashes['md5'].hexdigest() == hashlib.md5(DATA).hexdigest()
+
+
+def test_tracking_read_all():
+    tfw = TrackingFileWrapper(StringIO(DATA), background=True)
+    assert tfw.read() == DATA
+    assert tfw.hash.hexdigest() == hashlib.sha1(DATA).hexdigest()
+
+
+def test_fs_readinto():
+    path = tempfile.mkdtemp()
+    os.rmdir(path)
+    store = FSFileStore(path)
+    store.create()
+    try:
+        tfw = TrackingFileWrapper(io.BytesIO(DATA), background=True)
+        store['key'] = tfw
+        assert tfw.hash.hexdigest() == hashlib.sha1(DATA).hexdigest()
+        assert store['key'].read() == DATA
+    finally:
+        shutil.rmtree(path)
@@ -10,40 +10,153 @@ MoinMoin - backend utilities
 from __future__ import absolute_import, division
 
 import hashlib
+import threading
+from Queue import Queue
+from multiprocessing import cpu_count
+
+# with background hashing, only blocks of at least this size are hashed in
+# the background thread (for smaller ones, the thread overhead is not worth it)
+BACKGROUND_MINSIZE = 16 * 1024
+
+
+class _HashingThread(threading.Thread):
+    """
+    Updates hashes with the blocks put into its queue, in a background thread
+    (hashlib releases the GIL for bigger blocks, so this overlaps with the
+    store writing the data).
+    """
+    def __init__(self, hashes):
+        super(_HashingThread, self).__init__(name='hashing')
+        self.daemon = True
+        self.hashes = hashes
+        # at most 2 pending blocks: one being hashed, one being read / written
+        self.queue = Queue(maxsize=2)
+
+    def run(self):
+        while True:
+            block = self.queue.get()
+            try:
+                if block is None:
+                    return
+                for h in self.hashes:
+                    h.update(block)
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        """
+        wait until all blocks put into the queue are hashed
+        """
+        self.queue.join()
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
 
 
 class TrackingFileWrapper(object):
     """
     Wraps a file and computes hashcode and file size while it is read.
     Requires that initially the realfile is open and at pos 0.
-    Users need to call .read(blocksize) until it does not return any more data.
-    After this self.hash and self.size will have the wanted values.
+    Users need to call .read(blocksize) or .readinto(buffer) until it does not
+    return any more data. After this self.hash and self.size will have the
+    wanted values.
     self.hash is the hash instance, you may want to call self.hash.hexdigest().
+    If multiple hash methods are given, self.hashes is a dict name -> hash instance
+    (self.hash is the one of the first hash method).
+
+    With background=True, blocks bigger than BACKGROUND_MINSIZE are hashed in a
+    separate thread, while the caller writes them. With background=None, this
+    is only done if we have more than one cpu (otherwise it is just overhead).
     """
-    def __init__(self, realfile, hash_method='sha1'):
+    def __init__(self, realfile, hash_method='sha1', background=False):
         self._realfile = realfile
         self._read = realfile.read
-        self._hash = hashlib.new(hash_method)
+        self._readinto = getattr(realfile, 'readinto', None)
+        if isinstance(hash_method, basestring):
+            hash_method = [hash_method]
+        self._hashes = [(name, hashlib.new(name)) for name in hash_method]
+        if background is None:
+            background = cpu_count() > 1
+        self._background = background
+        self._hashing_thread = None
         self._size = 0
         self._finished = False
-        fpos = realfile.tell()
+        # note: some file-likes (e.g. http responses) can't tell
+        fpos = realfile.tell() if hasattr(realfile, 'tell') else 0
         if fpos:
             raise ValueError("file needs to be at pos 0")
 
+    def _update(self, block):
+        # note: block must not be modified until it is hashed, see _wait
+        if self._background and len(block) >= BACKGROUND_MINSIZE:
+            if self._hashing_thread is None:
+                self._hashing_thread = _HashingThread([h for name, h in self._hashes])
+                self._hashing_thread.start()
+            self._hashing_thread.queue.put(block)
+        else:
+            self._wait() # keep the order of the blocks
+            for name, h in self._hashes:
+                h.update(block)
+        self._size += len(block)
+
+    def _wait(self):
+        if self._hashing_thread is not None:
+            self._hashing_thread.wait()
+
+    def _finish(self):
+        self._finished = True
+        if self._hashing_thread is not None:
+            self._hashing_thread.stop()
+            self._hashing_thread = None
+
     def read(self, size=None):
         # XXX: workaround for werkzeug.wsgi.LimitedStream
         #      which expects None instead of -1 for "read everything"
         if size is None:
             data = self._read()
-            self._finished = True
+            self._update(data)
+            self._finish()
         else:
             data = self._read(size)
-            if not data:
-                self._finished = True
-        self._hash.update(data)
-        self._size += len(data)
+            if data:
+                self._update(data)
+            else:
+                self._finish()
         return data
 
+    def readinto(self, buf):
+        """
+        read into a (reusable) bytearray buffer, return the number of bytes read
+        """
+        # the caller has written the previous block, so we may reuse buf now,
+        # but only after it is hashed:
+        self._wait()
+        if self._readinto is not None:
+            count = self._readinto(buf)
+        else:
+            data = self._read(len(buf))
+            count = len(data)
+            buf[:count] = data
+        if count:
+            self._update(memoryview(buf)[:count])
+        else:
+            self._finish()
+        return count
+
+    def release(self):
+        """
+        stop the background hashing (if any), but leave realfile open, e.g.
+        when the caller gives up reading before EOF
+        """
+        if self._hashing_thread is not None:
+            self._hashing_thread.stop()
+            self._hashing_thread = None
+
+    def close(self):
+        self.release()
+        self._realfile.close()
+
     @property
     def size(self):
         if not self._finished:
@@ -54,5 +167,129 @@ class TrackingFileWrapper(object):
     def hash(self):
         if not self._finished:
             raise AttributeError("do not access hash attribute before having read all data")
-        return self._hash
+        return self._hashes[0][1]
+
+    @property
+    def hashes(self):
+        if not self._finished:
+            raise AttributeError("do not access hashes attribute before having read all data")
+        return dict(self._hashes)
+
+
+class PrefixedFile(object):
+    """
+    readonly file-like returning prefix (already read from realfile), then
+    the rest of realfile
+    """
+    def __init__(self, prefix, realfile):
+        self._prefix = prefix
+        self._realfile = realfile
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._prefix + self._realfile.read()
+            self._prefix = ''
+            return data
+        if self._prefix:
+            data, self._prefix = self._prefix[:size], self._prefix[size:]
+            return data
+        return self._realfile.read(size)
+
+    def close(self):
+        self._realfile.close()
+
+
+def read_prefix(f, size):
+    """
+    read up to size bytes from f (less only at EOF)
+    """
+    blocks = []
+    while size > 0:
+        block = f.read(size)
+        if not block:
+            break
+        blocks.append(block)
+        size -= len(block)
+    return ''.join(blocks)
+
+
+class LazyData(object):
+    """
+    File-like handle for revision data, the data is only opened (fetched from
+    the store) when it is really used (read, seek, ...).
+
+    size and hexdigest are taken from the metadata, so they are available
+    without opening the data.
+    """
+    def __init__(self, opener, size=None, hexdigest=None):
+        """
+        :param opener: callable returning the opened data file
+        :param size: data size (from meta)
+        :param hexdigest: HASH_ALGORITHM hexdigest of the data (from meta)
+        """
+        self._opener = opener
+        self._file = None
+        self.closed = False
+        self.size = size
+        self.hexdigest = hexdigest
+
+    def _get_file(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if self._file is None:
+            self._file = self._opener()
+        return self._file
+
+    @property
+    def opened(self):
+        """
+        was the data opened already?
+        """
+        return self._file is not None
+
+    def open(self):
+        """
+        open the data now (e.g. to prefetch it in another thread)
+        """
+        self._get_file()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            # some file-likes want None instead of -1 for "read everything"
+            return self._get_file().read()
+        return self._get_file().read(size)
+
+    def readline(self, size=-1):
+        return self._get_file().readline(size)
+
+    def readlines(self, sizehint=-1):
+        return self._get_file().readlines(sizehint)
+
+    def __iter__(self):
+        return iter(self._get_file())
+
+    def seek(self, offset, whence=0):
+        self._get_file().seek(offset, whence)
+
+    def tell(self):
+        if self._file is None and not self.closed:
+            return 0
+        return self._get_file().tell()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
 
+    def __getattr__(self, name):
+        # everything else (e.g. fileno, name) needs the real file
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._get_file(), name)
@@ -11,6 +11,21 @@ Files show as single revision items.
 
 Directories create a virtual directory item, listing the files in that
 directory.
+
+Revids are <path>/<mtime> (mtime in microseconds), so if a file is updated,
+its revid changes. Retrieving an outdated revid raises KeyError.
+
+The changes method is a change feed (e.g. for the indexer's update): it
+tells which revids were added / removed since the last call. It is computed
+from a snapshot of the tree (path -> revid), the scan cache, which can be
+persisted into a file. With watch=True, an inotify watcher (see _inotify
+module) tells which paths changed, so only these are looked at, otherwise
+(or if the watcher can not be used) the tree is rescanned.
+
+Directories are listed with scandir (if the scandir package is installed,
+otherwise listdir + stat), so walking the tree needs no extra stat calls
+for the entry types. Rendered directory pages are cached (bounded, see
+DIR_PAGE_CACHE_SIZE) and reused as long as the directory mtime is unchanged.
 """
 
 
@@ -19,10 +34,54 @@ from __future__ import absolute_import, division
 import os
 import errno
 import stat
+import marshal
+import logging
+import threading
 from StringIO import StringIO
 
-from config import MTIME, SIZE, CONTENTTYPE
+from config import NAME, ITEMID, MTIME, SIZE, CONTENTTYPE
+
+from storage._util import make_uuid, LRUCache
+
 from . import BackendBase
+from ._util import LazyData
+from . import _inotify
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+# max. number of rendered directory pages we cache
+DIR_PAGE_CACHE_SIZE = 100
+
+
+class _DirEntry(object):
+    """
+    minimal replacement for scandir's DirEntry (stats the entry when needed)
+    """
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._stat = {}
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks not in self._stat:
+            self._stat[follow_symlinks] = os.stat(self.path) if follow_symlinks else os.lstat(self.path)
+        return self._stat[follow_symlinks]
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def _listdir_scandir(path):
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+if scandir is None:
+    scandir = _listdir_scandir
 
 
 class Backend(BackendBase):
@@ -33,17 +92,35 @@ class Backend(BackendBase):
     def from_uri(cls, uri):
         return cls(uri)
 
-    def __init__(self, path):
+    def __init__(self, path, cache_path=None, watch=False, dir_page_cache_size=DIR_PAGE_CACHE_SIZE):
         """
         :param path: base directory (all files/dirs below will be exposed)
+        :param cache_path: file to persist the scan cache into (None: keep it in memory only)
+        :param watch: use inotify to find changes (if available)
+        :param dir_page_cache_size: max. number of rendered directory pages to cache
         """
         self.path = unicode(path)
+        self._dir_pages = LRUCache(dir_page_cache_size) # path -> (mtime, page)
+        self.cache_path = cache_path
+        self.watch = watch
+        self._watcher = None
+        self._snapshot = None # key -> revid, see changes()
+        self._token = None
+        self._scanned = False # did we scan the tree since the watcher was started?
+        self._lock = threading.Lock()
 
     def open(self):
-        pass
+        if self.watch:
+            try:
+                self._watcher = _inotify.Watcher(self.path)
+            except OSError as err:
+                logging.warning(u"can't watch %s for changes, falling back to scanning: %s" % (self.path, err))
 
     def close(self):
-        pass
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+        self._scanned = False
 
     def _mkpath(self, key):
         # XXX unsafe keys?
@@ -55,80 +132,223 @@ class Backend(BackendBase):
         key = path[len(root)+1:]
         return key
 
+    def _mkrevid(self, key, st):
+        return u'%s/%d' % (key, int(st.st_mtime * 1000000))
+
+    def _stat(self, key):
+        try:
+            return os.stat(self._mkpath(key))
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                raise KeyError(key)
+            raise
+
+    def _walk(self, top):
+        """
+        yield (path, stat result) for directory top and everything below it.
+
+        Like os.walk, symlinks to directories are not followed (and skipped).
+        """
+        try:
+            yield top, os.stat(top)
+        except OSError:
+            return # removed meanwhile
+        dirpaths = [top]
+        while dirpaths:
+            try:
+                entries = scandir(dirpaths.pop())
+            except OSError:
+                continue # removed meanwhile
+            for entry in entries:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not is_dir and entry.is_dir():
+                    continue # symlink to a directory
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue # removed meanwhile
+                yield entry.path, st
+                if is_dir:
+                    dirpaths.append(entry.path)
+
+    def _iter_scan(self, top=None):
+        """
+        yield (key, revid) for top and everything below it
+        """
+        for path, st in self._walk(top or self.path):
+            key = self._mkkey(path)
+            if not key:
+                continue # the base directory is not an item
+            yield key, self._mkrevid(key, st)
+
     def __iter__(self):
         # note: instead of just yielding the relative <path>, yield <path>/<mtime>,
         # so if the file is updated, the revid will change (and the indexer's
         # update() method can efficiently update the index).
-        for dirpath, dirnames, filenames in os.walk(self.path):
-            key = self._mkkey(dirpath)
-            if key:
-                yield key
-            for filename in filenames:
-                yield self._mkkey(os.path.join(dirpath, filename))
-
-    def _get_meta(self, fn):
-        path = self._mkpath(fn)
+        for key, revid in self._iter_scan():
+            yield revid
+
+    def _load_cache(self):
+        self._snapshot, self._token = {}, None
+        if self.cache_path is not None:
+            try:
+                with open(self.cache_path, 'rb') as f:
+                    self._token, self._snapshot = marshal.load(f)
+            except (IOError, OSError, EOFError, ValueError, TypeError):
+                pass # no (valid) cache, we'll scan
+
+    def _save_cache(self):
+        if self.cache_path is not None:
+            # write + rename, so we never have a partially written cache
+            tmp_path = self.cache_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                marshal.dump((self._token, self._snapshot), f, 2)
+            os.rename(tmp_path, self.cache_path)
+
+    def _apply_changes(self, snapshot, changed):
+        """
+        update snapshot for the changed paths (see _inotify.Watcher.changes)
+
+        :returns: added revids, removed revids
+        """
+        added, removed = [], []
+        gone = set()
+        for key, subtree in changed.iteritems():
+            if not key:
+                continue # the base directory is not an item
+            try:
+                st = self._stat(key)
+            except KeyError:
+                gone.add(key)
+                continue
+            scanned = [(key, self._mkrevid(key, st))]
+            if subtree and stat.S_ISDIR(st.st_mode):
+                scanned = self._iter_scan(self._mkpath(key))
+            for scanned_key, revid in scanned:
+                old_revid = snapshot.get(scanned_key)
+                if old_revid != revid:
+                    if old_revid is not None:
+                        removed.append(old_revid)
+                    added.append(revid)
+                    snapshot[scanned_key] = revid
+        if gone:
+            # removed files and directories, including everything below them
+            prefixes = tuple(key + u'/' for key in gone)
+            for key in [key for key in snapshot if key in gone or key.startswith(prefixes)]:
+                removed.append(snapshot.pop(key))
+        return added, removed
+
+    def changes(self, since=None):
+        """
+        change feed: return (token, added revids, removed revids) for the
+        changes since the state identified by token since (as returned by
+        the previous call).
+
+        If since is not the token of the previous call (or None), added and
+        removed are None, the caller has to compare everything (e.g. iterate
+        over the backend). As only the latest state is kept, there should be
+        only one consumer of the change feed.
+        """
+        with self._lock:
+            if self._snapshot is None:
+                self._load_cache()
+            snapshot, token = self._snapshot, self._token
+            changed = None
+            if self._watcher is not None:
+                changed = self._watcher.changes()
+                if not self._scanned:
+                    changed = None # the changes before the watcher started are unknown
+            if changed is None:
+                new_snapshot = dict(self._iter_scan())
+                added = [revid for key, revid in new_snapshot.iteritems() if snapshot.get(key) != revid]
+                removed = [revid for key, revid in snapshot.iteritems() if new_snapshot.get(key) != revid]
+                snapshot = new_snapshot
+                self._scanned = True
+            else:
+                added, removed = self._apply_changes(snapshot, changed)
+            self._snapshot, self._token = snapshot, make_uuid()
+            self._save_cache()
+            if since is None or since != token:
+                return self._token, None, None
+            return self._token, added, removed
+
+    def _split_revid(self, revid):
+        """
+        return key, st for revid, raise KeyError if revid does not exist (any more)
+        """
         try:
-            st = os.stat(path)
-        except OSError as e:
-            if e.errno == errno.ENOENT:
-                raise KeyError(fn)
-            raise
+            key, mtime = revid.rsplit(u'/', 1)
+        except ValueError:
+            raise KeyError(revid)
+        st = self._stat(key)
+        if self._mkrevid(key, st) != revid:
+            raise KeyError(revid) # outdated
+        return key, st
+
+    def _get_meta(self, fn, st):
         meta = {}
+        meta[NAME] = fn
+        meta[ITEMID] = fn
         meta[MTIME] = int(st.st_mtime) # use int, not float
         if stat.S_ISDIR(st.st_mode):
             # directory
             # we create a virtual wiki page listing links to subitems:
-            ct = 'text/x.moin.wiki;charset=utf-8'
+            ct = u'text/x.moin.wiki;charset=utf-8'
             size = 0
         elif stat.S_ISREG(st.st_mode):
             # normal file
             # TODO: real mimetype guessing
             if fn.endswith('.png'):
-                ct = 'image/png'
+                ct = u'image/png'
             elif fn.endswith('.txt'):
-                ct = 'text/plain'
+                ct = u'text/plain'
             else:
-                ct = 'application/octet-stream'
+                ct = u'application/octet-stream'
             size = int(st.st_size) # use int instead of long
         else:
             # symlink, device file, etc.
-            ct = 'application/octet-stream'
+            ct = u'application/octet-stream'
             size = 0
         meta[CONTENTTYPE] = ct
         meta[SIZE] = size
         return meta
 
-    def _make_directory_page(self, path):
+    def _get_directory_page(self, path, st):
+        """
+        return the (cached) directory page of the directory path with stat result st
+        """
+        cached = self._dir_pages.get(path)
+        if cached is not None and cached[0] == st.st_mtime:
+            return cached[1]
         try:
-            dirs = []
-            files = []
-            names = os.listdir(path)
-            for name in names:
-                filepath = os.path.join(path, name)
-                if os.path.isdir(filepath):
-                    dirs.append(name)
-                else:
-                    files.append(name)
-            content = [
-                u"= Directory contents =",
-                u" * [[../]]",
-            ]
-            content.extend(u" * [[/%s|%s/]]" % (name, name) for name in sorted(dirs))
-            content.extend(u" * [[/%s|%s]]" % (name, name) for name in sorted(files))
-            content.append(u"")
-            content = u'\r\n'.join(content)
+            page = self._make_directory_page(path).encode('utf-8')
         except OSError as err:
-            content = unicode(err)
-        return content
+            return unicode(err).encode('utf-8') # not cached
+        self._dir_pages[path] = st.st_mtime, page
+        return page
 
-    def _get_data(self, fn):
+    def _make_directory_page(self, path):
+        dirs = []
+        files = []
+        for entry in scandir(path):
+            if entry.is_dir():
+                dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+        content = [
+            u"= Directory contents =",
+            u" * [[../]]",
+        ]
+        content.extend(u" * [[/%s|%s/]]" % (name, name) for name in sorted(dirs))
+        content.extend(u" * [[/%s|%s]]" % (name, name) for name in sorted(files))
+        content.append(u"")
+        return u'\r\n'.join(content)
+
+    def _get_data(self, fn, st):
         path = self._mkpath(fn)
         try:
-            st = os.stat(path)
             if stat.S_ISDIR(st.st_mode):
-                data = self._make_directory_page(path)
-                return StringIO(data.encode('utf-8'))
+                return StringIO(self._get_directory_page(path, st))
             elif stat.S_ISREG(st.st_mode):
                 return open(path, 'rb')
             else:
@@ -138,8 +358,14 @@ class Backend(BackendBase):
                 raise KeyError(fn)
             raise
 
-    def retrieve(self, fn):
-        meta = self._get_meta(fn)
-        data = self._get_data(fn)
+    def retrieve(self, revid):
+        fn, st = self._split_revid(revid)
+        meta = self._get_meta(fn, st)
+        # the file is only opened when it is used
+        data = LazyData(lambda: self._get_data(fn, st))
         return meta, data
 
+    def retrieve_meta(self, revid):
+        fn, st = self._split_revid(revid)
+        return self._get_meta(fn, st)
+
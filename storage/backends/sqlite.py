@@ -0,0 +1,351 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - sqlite3 backend, meta and data in one database file
+
+Unlike the stores backend with 2 sqlite stores, storing a revision is a
+single transaction (data and meta are stored together or not at all) with a
+single commit. Use MutableBackend.batch() to store/remove many revisions with
+one commit.
+
+Tables:
+
+- meta: revid (primary key), itemid, name, mtime, contenttype, dataid
+  (indexed columns, copied from the metadata), meta (serialized metadata,
+  see _codec module)
+- data: dataid (primary key), data (blob)
+
+Revisions given with the dataid of already stored data share that data, it
+is removed together with the last revision using it.
+
+A sqlite3 connection may only be used by the thread that created it, so every
+thread gets its own connection (thus an in-memory db, ':memory:', is not
+supported: every thread would see a different, empty db).
+"""
+
+
+from __future__ import absolute_import, division
+
+import threading
+
+from StringIO import StringIO
+from sqlite3 import connect, Row
+
+from config import REVID, ITEMID, NAME, MTIME, CONTENTTYPE, DATAID, SIZE, HASH_ALGORITHM
+
+from storage._util import batches, make_uuid, make_time_uuid
+
+from . import BackendBase, MutableBackendBase, _open_data
+from ._util import TrackingFileWrapper, LazyData
+from . import _codec
+
+# max. number of keys we put into one sql statement
+# (sqlite has a limit of 999 host parameters per statement)
+BATCH_SIZE = 500
+
+# meta keys copied into (indexed) columns of the meta table
+INDEXED_KEYS = [ITEMID, NAME, MTIME, CONTENTTYPE, DATAID]
+
+SCHEMA = [
+    'create table meta (revid text primary key, itemid text, name text, mtime integer, contenttype text, '
+    'dataid text, meta blob)',
+    'create index meta_itemid on meta (itemid)',
+    'create index meta_name on meta (name)',
+    'create index meta_mtime on meta (mtime)',
+    'create index meta_contenttype on meta (contenttype)',
+    'create index meta_dataid on meta (dataid)',
+    'create table data (dataid text primary key, data blob)',
+]
+
+
+class Backend(BackendBase):
+    """
+    sqlite3 backend, readonly
+    """
+    @classmethod
+    def from_uri(cls, uri):
+        return cls(uri)
+
+    def __init__(self, db_name, meta_codec=_codec.json_codec):
+        """
+        :param db_name: database (file)name (not ':memory:', see module docstring)
+        :param meta_codec: codec used to serialize metadata
+        """
+        if db_name == ':memory:':
+            raise ValueError("in-memory sqlite dbs are not supported (every thread would get its own db)")
+        self.db_name = db_name
+        self.meta_codec = meta_codec
+        self._local = threading.local()
+        self._conns = []
+        self._lock = threading.Lock()
+
+    def open(self):
+        self._local = threading.local()
+        self.conn # connect now, so we notice problems early
+
+    def close(self):
+        with self._lock:
+            conns, self._conns = self._conns, []
+        self._local = threading.local()
+        for conn in conns:
+            conn.close()
+
+    @property
+    def conn(self):
+        """
+        the db connection of the current thread
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # only used by this thread, but close() may close it from another one
+            conn = self._local.conn = connect(self.db_name, check_same_thread=False)
+            conn.row_factory = Row # make column access by ['colname'] possible
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def __iter__(self):
+        for row in self.conn.execute('select revid from meta'):
+            yield row['revid']
+
+    def _deserialize(self, meta_str):
+        return _codec.decode(str(meta_str))
+
+    def _get_data(self, dataid):
+        rows = list(self.conn.execute('select data from data where dataid=?', (dataid, )))
+        if not rows:
+            raise KeyError(dataid)
+        return StringIO(str(rows[0]['data']))
+
+    def _lazy_data(self, meta):
+        # the data is only fetched from the db when it is used
+        dataid = meta[DATAID]
+        return LazyData(lambda: self._get_data(dataid), meta.get(SIZE), meta.get(HASH_ALGORITHM))
+
+    def retrieve_meta(self, metaid):
+        rows = list(self.conn.execute('select meta from meta where revid=?', (metaid, )))
+        if not rows:
+            raise KeyError(metaid)
+        return self._deserialize(rows[0]['meta'])
+
+    def retrieve(self, metaid):
+        meta = self.retrieve_meta(metaid)
+        return meta, self._lazy_data(meta)
+
+    def retrieve_range(self, metaid, offset, length=None):
+        # let sqlite cut out the part we want
+        query = ('select substr(data.data, 1 + ?, coalesce(?, length(data.data))) as part '
+                 'from meta join data on data.dataid = meta.dataid where meta.revid=?')
+        rows = list(self.conn.execute(query, (offset, length, metaid)))
+        if not rows:
+            raise KeyError(metaid)
+        return str(rows[0]['part'])
+
+    def iter_meta(self):
+        # one table scan
+        for row in self.conn.execute('select revid, meta from meta'):
+            yield row['revid'], self._deserialize(row['meta'])
+
+    def iter_revisions(self):
+        for metaid, meta in self.iter_meta():
+            yield metaid, meta, self._lazy_data(meta)
+
+    def _retrieve_batch(self, metaids):
+        query = 'select revid, meta from meta where revid in (%s)' % ','.join('?' * len(metaids))
+        metas = dict((row['revid'], row['meta']) for row in self.conn.execute(query, metaids))
+        items = []
+        for metaid in metaids:
+            try:
+                meta = self._deserialize(metas[metaid])
+            except KeyError:
+                raise KeyError(metaid)
+            items.append((metaid, meta, self._lazy_data(meta)))
+        return items
+
+    def retrieve_many(self, metaids, prefetch=None, prefetch_data=False, batch_size=BATCH_SIZE):
+        """
+        see BackendBase.retrieve_many, fetches batch_size metas per query
+        """
+        item_batches = self._prefetch(self._retrieve_batch, batches(metaids, batch_size), prefetch)
+        items = (item for item_batch in item_batches for item in item_batch)
+        if prefetch_data:
+            items = self._prefetch(_open_data, items, prefetch)
+        return items
+
+    def iter_metaids(self, itemid=None, name=None):
+        """
+        iterate over the metaids of revisions with this itemid and/or name
+        (using the indexes), oldest first
+        """
+        conditions, args = [], []
+        if itemid is not None:
+            conditions.append('itemid=?')
+            args.append(itemid)
+        if name is not None:
+            conditions.append('name=?')
+            args.append(name)
+        query = 'select revid from meta'
+        if conditions:
+            query += ' where ' + ' and '.join(conditions)
+        query += ' order by mtime'
+        for row in self.conn.execute(query, args):
+            yield row['revid']
+
+    def latest_revisions(self):
+        """
+        yield (itemid, metaid) of the latest (by mtime) revision of every item
+        """
+        query = ('select a.itemid, a.revid from meta a where a.mtime = '
+                 '(select max(b.mtime) from meta b where b.itemid = a.itemid) order by a.itemid, a.revid')
+        last = None
+        for row in self.conn.execute(query):
+            if row[0] != last: # same mtime for multiple revisions: first revid wins
+                last = row[0]
+                yield row[0], row[1]
+
+    def item_revisions(self, itemid):
+        """
+        yield the metaids of all revisions of this item, oldest first
+        """
+        return self.iter_metaids(itemid=itemid)
+
+    def metaids_by_dataid(self, dataid):
+        """
+        yield the metaids of all revisions using this dataid
+        """
+        for row in self.conn.execute('select revid from meta where dataid=?', (dataid, )):
+            yield row['revid']
+
+
+class MutableBackend(Backend, MutableBackendBase):
+    """
+    sqlite3 backend, read/write
+    """
+    def __init__(self, db_name, meta_codec=_codec.json_codec, time_ordered_ids=False):
+        """
+        :param db_name: database (file)name
+        :param meta_codec: codec used to serialize metadata
+        :param time_ordered_ids: make new revids / dataids time ordered (see
+                                 make_time_uuid, new rows get appended to the
+                                 primary key b-trees)
+        """
+        super(MutableBackend, self).__init__(db_name, meta_codec)
+        self._make_id = make_time_uuid if time_ordered_ids else make_uuid
+
+    def create(self):
+        conn = connect(self.db_name)
+        with conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+        conn.close()
+
+    def destroy(self):
+        conn = connect(self.db_name)
+        with conn:
+            conn.execute('drop table meta')
+            conn.execute('drop table data')
+        conn.close()
+
+    def _transaction(self):
+        """
+        context manager for a transaction (inside batch(), the batch is the transaction)
+        """
+        if getattr(self._local, 'batch', False):
+            return _NoCommit()
+        return self.conn
+
+    def batch(self):
+        """
+        context manager, stores / removes in the with-block of the calling
+        thread are done in one transaction (rolled back if an exception happens):
+
+            with backend.batch():
+                for meta, data in revisions:
+                    backend.store(meta, data)
+        """
+        return _Batch(self)
+
+    def _serialize(self, meta):
+        return self.meta_codec.encode(meta)
+
+    def store(self, meta, data):
+        conn = self.conn
+        with self._transaction():
+            if DATAID not in meta:
+                tfw = TrackingFileWrapper(data, hash_method=HASH_ALGORITHM)
+                dataid = self._make_id()
+                try:
+                    conn.execute('insert into data values (?, ?)', (dataid, buffer(tfw.read())))
+                finally:
+                    tfw.release()
+                meta[DATAID] = dataid
+                # check whether size and hash are consistent:
+                size_expected = meta.get(SIZE)
+                size_real = tfw.size
+                if size_expected is not None and size_expected != size_real:
+                    raise ValueError("computed data size (%d) does not match data size declared in metadata (%d)" % (
+                                     size_real, size_expected))
+                meta[SIZE] = size_real
+                hash_expected = meta.get(HASH_ALGORITHM)
+                hash_real = tfw.hash.hexdigest()
+                if hash_expected is not None and hash_expected != hash_real:
+                    raise ValueError("computed data hash (%s) does not match data hash declared in metadata (%s)" % (
+                                     hash_real, hash_expected))
+                meta[HASH_ALGORITHM] = hash_real
+            else:
+                dataid = meta[DATAID]
+                # we will just asume stuff is correct if you pass it with a data id
+                rows = list(conn.execute('select 1 from data where dataid=?', (dataid, )))
+                if not rows:
+                    conn.execute('insert into data values (?, ?)', (dataid, buffer(data.read())))
+            if REVID not in meta:
+                # Item.clear_revision calls us with REVID already present
+                meta[REVID] = self._make_id()
+            metaid = meta[REVID]
+            values = [metaid] + [meta.get(key) for key in INDEXED_KEYS] + [buffer(self._serialize(meta))]
+            conn.execute('insert into meta values (?, ?, ?, ?, ?, ?, ?)', values)
+        return metaid
+
+    def remove(self, metaid):
+        conn = self.conn
+        with self._transaction():
+            rows = list(conn.execute('select dataid from meta where revid=?', (metaid, )))
+            if not rows:
+                raise KeyError(metaid)
+            dataid = rows[0]['dataid']
+            conn.execute('delete from meta where revid=?', (metaid, ))
+            # the data may be shared with other revisions
+            conn.execute('delete from data where dataid=? and not exists (select 1 from meta where dataid=?)',
+                         (dataid, dataid))
+
+
+class _NoCommit(object):
+    """
+    transaction context manager doing nothing (we are inside a batch)
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        pass
+
+
+class _Batch(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __enter__(self):
+        local = self.backend._local
+        if getattr(local, 'batch', False):
+            raise RuntimeError("nested batches are not supported")
+        local.batch = True
+        return self.backend
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.backend._local.batch = False
+        conn = self.backend.conn
+        if exc_type is None:
+            conn.commit()
+        else:
+            conn.rollback()
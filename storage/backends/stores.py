@@ -8,34 +8,100 @@ MoinMoin - backend that ties together 2 key/value stores
 A meta store (a ByteStore):
 
 - key = revid UUID (bytes, ascii)
-- value = bytes (bytes, utf-8)
+- value = bytes (serialized metadata, see _codec module for the formats)
 
 A data store (a FileStore):
 
 - key = dataid UUID (bytes, ascii)
 - value = file (gets/returns open file instances, to read/write binary data)
 
+Optionally (MutableBackend only), a refs store (a ByteStore) for content
+addressed data deduplication:
+
+- key = HASH_ALGORITHM hexdigest of the data (bytes, ascii), with a
+  ".<layout>" suffix for data not stored plain (e.g. chunked), so only data
+  of the same layout is shared
+- value = "<dataid> <refcount>" (bytes, ascii)
+
+While a ref is updated, the new value is also kept under the key with a
+REF_PENDING_SUFFIX, so a crash never loses a refcount. Data not tracked by
+the refs (e.g. stored before deduplication was enabled) is only removed by
+the garbage collection.
+
+Optionally, a chunk store (a ByteStore) for chunked data (see _chunking
+module), the data store then has the chunk manifest as data:
+
+- key = HASH_ALGORITHM hexdigest of the chunk (bytes, ascii)
+- value = chunk (bytes)
+
+Optionally (MutableBackend only), a heads store (a ByteStore) to delta
+encode text revisions (see _delta module):
+
+- key = itemid (bytes, ascii)
+- value = "<dataid> <depth>" of the latest delta encoded data of that item
+- key = that dataid + _delta.HEAD_TEXT_SUFFIX (only if it is a delta)
+- value = the full text of that data (so reading the latest revision does
+  not need to apply deltas)
+
+Optionally (MutableBackend only), small data is stored inline in the meta
+record (layout LAYOUT_INLINE), it then has no data store entry at all.
+
+If the meta store is a sql store with the PROJECTED_COLUMNS (using the
+project_meta projector), revisions can be looked up by itemid / dataid
+and the latest revisions can be found without an index, see e.g.
+Backend.latest_revisions:
+
+    meta_store = sqlite.BytesStore(db_name, 'meta', columns=PROJECTED_COLUMNS, projector=project_meta)
+
 See the stores package for already implemented key/value stores.
 """
 
 
 from __future__ import absolute_import, division
 
-from uuid import uuid4
-make_uuid = lambda: unicode(uuid4().hex)
+import threading
+from StringIO import StringIO
 
-from config import REVID, DATAID, SIZE, HASH_ALGORITHM
+from config import REVID, ITEMID, NAME, MTIME, CONTENTTYPE, DATAID, DATALAYOUT, DATAINLINE, SIZE, \
+                   HASH_ALGORITHM
 
-from . import BackendBase, MutableBackendBase
-from ._util import TrackingFileWrapper
+from storage._util import batches, make_uuid, make_time_uuid, slice_range
 
-try:
-    import json
-except ImportError:
-    import simplejson as json
+from . import BackendBase, MutableBackendBase, _open_data
+from ._util import TrackingFileWrapper, PrefixedFile, LazyData, read_prefix
+from . import _codec
+from . import _gc
+from . import _chunking
+from . import _delta
 
 STORES_PACKAGE = 'storage.stores'
 
+# how many metaids retrieve_many fetches from the meta store in one go
+BATCH_SIZE = 100
+
+# refs store key suffix for a ref being updated, see MutableBackend._set_ref
+REF_PENDING_SUFFIX = '.pending'
+
+# meta[DATALAYOUT] value for data stored inline in the meta record
+LAYOUT_INLINE = u'inline'
+
+# meta keys a sql meta store can project into indexed columns
+PROJECTED_COLUMNS = [
+    (NAME, 'text'),
+    (ITEMID, 'text'),
+    (MTIME, 'integer'),
+    (CONTENTTYPE, 'text'),
+    (DATAID, 'text'),
+]
+
+
+def project_meta(meta_str):
+    """
+    projector for sql meta stores, return the PROJECTED_COLUMNS values of a meta record
+    """
+    meta = _codec.decode(meta_str)
+    return dict((key, meta.get(key)) for key, type_ in PROJECTED_COLUMNS)
+
 
 class Backend(BackendBase):
     """
@@ -52,30 +118,40 @@ class Backend(BackendBase):
         data_store_uri = store_uri % dict(kind='data')
         return cls(module.BytesStore(meta_store_uri), module.FileStore(data_store_uri))
 
-    def __init__(self, meta_store, data_store):
+    def __init__(self, meta_store, data_store, meta_codec=_codec.json_codec, chunk_store=None):
         """
         :param meta_store: a ByteStore for metadata
         :param data_store: a FileStore for data
+        :param meta_codec: codec used to serialize metadata (reading works
+                           for all formats, no matter which codec we use),
+                           see _codec module about using the binary codec
+        :param chunk_store: a ByteStore for data chunks (needed to read chunked data)
         """
         self.meta_store = meta_store
         self.data_store = data_store
+        self.meta_codec = meta_codec
+        self.chunk_store = chunk_store
+
+    def _stores(self):
+        stores = [self.meta_store, self.data_store]
+        if self.chunk_store is not None:
+            stores.append(self.chunk_store)
+        return stores
 
     def open(self):
-        self.meta_store.open()
-        self.data_store.open()
+        for store in self._stores():
+            store.open()
 
     def close(self):
-        self.meta_store.close()
-        self.data_store.close()
+        for store in self._stores():
+            store.close()
 
     def __iter__(self):
         for metaid in self.meta_store:
             yield metaid
 
     def _deserialize(self, meta_str):
-        text = meta_str.decode('utf-8')
-        meta = json.loads(text)
-        return meta
+        return _codec.decode(meta_str)
 
     def _get_meta(self, metaid):
         meta = self.meta_store[metaid]
@@ -92,35 +168,237 @@ class Backend(BackendBase):
         # a file-like object).
         return data
 
+    def _read_data(self, dataid):
+        f = self._get_data(dataid)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def _get_chunked_data(self, dataid):
+        manifest = self._read_data(dataid)
+        return _chunking.ChunkedFile(manifest, self.chunk_store)
+
+    def _get_delta_text(self, dataid):
+        """
+        reconstruct delta encoded data
+
+        :returns: text
+        """
+        chain, ops = _delta.decode_record(self._read_data(dataid))
+        return self._apply_deltas(chain, ops)
+
+    def _apply_deltas(self, chain, ops):
+        """
+        reconstruct the text of a delta record from its chain and ops
+        """
+        values = self.data_store.get_many(chain)
+        records = {}
+        for key, f in values.items():
+            try:
+                records[key] = f.read()
+            finally:
+                f.close()
+        missing = set(chain) - set(records)
+        if missing:
+            raise IOError("missing delta base(s) %s" % ', '.join(sorted(missing)))
+        lines = records[chain[0]].splitlines(True) # the keyframe
+        for base_dataid in chain[1:]:
+            lines = _delta.apply_delta(lines, _delta.decode_record(records[base_dataid])[1])
+        lines = _delta.apply_delta(lines, ops)
+        return ''.join(lines)
+
+    def _lazy_data(self, meta):
+        # the data is only fetched from the data store when it is used
+        inline = meta.pop(DATAINLINE, None)
+        if inline is not None:
+            # came with the meta record, no need to touch the data store
+            return LazyData(lambda: StringIO(inline), meta.get(SIZE), meta.get(HASH_ALGORITHM))
+        dataid = meta[DATAID]
+        layout = meta.get(DATALAYOUT)
+        if layout == _chunking.LAYOUT_CHUNKED:
+            opener = lambda: self._get_chunked_data(dataid)
+        elif layout == _delta.LAYOUT_DELTA:
+            opener = lambda: StringIO(self._get_delta_text(dataid))
+        else:
+            opener = lambda: self._get_data(dataid)
+        return LazyData(opener, meta.get(SIZE), meta.get(HASH_ALGORITHM))
+
     def retrieve(self, metaid):
         meta = self._get_meta(metaid)
-        dataid = meta[DATAID]
-        data = self._get_data(dataid)
+        data = self._lazy_data(meta)
         return meta, data
 
+    def retrieve_meta(self, metaid):
+        meta = self._get_meta(metaid)
+        meta.pop(DATAINLINE, None)
+        return meta
+
+    def retrieve_range(self, metaid, offset, length=None):
+        meta = self._get_meta(metaid)
+        inline = meta.get(DATAINLINE)
+        if inline is not None:
+            return slice_range(inline, offset, length)
+        dataid = meta[DATAID]
+        layout = meta.get(DATALAYOUT)
+        if layout == _chunking.LAYOUT_CHUNKED:
+            return _chunking.read_range(self._read_data(dataid), self.chunk_store, offset, length)
+        if layout == _delta.LAYOUT_DELTA:
+            # we need to reconstruct the whole text anyway
+            return slice_range(self._get_delta_text(dataid), offset, length)
+        return self.data_store.get_range(dataid, offset, length)
+
+    def iter_meta(self):
+        # one pass over the meta store, no separate lookup per metaid
+        for metaid, meta in self.meta_store.iteritems():
+            meta = self._deserialize(meta)
+            meta.pop(DATAINLINE, None)
+            yield metaid, meta
+
+    def iter_revisions(self):
+        for metaid, meta in self.meta_store.iteritems():
+            meta = self._deserialize(meta)
+            yield metaid, meta, self._lazy_data(meta)
+
+    def _queryable_meta_store(self, *columns):
+        store = self.meta_store
+        column_names = getattr(store, 'column_names', [])
+        missing = [column for column in columns if column not in column_names]
+        if missing:
+            raise NotImplementedError("meta store has no %s column(s), see PROJECTED_COLUMNS" % ', '.join(missing))
+        return store
+
+    def latest_revisions(self):
+        """
+        yield (itemid, metaid) of the latest (by MTIME) revision of every item,
+        using the projected meta store columns (no index needed)
+        """
+        return self._queryable_meta_store(ITEMID, MTIME).query_latest(ITEMID, MTIME)
+
+    def item_revisions(self, itemid):
+        """
+        yield the metaids of all revisions of this item, oldest first
+        """
+        return self._queryable_meta_store(ITEMID, MTIME).query(order_by=MTIME, itemid=itemid)
+
+    def metaids_by_dataid(self, dataid):
+        """
+        yield the metaids of all revisions using this dataid
+        """
+        return self._queryable_meta_store(DATAID).query(dataid=dataid)
+
+    def _retrieve_batch(self, metaids):
+        # fetch the metadata of a batch of revisions with one store operation:
+        metas = self.meta_store.get_many(metaids)
+        items = []
+        for metaid in metaids:
+            try:
+                meta = metas[metaid]
+            except KeyError:
+                raise KeyError(metaid)
+            meta = self._deserialize(meta)
+            items.append((metaid, meta, self._lazy_data(meta)))
+        return items
+
+    def retrieve_many(self, metaids, prefetch=None, prefetch_data=False, batch_size=BATCH_SIZE):
+        """
+        see BackendBase.retrieve_many, with prefetch given, up to prefetch
+        meta batches of batch_size revisions are fetched concurrently.
+        """
+        item_batches = self._prefetch(self._retrieve_batch, batches(metaids, batch_size), prefetch)
+        items = (item for item_batch in item_batches for item in item_batch)
+        if prefetch_data:
+            items = self._prefetch(_open_data, items, prefetch)
+        return items
+
 
 class MutableBackend(Backend, MutableBackendBase):
     """
     same as Backend, but read/write
+
+    If a refs store is given, identical data is only stored once: revisions
+    with the same data (same HASH_ALGORITHM digest) share one dataid, which
+    is only removed from the data store after the last revision using it
+    was removed. Concurrent stores / removes are serialized by a lock, so
+    this is thread safe, but not multi-process safe.
+
+    If a chunk store is given, new data is stored chunked: identical chunks
+    of different data (e.g. of revisions of the same item) are only stored
+    once. Chunks are not reference counted, remove() leaves them for the
+    garbage collector.
+
+    If a heads store is given, text revisions of an item are stored delta
+    encoded (see _delta module): as a line delta against the previous
+    revision, with a full keyframe every keyframe_interval revisions. The
+    full text of the latest revision is kept in the heads store, so reading
+    it is not slowed down. As other revisions' deltas may be based on it,
+    such data is also left for the garbage collector by remove(). Delta
+    encoded data is not deduplicated.
+
+    If inline_size is given, new data of up to inline_size bytes is stored
+    inline in the meta record, saving a data store operation when storing and
+    reading it. Inline data is not deduplicated or delta encoded.
     """
+    def __init__(self, meta_store, data_store, meta_codec=_codec.json_codec, refs_store=None,
+                 chunk_store=None, heads_store=None, keyframe_interval=_delta.KEYFRAME_INTERVAL,
+                 inline_size=0, time_ordered_ids=False):
+        """
+        :param meta_store: a ByteStore for metadata
+        :param data_store: a FileStore for data
+        :param meta_codec: codec used to serialize metadata
+        :param refs_store: a ByteStore for data hash -> dataid, refcount
+                           (None: no deduplication). Refs are locked by a
+                           threading lock, so only one process (one backend
+                           object) may store into / remove from these stores.
+        :param chunk_store: a ByteStore for data chunks (None: do not chunk data)
+        :param heads_store: a ByteStore for itemid -> latest delta encoded dataid
+                            (None: no delta encoding)
+        :param keyframe_interval: store every n-th revision of an item in full
+        :param inline_size: store data up to this size inline in the meta record
+                            (0: never)
+        :param time_ordered_ids: make new revids / dataids time ordered (see
+                                 make_time_uuid, good for b-tree based stores)
+        """
+        super(MutableBackend, self).__init__(meta_store, data_store, meta_codec, chunk_store)
+        self.refs_store = refs_store
+        self.heads_store = heads_store
+        self.keyframe_interval = keyframe_interval
+        self.inline_size = inline_size
+        self._make_id = make_time_uuid if time_ordered_ids else make_uuid
+        self._refs_lock = threading.Lock()
+        self._chunks_lock = threading.Lock()
+        self._heads_lock = threading.Lock()
+        # keys written or reused while a gc runs (None: no gc running), see _gc
+        self._gc_lock = threading.Lock()
+        self._touched = None
+
+    def _stores(self):
+        stores = super(MutableBackend, self)._stores()
+        for store in [self.refs_store, self.heads_store]:
+            if store is not None:
+                stores.append(store)
+        return stores
+
     def create(self):
-        self.meta_store.create()
-        self.data_store.create()
+        for store in self._stores():
+            store.create()
 
     def destroy(self):
-        self.meta_store.destroy()
-        self.data_store.destroy()
+        for store in self._stores():
+            store.destroy()
 
     def _serialize(self, meta):
-        text = json.dumps(meta, ensure_ascii=False)
-        meta_str = text.encode('utf-8')
-        return meta_str
+        return self.meta_codec.encode(meta)
 
-    def _store_meta(self, meta):
+    def _store_meta(self, meta, inline=None):
         if REVID not in meta:
             # Item.clear_revision calls us with REVID already present
-            meta[REVID] = make_uuid()
+            meta[REVID] = self._make_id()
         metaid = meta[REVID]
+        if inline is not None:
+            # do not put the data into the caller's meta dict
+            meta = dict(meta)
+            meta[DATAINLINE] = inline
         meta = self._serialize(meta)
         # XXX Idea: we could check the type the store wants from us:
         # if it is a str/bytes (BytesStore), just use meta "as is",
@@ -128,14 +406,221 @@ class MutableBackend(Backend, MutableBackendBase):
         self.meta_store[metaid] = meta
         return metaid
 
+    def _ref_key(self, hexdigest, layout):
+        """
+        return the refs store key for data with this hash, stored in layout
+        """
+        if layout is None:
+            return hexdigest
+        return '%s.%s' % (hexdigest, layout)
+
+    def _track_touched(self, enable):
+        """
+        start / stop tracking the keys touched by stores (called by the gc)
+        """
+        with self._gc_lock:
+            self._touched = set() if enable else None
+
+    def _touch(self, *keys):
+        """
+        tell a running gc that we use keys, call this before checking whether
+        they exist (the gc won't remove them after this)
+        """
+        with self._gc_lock:
+            if self._touched is not None:
+                self._touched.update(keys)
+
+    def _is_touched(self, key):
+        # caller must hold _gc_lock
+        return self._touched is not None and key in self._touched
+
+    def _get_ref(self, hexdigest):
+        """
+        return dataid, refcount for data with this hash (None, 0 if unknown)
+        """
+        # a pending ref is newer than the ref (we crashed while updating it)
+        ref = self.refs_store.get(hexdigest + REF_PENDING_SUFFIX)
+        if ref is None:
+            ref = self.refs_store.get(hexdigest)
+        if ref is None:
+            return None, 0
+        dataid, refcount = ref.split()
+        if not int(refcount):
+            return None, 0
+        return unicode(dataid), int(refcount)
+
+    def _set_ref(self, hexdigest, dataid, refcount):
+        """
+        update the ref for data with this hash, never losing it: some stores
+        can't overwrite existing keys, so the new ref is written to a pending
+        key first (see _get_ref), then the ref is replaced.
+        """
+        pending = hexdigest + REF_PENDING_SUFFIX
+        if pending in self.refs_store:
+            # left over by a crashed update, _get_ref used it
+            self._replace_ref(hexdigest, self.refs_store[pending])
+        ref = '%s %d' % (dataid, max(refcount, 0))
+        self.refs_store[pending] = ref
+        self._replace_ref(hexdigest, ref)
+
+    def _replace_ref(self, hexdigest, ref):
+        # the pending key has ref, make it the ref and remove the pending key
+        if hexdigest in self.refs_store:
+            del self.refs_store[hexdigest]
+        if int(ref.split()[1]):
+            self.refs_store[hexdigest] = ref
+        del self.refs_store[hexdigest + REF_PENDING_SUFFIX]
+
+    def _add_ref(self, hexdigest, layout, dataid, new):
+        """
+        register a new reference to data with this hash, stored as dataid.
+
+        :param layout: meta[DATALAYOUT] of dataid (None for plain data)
+        :param new: whether dataid was just written by the calling store()
+                    (else the caller gave it, e.g. Item.clear_revision)
+        :returns: the dataid to use (if we already have new data stored under
+                  another dataid, that one is returned and dataid is removed)
+        """
+        hexdigest = self._ref_key(hexdigest, layout)
+        with self._refs_lock:
+            ref_dataid, refcount = self._get_ref(hexdigest)
+            if ref_dataid is not None and ref_dataid != dataid:
+                self._touch(ref_dataid)
+                if ref_dataid not in self.data_store:
+                    # removed by the gc meanwhile, the ref is stale
+                    self._set_ref(hexdigest, None, 0)
+                    ref_dataid, refcount = None, 0
+            if ref_dataid == dataid or ref_dataid is None and new:
+                self._set_ref(hexdigest, dataid, refcount + 1)
+                return dataid
+            if new:
+                # we already have this data, throw away the new copy
+                self._del_data(dataid)
+                self._set_ref(hexdigest, ref_dataid, refcount + 1)
+                return ref_dataid
+            # given data not tracked by the refs (e.g. stored before
+            # deduplication was enabled), other revisions may use it, so it
+            # is not registered (remove won't remove it, the gc will)
+            return dataid
+
+    def _get_delta_text(self, dataid):
+        if self.heads_store is not None:
+            # the latest revision of an item, we have its full text
+            text = self.heads_store.get(dataid + _delta.HEAD_TEXT_SUFFIX)
+            if text is not None:
+                return text
+        return super(MutableBackend, self)._get_delta_text(dataid)
+
+    def _set_head(self, itemid, dataid, depth, text=None):
+        """
+        set the head of an item (None: no head), with the full text of a
+        delta head. Caller must hold _heads_lock.
+        """
+        try:
+            old_dataid = _delta.decode_head(self.heads_store[itemid])[0]
+        except KeyError:
+            old_dataid = None
+        if text is not None and depth:
+            # before the head, so a head always has its full text
+            self.heads_store[dataid + _delta.HEAD_TEXT_SUFFIX] = text
+        # some stores can't overwrite existing keys, so always delete first
+        if old_dataid is not None:
+            del self.heads_store[itemid]
+        if dataid is not None:
+            self.heads_store[itemid] = _delta.encode_head(dataid, depth)
+        if old_dataid is not None and old_dataid != dataid:
+            # if we crash before this, the gc removes it with the data
+            old_text_key = old_dataid + _delta.HEAD_TEXT_SUFFIX
+            if old_text_key in self.heads_store:
+                del self.heads_store[old_text_key]
+
+    def _store_delta(self, dataid, itemid, text):
+        """
+        store text as a delta against the previous revision of the item (or
+        as a keyframe if the chain would get too long)
+
+        :returns: layout
+        """
+        with self._heads_lock:
+            chain = None
+            try:
+                head_dataid, depth = _delta.decode_head(self.heads_store[itemid])
+            except KeyError:
+                depth = None
+            if depth is not None and depth + 1 < self.keyframe_interval:
+                try:
+                    self._touch(head_dataid)
+                    if depth:
+                        chain, ops = _delta.decode_record(self._read_data(head_dataid))
+                        self._touch(*chain)
+                        base = self.heads_store.get(head_dataid + _delta.HEAD_TEXT_SUFFIX)
+                        if base is None:
+                            base = self._apply_deltas(chain, ops)
+                        elif not all(base_dataid in self.data_store for base_dataid in chain):
+                            raise IOError("missing delta base(s)")
+                    else:
+                        chain, base = [], self._read_data(head_dataid)
+                except (KeyError, IOError):
+                    chain = None # base data is gone (garbage collected), start a new chain
+            if chain is None:
+                self.data_store[dataid] = StringIO(text)
+                layout, depth = _delta.LAYOUT_KEYFRAME, 0
+            else:
+                ops = _delta.make_delta(base.splitlines(True), text.splitlines(True))
+                self.data_store[dataid] = StringIO(_delta.encode_record(chain + [head_dataid], ops))
+                layout, depth = _delta.LAYOUT_DELTA, depth + 1
+            self._set_head(itemid, dataid, depth, text)
+            return layout
+
+    def _store_data(self, dataid, tfw, meta):
+        """
+        store new data (read from tfw) under dataid
+
+        :returns: layout (None: plain)
+        """
+        if self.heads_store is not None and _delta.deltifiable(meta):
+            # SIZE is usually not given, so do not read more than we can delta encode
+            text = read_prefix(tfw, _delta.MAX_SIZE + 1)
+            if len(text) <= _delta.MAX_SIZE:
+                return self._store_delta(dataid, meta[ITEMID], text)
+            # too big, store it plain and start a new chain with the next revision
+            with self._heads_lock:
+                self._set_head(meta[ITEMID], None, 0)
+            self.data_store[dataid] = PrefixedFile(text, tfw)
+            return None
+        if self.chunk_store is not None:
+            manifest = _chunking.store_chunks(tfw, self.chunk_store, self._chunks_lock, touch=self._touch)
+            self.data_store[dataid] = StringIO(manifest)
+            return _chunking.LAYOUT_CHUNKED
+        self.data_store[dataid] = tfw
+        return None
+
     def store(self, meta, data):
         # XXX Idea: we could check the type the store wants from us:
         # if it is a str/bytes (BytesStore), just use meta "as is",
         # if it is a file (FileStore), wrap it into StringIO and give that to the store.
         if DATAID not in meta:
-            tfw = TrackingFileWrapper(data, hash_method=HASH_ALGORITHM)
-            dataid = make_uuid()
-            self.data_store[dataid] = tfw
+            tfw = TrackingFileWrapper(data, hash_method=HASH_ALGORITHM, background=None)
+            dataid = self._make_id()
+            self._touch(dataid)
+            inline = None
+            try:
+                if self.inline_size:
+                    prefix = read_prefix(tfw, self.inline_size + 1)
+                    if len(prefix) <= self.inline_size:
+                        inline, layout = prefix, LAYOUT_INLINE
+                    else:
+                        layout = self._store_data(dataid, PrefixedFile(prefix, tfw), meta)
+                else:
+                    layout = self._store_data(dataid, tfw, meta)
+            finally:
+                # no hashing thread left behind if the data store failed before EOF
+                # (not close, the caller may still use data)
+                tfw.release()
+            if layout is not None:
+                meta[DATALAYOUT] = layout
+            else:
+                meta.pop(DATALAYOUT, None)
             meta[DATAID] = dataid
             # check whether size and hash are consistent:
             size_expected = meta.get(SIZE)
@@ -150,13 +635,23 @@ class MutableBackend(Backend, MutableBackendBase):
                 raise ValueError("computed data hash (%s) does not match data hash declared in metadata (%s)" % (
                                  hash_real, hash_expected))
             meta[HASH_ALGORITHM] = hash_real
+            if self.refs_store is not None and layout not in _delta.LAYOUTS and inline is None:
+                meta[DATAID] = self._add_ref(hash_real, layout, dataid, True)
         else:
+            inline = None
             dataid = meta[DATAID]
+            self._touch(dataid)
             # we will just asume stuff is correct if you pass it with a data id
-            if dataid not in self.data_store:
+            new = dataid not in self.data_store
+            if new:
                 self.data_store[dataid] = data
+                meta.pop(DATALAYOUT, None) # we just stored it plain
+            if (self.refs_store is not None and HASH_ALGORITHM in meta and
+                meta.get(DATALAYOUT) not in _delta.LAYOUTS):
+                # another revision using the same data (e.g. store_all_revisions)
+                meta[DATAID] = self._add_ref(meta[HASH_ALGORITHM], meta.get(DATALAYOUT), dataid, new)
         # if something goes wrong below, the data shall be purged by a garbage collection
-        metaid = self._store_meta(meta)
+        metaid = self._store_meta(meta, inline)
         return metaid
 
     def _del_meta(self, metaid):
@@ -165,9 +660,45 @@ class MutableBackend(Backend, MutableBackendBase):
     def _del_data(self, dataid):
         del self.data_store[dataid]
 
+    def _del_ref(self, hexdigest, layout, dataid):
+        """
+        unregister a reference to data with this hash, stored as dataid.
+        Shared data is removed when the last reference to it goes away.
+
+        :param layout: meta[DATALAYOUT] of dataid (None for plain data)
+        """
+        hexdigest = self._ref_key(hexdigest, layout)
+        with self._refs_lock:
+            ref_dataid, refcount = self._get_ref(hexdigest)
+            if ref_dataid != dataid:
+                # data not tracked by the refs (e.g. stored before deduplication
+                # was enabled), other revisions may use it, the gc removes it
+                return
+            self._set_ref(hexdigest, dataid, refcount - 1)
+            if refcount == 1:
+                # the data is removed while we hold the lock, so nobody can add
+                # a new reference to it meanwhile.
+                self._del_data(dataid)
+
     def remove(self, metaid):
-        meta = self._get_meta(metaid)
+        meta = self.retrieve_meta(metaid)
         dataid = meta[DATAID]
         self._del_meta(metaid)
-        self._del_data(dataid)
+        if meta.get(DATALAYOUT) == LAYOUT_INLINE:
+            return # nothing in the data store
+        if meta.get(DATALAYOUT) in _delta.LAYOUTS:
+            # other revisions' deltas may be based on this data, the gc removes it
+            return
+        if self.refs_store is None:
+            self._del_data(dataid)
+        elif HASH_ALGORITHM in meta:
+            self._del_ref(meta[HASH_ALGORITHM], meta.get(DATALAYOUT), dataid)
+        # else: not tracked by the refs, other revisions may use it, the gc removes it
+
+    def collect_garbage(self, dry_run=False, **kw):
+        """
+        remove unreferenced data, see _gc module
 
+        :returns: gc report dict
+        """
+        return _gc.collect_garbage(self, dry_run=dry_run, **kw)
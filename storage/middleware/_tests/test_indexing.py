@@ -8,6 +8,9 @@ MoinMoin - indexing middleware tests
 
 from __future__ import absolute_import, division
 
+import os
+import shutil
+import tempfile
 from StringIO import StringIO
 import hashlib
 
@@ -18,6 +21,7 @@ from config import NAME, SIZE, ITEMID, REVID, DATAID, HASH_ALGORITHM, CONTENT, C
 from ..indexing import IndexingMiddleware
 
 from storage.backends.stores import MutableBackend
+from storage.backends.fileserver import Backend as FileServerBackend
 from storage.stores.memory import BytesStore as MemoryBytesStore
 from storage.stores.memory import FileStore as MemoryFileStore
 
@@ -130,6 +134,15 @@ class TestIndexingMiddleware(object):
         item = self.imw[item_name]
         assert not item # does not exist
 
+    def test_optimize_backend(self):
+        item = self.imw[u'foo']
+        rev = item.store_revision(dict(name=u'foo'), StringIO('bar'))
+        self.be.data_store[u'orphan'] = StringIO('garbage')
+        report = self.imw.optimize_backend(dry_run=True)
+        assert report['garbage'] == [u'orphan']
+        assert self.imw.optimize_backend()['removed'] == 1
+        assert list(self.be.data_store) == [rev.meta[DATAID]]
+
     def test_all_revisions(self):
         item_name = u'foo'
         item = self.imw[item_name]
@@ -334,6 +347,49 @@ class TestIndexingMiddleware(object):
         assert expected_revid == doc[REVID]
         assert unicode(data) == doc[CONTENT]
 
+class TestChangeFeedIndexingMiddleware(object):
+    def setup_method(self, method):
+        self.path = tempfile.mkdtemp()
+        self.be = FileServerBackend(self.path)
+        self.be.open()
+        self.imw = IndexingMiddleware(index_dir='ix', backend=self.be)
+        self.imw.create()
+
+    def teardown_method(self, method):
+        self.imw.destroy()
+        self.be.close()
+        shutil.rmtree(self.path)
+
+    def _write(self, name, data, mtime):
+        fn = os.path.join(self.path, name)
+        with open(fn, 'wb') as f:
+            f.write(data)
+        os.utime(fn, (mtime, mtime))
+
+    def _revids(self):
+        self.imw.open()
+        try:
+            return (sorted(rev.revid for rev in self.imw.documents(all_revs=True)),
+                    sorted(rev.revid for rev in self.imw.documents(all_revs=False)))
+        finally:
+            self.imw.close()
+
+    def test_index_update(self):
+        self._write('foo.txt', 'foo', 1000)
+        self._write('bar.txt', 'bar', 1000)
+        # no token yet, compares everything:
+        assert self.imw.update()
+        expected = sorted([u'bar.txt/1000000000', u'foo.txt/1000000000'])
+        assert self._revids() == (expected, expected)
+        # nothing changed
+        assert not self.imw.update()
+        self._write('foo.txt', 'new foo', 2000)
+        os.remove(os.path.join(self.path, 'bar.txt'))
+        assert self.imw.update()
+        expected = [u'foo.txt/2000000000']
+        assert self._revids() == (expected, expected)
+
+
 class TestProtectedIndexingMiddleware(object):
     def setup_method(self, method):
         meta_store = MemoryBytesStore()
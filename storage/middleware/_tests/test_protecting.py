@@ -38,6 +38,7 @@ class TestProtectingMiddleware(TestIndexingMiddleware):
         pass
 
     test_index_rebuild = _dummy
+    test_optimize_backend = _dummy
     test_index_update = _dummy
     test_indexed_content = _dummy
 
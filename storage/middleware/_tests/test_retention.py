@@ -0,0 +1,78 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - retention tests
+"""
+
+
+from __future__ import absolute_import, division
+
+from StringIO import StringIO
+
+import pytest
+
+from config import NAME, MTIME
+
+from ..indexing import IndexingMiddleware
+from ..retention import Policy, select_expendable, apply_retention
+
+from storage.backends.stores import MutableBackend
+from storage.stores.memory import BytesStore as MemoryBytesStore
+from storage.stores.memory import FileStore as MemoryFileStore
+
+DAY = 24 * 3600
+NOW = 100 * DAY
+
+
+class TestRetention(object):
+    def setup_method(self, method):
+        self.be = MutableBackend(MemoryBytesStore(), MemoryFileStore())
+        self.be.create()
+        self.be.open()
+        self.imw = IndexingMiddleware(index_dir='ix', backend=self.be)
+        self.imw.create()
+        self.imw.open()
+        self.revids = {}
+        for name in [u'foo', u'users/joe']:
+            item = self.imw[name]
+            self.revids[name] = [item.store_revision({NAME: name, MTIME: NOW - (10 - i) * DAY}, StringIO(str(i))).revid
+                                 for i in range(10)]
+
+    def teardown_method(self, method):
+        self.imw.close()
+        self.imw.destroy()
+        self.be.close()
+        self.be.destroy()
+
+    def test_policy(self):
+        with pytest.raises(ValueError):
+            Policy(max_revisions=0)
+
+    def test_select(self):
+        policies = [(u'users', Policy(max_revisions=1)), (u'', Policy(max_age=5.5 * DAY))]
+        expendable = sorted(revid for revid, size in select_expendable(self.imw, policies, now=NOW))
+        assert expendable == sorted(self.revids[u'users/joe'][:-1] + self.revids[u'foo'][:5])
+        # latest revision is kept, even if it is too old:
+        policies = [(u'', Policy(max_revisions=3, max_age=0))]
+        expendable = sorted(revid for revid, size in select_expendable(self.imw, policies, now=NOW))
+        assert expendable == sorted(self.revids[u'users/joe'][:-1] + self.revids[u'foo'][:-1])
+        # no policy for an item keeps it completely
+        policies = [(u'users', Policy(max_revisions=8))]
+        expendable = sorted(revid for revid, size in select_expendable(self.imw, policies, now=NOW))
+        assert expendable == sorted(self.revids[u'users/joe'][:2])
+
+    def test_apply(self):
+        policies = [(u'', Policy(max_revisions=4))]
+        report = apply_retention(self.imw, policies, dry_run=True, now=NOW)
+        assert report['removed'] == 0
+        assert report['reclaimed_bytes'] == 12
+        report = apply_retention(self.imw, policies, now=NOW, batch_size=5)
+        assert report['removed'] == 12
+        assert report['reclaimed_bytes'] == 12
+        for name in [u'foo', u'users/joe']:
+            item = self.imw[name]
+            assert sorted(rev.revid for rev in item.iter_revs()) == sorted(self.revids[name][-4:])
+            assert item.itemid is not None
+        assert sorted(self.be) == sorted(self.revids[u'foo'][-4:] + self.revids[u'users/joe'][-4:])
+        assert apply_retention(self.imw, policies, now=NOW)['removed'] == 0
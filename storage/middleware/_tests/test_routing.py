@@ -8,6 +8,10 @@ MoinMoin - router middleware tests
 
 from __future__ import absolute_import, division
 
+import os
+import time
+import shutil
+import tempfile
 from StringIO import StringIO
 
 import pytest
@@ -17,6 +21,7 @@ from config import NAME, REVID
 from ..routing import Backend as RouterBackend
 
 from storage.backends.stores import MutableBackend as StoreBackend, Backend as ROBackend
+from storage.backends.fileserver import Backend as FileServerBackend
 from storage.stores.memory import BytesStore as MemoryBytesStore
 from storage.stores.memory import FileStore as MemoryFileStore
 
@@ -29,7 +34,6 @@ def make_ro_backend():
     return ROBackend(store.meta_store, store.data_store)
 
 
-
 def pytest_funcarg__router(request):
     root_be = StoreBackend(MemoryBytesStore(), MemoryFileStore())
     sub_be = StoreBackend(MemoryBytesStore(), MemoryFileStore())
@@ -63,6 +67,8 @@ def test_store_get_del(router):
     sub_meta, _ = router.retrieve(sub_revid)
     assert root_name == root_meta[NAME]
     assert sub_name == sub_meta[NAME]
+    assert router.retrieve_meta(root_revid) == root_meta
+    assert router.retrieve_meta(sub_revid) == sub_meta
 
     # when looking into the storage backend, we see relative names (without mountpoint):
     root_meta, _ = router.mapping[-1][1].retrieve(revid_split(root_revid)[1])
@@ -74,6 +80,24 @@ def test_store_get_del(router):
     router.remove(sub_revid)
 
 
+def test_retrieve_many(router):
+    names = [u'foo', u'sub/bar', u'baz', u'sub/qux']
+    revids = [router.store(dict(name=name), StringIO(name.encode('utf-8'))) for name in names]
+    revids.append(u'ro/' + iter(router.mapping[1][1]).next())
+    result = [(revid, meta[NAME], data.read()) for revid, meta, data in router.retrieve_many(revids, prefetch=2)]
+    assert [revid for revid, _, _ in result] == revids
+    assert [name for _, name, _ in result] == names + [router.retrieve_meta(revids[-1])[NAME]]
+    assert [data for _, _, data in result[:-1]] == names
+
+
+def test_iter_meta(router):
+    names = [u'foo', u'sub/bar']
+    revids = [router.store(dict(name=name), StringIO('')) for name in names]
+    result = dict((revid, meta[NAME]) for revid, meta in router.iter_meta())
+    assert result == dict((revid, router.retrieve_meta(revid)[NAME]) for revid in router)
+    assert [result[revid] for revid in revids] == names
+
+
 def test_store_readonly_fails(router):
     with pytest.raises(TypeError):
         router.store(dict(name=u'ro/testing'), StringIO(''))
@@ -102,3 +126,69 @@ def test_iter(router):
     sub_revid = router.store(dict(name=u'sub/bar'), StringIO(''))
     assert set(router) == (set([root_revid, sub_revid])|existing)
 
+
+def test_retrieve_range(router):
+    root_revid = router.store(dict(name=u'foo'), StringIO('root data'))
+    sub_revid = router.store(dict(name=u'sub/bar'), StringIO('sub data'))
+    assert router.retrieve_range(root_revid, 5, 4) == 'data'
+    assert router.retrieve_range(sub_revid, 4) == 'data'
+
+
+def test_changes(router):
+    # not all backends have a change feed
+    assert router.changes() == (None, None, None)
+
+
+def test_fileserver_changes():
+    path = tempfile.mkdtemp()
+    try:
+        router = RouterBackend([('fs', FileServerBackend(path))])
+        router.open()
+        token, added, removed = router.changes()
+        assert added is None and removed is None
+        fn = os.path.join(path, 'foo.txt')
+        with open(fn, 'wb') as f:
+            f.write('foo')
+        os.utime(fn, (1000, 1000))
+        token, added, removed = router.changes(token)
+        assert (added, removed) == ([u'fs/foo.txt/1000000000'], [])
+        # the backend revid contains slashes
+        assert router.retrieve_meta(added[0])[NAME] == u'fs/foo.txt'
+        router.close()
+    finally:
+        shutil.rmtree(path)
+
+
+def test_get_backend():
+    a, ab, root = object(), object(), object()
+    router = RouterBackend([('a/b', ab), ('a', a), ('', root)])
+    assert router._get_backend(u'a/b/c') == (ab, u'c', u'a/b')
+    assert router._get_backend(u'a/b') == (ab, u'', u'a/b')
+    assert router._get_backend(u'a/bc') == (a, u'bc', u'a')
+    assert router._get_backend(u'a') == (a, u'', u'a')
+    assert router._get_backend(u'ab') == (root, u'ab', u'')
+    assert router._get_backend(u'a/b/c') == (ab, u'c', u'a/b') # memoized
+    assert router._split_revid(u'a/b/rev') == (u'a/b', ab, u'rev')
+    assert router._split_revid(u'/rev') == (u'', root, u'rev')
+    with pytest.raises(KeyError):
+        router._split_revid(u'rev')
+    # order matters: the first matching mountpoint wins
+    router = RouterBackend([('a', a), ('a/b', ab), ('', root)])
+    assert router._get_backend(u'a/b/c') == (a, u'b/c', u'a')
+    with pytest.raises(AssertionError):
+        RouterBackend([('a', a)])._get_backend(u'b')
+
+
+def test_perf_get_backend():
+    pytest.skip("usually we do no performance tests")
+    # resolve item names with many mounts
+    router = RouterBackend([(u'mount%d/sub' % i, object()) for i in range(50)] + [(u'', object())])
+    names = [u'mount%d/sub/Some/Deep/Item%d' % (i % 60, i) for i in range(1000)]
+    for memoized in [False, True]:
+        start = time.time()
+        for i in xrange(20):
+            for name in names:
+                if not memoized:
+                    router._resolved.clear()
+                router._get_backend(name)
+        print "memoized: %s, %.1fus per name" % (memoized, (time.time() - start) / 20000 * 1e6)
@@ -58,9 +58,6 @@ import time
 import datetime
 from StringIO import StringIO
 
-from uuid import uuid4
-make_uuid = lambda: unicode(uuid4().hex)
-
 import logging
 
 from whoosh.fields import Schema, TEXT, ID, IDLIST, NUMERIC, DATETIME, KEYWORD, BOOLEAN
@@ -76,6 +73,14 @@ from config import WIKINAME, NAME, NAME_EXACT, MTIME, CONTENTTYPE, TAGS, \
                    CONTENT, ITEMLINKS, ITEMTRANSCLUSIONS, ACL, EMAIL, OPENID, \
                    ITEMID, REVID
 
+from storage._util import make_uuid, make_time_uuid
+
+# how many revisions are retrieved from the backend concurrently while indexing
+RETRIEVE_PREFETCH = 8
+
+# file in the index directory remembering the backend's change feed token, see update()
+CHANGES_TOKEN_FILE = 'changes.token'
+
 LATEST_REVS = 'latest_revs'
 ALL_REVS = 'all_revs'
 INDEXES = [LATEST_REVS, ALL_REVS, ]
@@ -120,15 +125,18 @@ def convert_to_indexable(meta, data):
 
 
 class IndexingMiddleware(object):
-    def __init__(self, index_dir, backend, user_name=None, acl_support=False, **kw):
+    def __init__(self, index_dir, backend, user_name=None, acl_support=False, time_ordered_ids=False, **kw):
         """
         Store params, create schemas.
+
+        :param time_ordered_ids: make new itemids time ordered (see make_time_uuid)
         """
         self.index_dir = index_dir
         self.index_dir_tmp = index_dir + '.temp'
         self.backend = backend
         self.user_name = user_name # TODO use currently logged-in username
         self.acl_support = acl_support
+        self._make_id = make_time_uuid if time_ordered_ids else make_uuid
         self.wikiname = u'' # TODO take from app.cfg.interwikiname
         self.ix = {}  # open indexes
         self.schemas = {}  # existing schemas
@@ -321,7 +329,7 @@ class IndexingMiddleware(object):
                     latest_revid = latest_revids[0]
                     # we must fetch from backend because schema for LATEST_REVS is different than for ALL_REVS
                     # (and we can't be sure we have all fields stored, too)
-                    meta, _ = self.backend.retrieve(latest_revid)
+                    meta = self.backend.retrieve_meta(latest_revid)
                     # we only use meta (not data), because we do not want to transform data->content again (this
                     # is potentially expensive) as we already have the transformed content stored in ALL_REVS index:
                     with self.ix[ALL_REVS].searcher() as searcher:
@@ -339,6 +347,9 @@ class IndexingMiddleware(object):
 
         Note: mode == 'add' is faster but you need to make sure to not create duplicate
               documents in the index.
+
+        :param revids: revids to add/update/delete, None means all revisions
+                       in the backend (fetched in one pass, add/update only)
         """
         if procs == 1:
             # MultiSegmentWriter sometimes has issues and is pointless for procs == 1,
@@ -347,19 +358,25 @@ class IndexingMiddleware(object):
         else:
             writer = MultiSegmentWriter(index, procs, limitmb)
         with writer as writer:
-            for revid in revids:
-                if mode in ['add', 'update', ]:
-                    meta, data = self.backend.retrieve(revid)
+            if mode in ['add', 'update', ]:
+                if revids is None:
+                    revs = self.backend.iter_revisions()
+                else:
+                    revs = self.backend.retrieve_many(revids, prefetch=RETRIEVE_PREFETCH, prefetch_data=True)
+                for revid, meta, data in revs:
+                    meta[REVID] = revid # not all backends keep it in the metadata
                     content = convert_to_indexable(meta, data)
+                    data.close()
                     doc = backend_to_index(meta, content, schema, wikiname)
-                if mode == 'update':
-                    writer.update_document(**doc)
-                elif mode == 'add':
-                    writer.add_document(**doc)
-                elif mode == 'delete':
+                    if mode == 'update':
+                        writer.update_document(**doc)
+                    else:
+                        writer.add_document(**doc)
+            elif mode == 'delete':
+                for revid in revids:
                     writer.delete_by_term(REVID, revid)
-                else:
-                    raise ValueError("mode must be 'update', 'add' or 'delete', not '%s'" % mode)
+            else:
+                raise ValueError("mode must be 'update', 'add' or 'delete', not '%s'" % mode)
 
     def _find_latest_revids(self, index, query=None):
         """
@@ -395,7 +412,7 @@ class IndexingMiddleware(object):
         index = open_dir(index_dir, indexname=ALL_REVS)
         try:
             # build an index of all we have (so we know what we have)
-            all_revids = self.backend # the backend is a iterator over all revids
+            all_revids = None # all revisions in the backend, in one pass
             self._modify_index(index, self.schemas[ALL_REVS], self.wikiname, all_revids, 'add', procs, limitmb)
             latest_revids = self._find_latest_revids(index)
         finally:
@@ -418,19 +435,31 @@ class IndexingMiddleware(object):
 
         Reason: new revisions that were created after the rebuild started might be missing in new index.
 
+        If the backend has a change feed (see e.g. the fileserver backend), only
+        the revisions changed since the last update are processed, otherwise all
+        backend revids are compared with the indexed ones.
+
         :returns: index changed (bool)
         """
         index_dir = self.index_dir_tmp if tmp else self.index_dir
+        token, add_revids, del_revids = self._backend_changes(index_dir)
         index_all = open_dir(index_dir, indexname=ALL_REVS)
         try:
             # first update ALL_REVS index:
-            backend_revids = set(self.backend)
-            with index_all.searcher() as searcher:
-                ix_revids = set([doc[REVID] for doc in searcher.all_stored_fields()])
-            add_revids = backend_revids - ix_revids
-            del_revids = ix_revids - backend_revids
+            if add_revids is not None:
+                try:
+                    self._modify_index(index_all, self.schemas[ALL_REVS], self.wikiname, add_revids, 'update')
+                except KeyError:
+                    # changed again meanwhile, compare everything
+                    add_revids = None
+            if add_revids is None:
+                backend_revids = set(self.backend)
+                with index_all.searcher() as searcher:
+                    ix_revids = set([doc[REVID] for doc in searcher.all_stored_fields()])
+                add_revids = backend_revids - ix_revids
+                del_revids = ix_revids - backend_revids
+                self._modify_index(index_all, self.schemas[ALL_REVS], self.wikiname, add_revids, 'add')
             changed = add_revids or del_revids
-            self._modify_index(index_all, self.schemas[ALL_REVS], self.wikiname, add_revids, 'add')
             self._modify_index(index_all, self.schemas[ALL_REVS], self.wikiname, del_revids, 'delete')
 
             backend_latest_revids = set(self._find_latest_revids(index_all))
@@ -446,19 +475,52 @@ class IndexingMiddleware(object):
             self._modify_index(index_latest, self.schemas[LATEST_REVS], self.wikiname, del_revids, 'delete')
         finally:
             index_latest.close()
+        if token is not None:
+            self._save_changes_token(index_dir, token)
         return changed
 
-    def optimize_backend(self):
+    def _backend_changes(self, index_dir):
+        """
+        get the backend's changes since the last update of the index in index_dir
+
+        :returns: token, added revids, removed revids (None if unknown, see
+                  e.g. the fileserver backend's changes method)
+        """
+        changes = getattr(self.backend, 'changes', None)
+        if changes is None:
+            return None, None, None
+        try:
+            with open(os.path.join(index_dir, CHANGES_TOKEN_FILE), 'rb') as f:
+                since = f.read().decode('utf-8')
+        except (IOError, OSError):
+            since = None
+        return changes(since)
+
+    def _save_changes_token(self, index_dir, token):
+        # write + rename, so we never have a partially written token
+        path = os.path.join(index_dir, CHANGES_TOKEN_FILE)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(token.encode('utf-8'))
+        os.rename(path + '.tmp', path)
+
+    def optimize_backend(self, dry_run=False, **kw):
         """
         Optimize backend / collect garbage to safe space:
 
         * trash bin: empty it? use trash_max_age?
         * user profiles: only keep latest revision?
-        * normal wiki items: keep by max_revisions_count / max_age
+        * normal wiki items: keep by max_revisions_count / max_age (see retention module)
         * deduplicate data (determine dataids with same hash, fix references to point to one of them)
         * remove unreferenced dataids (destroyed revisions, deduplicated stuff)
+
+        :param dry_run: only report what would be removed
+        :param kw: given to the garbage collector (batch_size, pause)
+        :returns: garbage collector report (None if the backend has no gc)
         """
-        # TODO
+        # TODO: trash bin, deduplication of existing data
+        collect_garbage = getattr(self.backend, 'collect_garbage', None)
+        if collect_garbage is not None:
+            return collect_garbage(dry_run=dry_run, **kw)
 
     def optimize_index(self):
         """
@@ -674,7 +736,7 @@ class Item(object):
         Get Revision with revision id <revid>.
         """
         rev = Revision(self, revid)
-        rev.data # XXX trigger KeyError if rev does not exist
+        rev.data # trigger KeyError if rev does not exist (the data itself is opened lazily)
         return rev
 
     def get_revision(self, revid):
@@ -697,7 +759,7 @@ class Item(object):
         :returns: a Revision instance of the just created revision
         """
         if self.itemid is None:
-            self.itemid = make_uuid()
+            self.itemid = self.indexer._make_id()
         backend = self.backend
         if not overwrite:
             revid = meta.get(REVID)
@@ -793,7 +855,7 @@ class Meta(object):
             return self._doc[key]
         except KeyError:
             pass
-        self._meta, self.revision._data = self.revision.backend.retrieve(self.revision.revid) # raises KeyError if rev does not exist
+        self._meta = self.revision.backend.retrieve_meta(self.revision.revid) # raises KeyError if rev does not exist
         return self._meta[key]
 
     def __cmp__(self, other):
@@ -0,0 +1,152 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - revision retention
+
+Keeps history from growing forever: a retention policy says how many old
+revisions of an item are kept (max_revisions) and/or how old they may get
+(max_age). Policies are given per namespace, like the routing middleware
+mapping:
+
+    policies = [
+        (u'users', Policy(max_revisions=1)),
+        (u'', Policy(max_revisions=100, max_age=365 * 24 * 3600)),
+    ]
+
+The first policy with a matching name prefix (the item's current name is
+used) applies, items matching no policy are kept completely.
+
+The expendable revisions are selected using the indexes only (no backend
+access), the latest revision of an item is never touched. They are removed
+in batches: from the backend, then from the ALL_REVS index with one writer
+commit per batch (the LATEST_REVS index does not need updating).
+
+Run apply_retention before IndexingMiddleware.optimize_backend, so the
+garbage collector also finds data left over by a partially failed run.
+"""
+
+
+from __future__ import absolute_import, division
+
+import time
+import datetime
+
+from config import NAME, MTIME, SIZE, ITEMID, REVID
+
+from storage._util import batches
+from storage.middleware.indexing import LATEST_REVS, ALL_REVS
+
+# how many revisions we remove with one index commit
+BATCH_SIZE = 1000
+
+
+class Policy(object):
+    """
+    retention policy for the revisions of an item
+    """
+    def __init__(self, max_revisions=None, max_age=None):
+        """
+        :param max_revisions: keep at most this many revisions (including the latest one)
+        :param max_age: remove revisions older than this (seconds)
+        """
+        if max_revisions is not None and max_revisions < 1:
+            raise ValueError("max_revisions must be >= 1 (the latest revision is always kept)")
+        self.max_revisions = max_revisions
+        self.max_age = max_age
+
+    def expendable(self, revs, now):
+        """
+        select expendable revisions
+
+        :param revs: list of (mtime, revid, size), newest first, without the latest revision
+        :param now: UNIX timestamp of "now"
+        :returns: list of expendable (mtime, revid, size)
+        """
+        if self.max_age is not None:
+            oldest = datetime.datetime.utcfromtimestamp(now - self.max_age)
+        result = []
+        for pos, rev in enumerate(revs, 1): # pos 0 is the latest revision
+            mtime = rev[0]
+            if (self.max_revisions is not None and pos >= self.max_revisions or
+                self.max_age is not None and mtime is not None and mtime < oldest):
+                result.append(rev)
+        return result
+
+
+def _get_policy(policies, name):
+    for prefix, policy in policies:
+        prefix = prefix.rstrip(u'/')
+        if name == prefix or name.startswith(prefix and prefix + u'/' or u''):
+            return policy
+
+
+def select_expendable(indexer, policies, now=None):
+    """
+    select expendable revisions using the indexes
+
+    We go through the items one by one, so we only keep the revisions of one
+    item in memory (besides the result).
+
+    :param indexer: an opened IndexingMiddleware
+    :param policies: list of (name prefix, Policy)
+    :param now: UNIX timestamp to use as "now" (default: current time)
+    :returns: list of (revid, size) of expendable revisions
+    """
+    if now is None:
+        now = time.time()
+    result = []
+    with indexer.ix[LATEST_REVS].searcher() as latest_searcher:
+        with indexer.ix[ALL_REVS].searcher() as all_searcher:
+            for latest in latest_searcher.all_stored_fields():
+                policy = _get_policy(policies, latest[NAME])
+                if policy is None:
+                    continue # keep this item completely
+                # (mtime, revid, size) of the older revisions of this item
+                item_revs = [(doc.get(MTIME), doc[REVID], doc.get(SIZE) or 0)
+                             for doc in all_searcher.documents(itemid=latest[ITEMID])
+                             if doc[REVID] != latest[REVID]]
+                item_revs.sort(reverse=True)
+                result.extend((revid, size) for mtime, revid, size in policy.expendable(item_revs, now))
+    return result
+
+
+def apply_retention(indexer, policies, now=None, dry_run=False, batch_size=BATCH_SIZE):
+    """
+    remove expendable revisions from backend and index
+
+    :param indexer: an opened IndexingMiddleware
+    :param policies: list of (name prefix, Policy)
+    :param now: UNIX timestamp to use as "now" (default: current time)
+    :param dry_run: just select, do not remove anything
+    :param batch_size: number of revisions removed with one index commit
+    :returns: report dict with:
+              - revids: list of expendable revids
+              - removed: number of removed revisions (0 for a dry run)
+              - reclaimed_bytes: sum of the data sizes of the (removed) revisions
+                (more than really freed if revisions share data, see dedup)
+    """
+    expendable = select_expendable(indexer, policies, now)
+    report = dict(revids=[revid for revid, size in expendable], removed=0, reclaimed_bytes=0)
+    if dry_run:
+        report['reclaimed_bytes'] = sum(size for revid, size in expendable)
+        return report
+    backend = indexer.backend
+    for batch in batches(expendable, batch_size):
+        removed = []
+        try:
+            for revid, size in batch:
+                try:
+                    backend.remove(revid)
+                except KeyError:
+                    pass # already gone from the backend, just fix the index
+                else:
+                    report['reclaimed_bytes'] += size
+                removed.append(revid)
+        finally:
+            # even if something went wrong, the index must reflect what we removed
+            with indexer.ix[ALL_REVS].writer() as writer:
+                for revid in removed:
+                    writer.delete_by_term(REVID, revid)
+            report['removed'] += len(removed)
+    return report
@@ -12,21 +12,45 @@ Just think of UNIX filesystems, fstab and mount.
 
 This middleware lets you mount backends that store items belonging to some
 specific part of the namespace. Routing middleware has same API as a backend.
+
+The mapping is compiled into a dict mountpoint -> backend, so finding the
+backend of an item name or revid needs one dict lookup per path segment
+(not a scan of all mountpoints). Resolved item names are memoized.
 """
 
 
 from __future__ import absolute_import, division
 
+import json
+from itertools import chain
+
 from config import NAME
 
+from storage._util import batches, LRUCache
 from storage.backends import BackendBase, MutableBackendBase
 
+# how many revids retrieve_many distributes to the mounted backends in one go
+BATCH_SIZE = 100
+
+# how many resolved item names _get_backend memoizes
+RESOLVE_CACHE_SIZE = 10000
+
+
+def _segment_prefixes(path):
+    """
+    yield the prefixes of path that end before a '/', shortest first
+    """
+    pos = path.find(u'/')
+    while pos != -1:
+        yield path[:pos]
+        pos = path.find(u'/', pos + 1)
+
 
 class Backend(MutableBackendBase):
     """
     router, behaves readonly for readonly mounts
     """
-    def __init__(self, mapping):
+    def __init__(self, mapping, resolve_cache_size=RESOLVE_CACHE_SIZE):
         """
         Initialize router backend.
 
@@ -42,8 +66,14 @@ class Backend(MutableBackendBase):
 
         :type mapping: list of tuples of mountpoint -> backend mappings
         :param mapping: [(mountpoint, backend), ...]
+        :param resolve_cache_size: max. number of resolved item names to memoize
         """
         self.mapping = [(mountpoint.rstrip('/'), backend) for mountpoint, backend in mapping]
+        # mountpoint -> (position in mapping, backend), the first one wins
+        self._mounts = {}
+        for index, (mountpoint, backend) in enumerate(self.mapping):
+            self._mounts.setdefault(mountpoint, (index, backend))
+        self._resolved = LRUCache(resolve_cache_size) # itemname -> _get_backend result
 
     def open(self):
         for mountpoint, backend in self.mapping:
@@ -53,6 +83,19 @@ class Backend(MutableBackendBase):
         for mountpoint, backend in self.mapping:
             backend.close()
 
+    def _find_mount(self, prefixes):
+        """
+        find the mount (first in mapping order) with its mountpoint in prefixes
+
+        :returns: tuple of (mountpoint, backend) or None
+        """
+        found, found_index = None, None
+        for prefix in prefixes:
+            mount = self._mounts.get(prefix)
+            if mount is not None and (found is None or mount[0] < found_index):
+                found_index, found = mount[0], (prefix, mount[1])
+        return found
+
     def _get_backend(self, itemname):
         """
         For a given fully-qualified itemname (i.e. something like Company/Bosses/Mr_Joe)
@@ -62,11 +105,29 @@ class Backend(MutableBackendBase):
         :param itemname: fully-qualified itemname
         :returns: tuple of (backend, local itemname, mountpoint)
         """
-        for mountpoint, backend in self.mapping:
-            if itemname == mountpoint or itemname.startswith(mountpoint and mountpoint + '/' or ''):
-                lstrip = mountpoint and len(mountpoint)+1 or 0
-                return backend, itemname[lstrip:], mountpoint
-        raise AssertionError("No backend found for %r. Available backends: %r" % (itemname, self.mapping))
+        result = self._resolved.get(itemname)
+        if result is None:
+            # the mountpoint is '', a parent of itemname or itemname itself
+            mount = self._find_mount(chain([u''], _segment_prefixes(itemname), [itemname]))
+            if mount is None:
+                raise AssertionError("No backend found for %r. Available backends: %r" % (itemname, self.mapping))
+            mountpoint, backend = mount
+            lstrip = mountpoint and len(mountpoint)+1 or 0
+            result = self._resolved[itemname] = backend, itemname[lstrip:], mountpoint
+        return result
+
+    def _split_revid(self, revid):
+        """
+        split a router revid into mountpoint, backend and backend revid (which
+        may contain slashes, e.g. the fileserver backend's <path>/<mtime>)
+
+        :returns: tuple of (mountpoint, backend, backend revid)
+        """
+        mount = self._find_mount(_segment_prefixes(revid))
+        if mount is None:
+            raise KeyError(revid)
+        mountpoint, backend = mount
+        return mountpoint, backend, revid[len(mountpoint)+1:]
 
     def __iter__(self):
         # Note: yields <backend_mountpoint>/<backend_revid> as router revid, so that this
@@ -75,14 +136,81 @@ class Backend(MutableBackendBase):
             for revid in backend:
                 yield u'%s/%s' % (mountpoint, revid)
 
+    def iter_meta(self):
+        for mountpoint, backend in self.mapping:
+            for revid, meta in backend.iter_meta():
+                if mountpoint:
+                    meta[NAME] = u'%s/%s' % (mountpoint, meta[NAME])
+                yield u'%s/%s' % (mountpoint, revid), meta
+
+    def iter_revisions(self):
+        for mountpoint, backend in self.mapping:
+            for revid, meta, data in backend.iter_revisions():
+                if mountpoint:
+                    meta[NAME] = u'%s/%s' % (mountpoint, meta[NAME])
+                yield u'%s/%s' % (mountpoint, revid), meta, data
+
     def retrieve(self, revid):
-        mountpoint, revid = revid.rsplit(u'/', 1)
-        backend = self._get_backend(mountpoint)[0]
+        mountpoint, backend, revid = self._split_revid(revid)
         meta, data = backend.retrieve(revid)
         if mountpoint:
             meta[NAME] = u'%s/%s' % (mountpoint, meta[NAME])
         return meta, data
 
+    def retrieve_many(self, revids, prefetch=None, prefetch_data=False, batch_size=BATCH_SIZE):
+        # group the revids of each batch by mountpoint, so each backend gets
+        # all its revids with one retrieve_many call.
+        for batch in batches(revids, batch_size):
+            by_mountpoint = {}
+            for revid in batch:
+                mountpoint, backend, local_revid = self._split_revid(revid)
+                by_mountpoint.setdefault(mountpoint, (backend, []))[1].append(local_revid)
+            results = {}
+            for mountpoint, (backend, local_revids) in by_mountpoint.iteritems():
+                for local_revid, meta, data in backend.retrieve_many(local_revids, prefetch=prefetch,
+                                                                     prefetch_data=prefetch_data):
+                    if mountpoint:
+                        meta[NAME] = u'%s/%s' % (mountpoint, meta[NAME])
+                    results[u'%s/%s' % (mountpoint, local_revid)] = meta, data
+            for revid in batch:
+                meta, data = results[revid]
+                yield revid, meta, data
+
+    def retrieve_meta(self, revid):
+        mountpoint, backend, revid = self._split_revid(revid)
+        meta = backend.retrieve_meta(revid)
+        if mountpoint:
+            meta[NAME] = u'%s/%s' % (mountpoint, meta[NAME])
+        return meta
+
+    def retrieve_range(self, revid, offset, length=None):
+        mountpoint, backend, revid = self._split_revid(revid)
+        return backend.retrieve_range(revid, offset, length)
+
+    def changes(self, since=None):
+        """
+        combined change feed of all mounted backends, see e.g. the fileserver
+        backend. If some backend has no change feed, added and removed are
+        always None (the caller has to compare everything).
+        """
+        if not all(hasattr(backend, 'changes') for mountpoint, backend in self.mapping):
+            return None, None, None
+        since = json.loads(since) if since else {}
+        tokens, added, removed = {}, [], []
+        complete = True
+        for mountpoint, backend in self.mapping:
+            token, backend_added, backend_removed = backend.changes(since.get(mountpoint))
+            tokens[mountpoint] = token
+            if backend_added is None:
+                complete = False
+            else:
+                added.extend(u'%s/%s' % (mountpoint, revid) for revid in backend_added)
+                removed.extend(u'%s/%s' % (mountpoint, revid) for revid in backend_removed)
+        token = json.dumps(tokens, sort_keys=True)
+        if not complete:
+            return token, None, None
+        return token, added, removed
+
     # writing part
     def create(self):
         for mountpoint, backend in self.mapping:
@@ -106,10 +234,20 @@ class Backend(MutableBackendBase):
         return u'%s/%s' % (mountpoint, backend.store(meta, data))
 
     def remove(self, revid):
-        mountpoint, revid = revid.rsplit(u'/', 1)
-        backend = self._get_backend(mountpoint)[0]
+        mountpoint, backend, revid = self._split_revid(revid)
         if not isinstance(backend, MutableBackendBase):
             raise TypeError('backend %r mounted at %r is readonly' % (
                 backend, mountpoint))
         backend.remove(revid)
 
+    def collect_garbage(self, dry_run=False, **kw):
+        """
+        collect garbage in all mounted backends that support it
+
+        :returns: list of (mountpoint, gc report dict)
+        """
+        reports = []
+        for mountpoint, backend in self.mapping:
+            if isinstance(backend, MutableBackendBase) and hasattr(backend, 'collect_garbage'):
+                reports.append((mountpoint, backend.collect_garbage(dry_run=dry_run, **kw)))
+        return reports
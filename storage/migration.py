@@ -0,0 +1,214 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - store to store migration
+
+Copies all k/v pairs of a source store to a target store (e.g. when moving a
+wiki from fs stores to sqlite stores), see copy_store. migrate_backend does
+this for all stores of a "stores" backend.
+
+- reading is done by a pool of reader threads, each fetching a batch of keys
+  with one get_many call; writing is done by one (or more) writer threads,
+  storing a batch with one set_many call (1 writer is best for sqlite).
+- after each batch, progress is saved into a checkpoint file, so an
+  interrupted migration can be resumed. For ordered source stores we resume
+  after the last copied key. Keys already present in the target store are
+  skipped (they may have been written after the last checkpoint).
+- optionally, everything written is read back and verified by size and
+  HASH_ALGORITHM digest.
+"""
+
+
+from __future__ import absolute_import, division
+
+import os
+import json
+import hashlib
+
+from config import HASH_ALGORITHM
+
+from storage._util import Executor, batches
+from storage.stores import FileStoreBase, FileMutableStoreBase
+from storage.backends._util import TrackingFileWrapper
+
+BLOCKSIZE = 64 * 1024
+
+# the stores of a "stores" backend, in the order migrate_backend copies them
+STORE_NAMES = ['chunk_store', 'data_store', 'refs_store', 'heads_store', 'meta_store']
+
+
+def _load_checkpoint(path):
+    try:
+        with open(path, 'rb') as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return None
+
+
+def _save_checkpoint(path, state):
+    # write + rename, so we never have a partially written checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        json.dump(state, f)
+    os.rename(tmp_path, path)
+
+
+def _file_digest(f):
+    h = hashlib.new(HASH_ALGORITHM)
+    size = 0
+    while True:
+        block = f.read(BLOCKSIZE)
+        if not block:
+            break
+        h.update(block)
+        size += len(block)
+    return size, h.hexdigest()
+
+
+class _Copier(object):
+    def __init__(self, src, dst, verify):
+        self.src = src
+        self.dst = dst
+        self.verify = verify
+        self.files = isinstance(src, (FileStoreBase, FileMutableStoreBase))
+
+    def missing_in_dst(self, keys):
+        """
+        return the keys that are not present in the target store yet
+        """
+        return [key for key in keys if key not in self.dst]
+
+    def read(self, keys):
+        """
+        read a batch (runs in a reader thread)
+
+        :returns: list of (key, value) pairs, files are wrapped to compute size / hash while written
+        """
+        values = self.src.get_many(keys)
+        missing = set(keys) - set(values)
+        if missing:
+            # the source store is changed while we copy it?
+            raise KeyError("keys vanished from source store: %r" % sorted(missing))
+        items = []
+        for key in keys:
+            value = values[key]
+            if self.files:
+                value = TrackingFileWrapper(value, hash_method=HASH_ALGORITHM)
+            items.append((key, value))
+        return items
+
+    def write(self, items):
+        """
+        write a batch (runs in a writer thread)
+
+        :returns: keys, bytes written
+        """
+        try:
+            self.dst.set_many(items)
+        finally:
+            if self.files:
+                for key, value in items:
+                    value.close()
+        if self.files:
+            expected = dict((key, (value.size, value.hash.hexdigest())) for key, value in items)
+        else:
+            expected = dict((key, (len(value), hashlib.new(HASH_ALGORITHM, value).hexdigest()))
+                            for key, value in items)
+        keys = [key for key, value in items]
+        if self.verify:
+            self.check(keys, expected)
+        return keys, sum(size for size, _ in expected.values())
+
+    def check(self, keys, expected):
+        values = self.dst.get_many(keys)
+        for key in keys:
+            try:
+                value = values[key]
+            except KeyError:
+                raise ValueError("verification failed, key %r is missing in the target store" % (key, ))
+            if self.files:
+                try:
+                    real = _file_digest(value)
+                finally:
+                    value.close()
+            else:
+                real = len(value), hashlib.new(HASH_ALGORITHM, value).hexdigest()
+            if real != expected[key]:
+                raise ValueError("verification failed for key %r: size, hash = %r, expected %r" % (
+                                 key, real, expected[key]))
+
+
+def copy_store(src, dst, readers=4, writers=1, batch_size=100, checkpoint=None, verify=True, progress=None):
+    """
+    copy all k/v pairs from src store to dst store
+
+    :param src: source store (opened)
+    :param dst: target store (created and opened)
+    :param readers: number of reader threads
+    :param writers: number of writer threads
+    :param batch_size: number of keys read / written with one store operation
+    :param checkpoint: checkpoint file path (None: no checkpointing / resume)
+    :param verify: read back and verify everything that was written
+    :param progress: callable, called with the checkpoint state dict after each batch
+    :returns: checkpoint state dict, with count of copied keys and bytes
+    """
+    state = checkpoint and _load_checkpoint(checkpoint) or dict(last_key=None, count=0, bytes=0)
+    resuming = bool(state['count'])
+    if src.ordered:
+        keys = src.iter_range(start=state['last_key'])
+        if state['last_key'] is not None:
+            keys = (key for key in keys if key != state['last_key'])
+    else:
+        keys = iter(src)
+    copier = _Copier(src, dst, verify)
+    key_batches = batches(keys, batch_size)
+    if resuming:
+        # batches written after the last checkpoint was saved are in dst
+        # already (and some stores can't overwrite keys)
+        key_batches = (copier.missing_in_dst(batch) for batch in key_batches)
+        key_batches = (batch for batch in key_batches if batch)
+    reader_pool, writer_pool = Executor(readers), Executor(writers)
+    try:
+        # the writers' results come back in order, so the checkpoint is always
+        # at a point where everything before it was written
+        item_batches = reader_pool.map(copier.read, key_batches)
+        for keys, size in writer_pool.map(copier.write, item_batches):
+            state['last_key'] = keys[-1]
+            state['count'] += len(keys)
+            state['bytes'] += size
+            if checkpoint:
+                _save_checkpoint(checkpoint, state)
+            if progress:
+                progress(state)
+    finally:
+        reader_pool.shutdown()
+        writer_pool.shutdown()
+    return state
+
+
+def migrate_backend(src, dst, checkpoint=None, **kw):
+    """
+    copy all stores of a "stores" backend to another one (the target needs
+    the same kinds of stores, e.g. a chunk store if the source has one)
+
+    Stores are copied in STORE_NAMES order, so the target never has meta
+    referencing missing data (or manifests referencing missing chunks).
+
+    :param src: source stores backend (opened)
+    :param dst: target stores backend (created and opened)
+    :param checkpoint: checkpoint file path prefix (None: no checkpointing / resume)
+    :param kw: see copy_store
+    :returns: dict store name -> checkpoint state dict
+    """
+    names = [name for name in STORE_NAMES if getattr(src, name, None) is not None]
+    if len(names) != len(src._stores()):
+        raise ValueError("source backend has stores we do not know how to migrate")
+    missing = [name for name in names if getattr(dst, name, None) is None]
+    if missing:
+        raise ValueError("target backend has no %s" % ', '.join(missing))
+    states = {}
+    for name in names:
+        states[name] = copy_store(getattr(src, name), getattr(dst, name),
+                                  checkpoint=checkpoint and '%s.%s' % (checkpoint, name.split('_')[0]), **kw)
+    return states
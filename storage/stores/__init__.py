@@ -13,14 +13,39 @@ you can likely implement it adding very little and rather easy code.
 from __future__ import absolute_import, division
 
 import io
+import sys
+from bisect import bisect_left
 from abc import abstractmethod
 from collections import Mapping, MutableMapping
 
+from storage._util import get_executor, batches, slice_range, read_range
+
+
+# how many keys the generic iteritems fetches with one get_many call
+ITER_BATCH_SIZE = 100
+
+
+def prefix_stop(prefix):
+    """
+    return the smallest key that is greater than all keys starting with prefix
+    (or None if there is no such key)
+    """
+    maxchar = sys.maxunicode if isinstance(prefix, unicode) else 255
+    mkchar = unichr if isinstance(prefix, unicode) else chr
+    for i in xrange(len(prefix) - 1, -1, -1):
+        if ord(prefix[i]) < maxchar:
+            return prefix[:i] + mkchar(ord(prefix[i]) + 1)
+    return None
+
 
 class StoreBase(Mapping):
     """
     A simple read-only key/value store.
     """
+    # True if the store keeps its keys in an ordered index, so that iter_range
+    # and iter_prefix are cheap. If False, they need to sort all keys.
+    ordered = False
+
     @classmethod
     @abstractmethod
     def from_uri(cls, uri):
@@ -59,6 +84,95 @@ class StoreBase(Mapping):
         return data stored for key
         """
 
+    def get_many(self, keys):
+        """
+        return a dict key -> value for all the given keys that are present in
+        the store (missing keys are just left out, no KeyError is raised)
+
+        note: for file stores, the caller is responsible for closing the open
+              files we return.
+
+        stores that can fetch many keys in one operation override this.
+        """
+        result = {}
+        for key in keys:
+            try:
+                result[key] = self[key]
+            except KeyError:
+                pass
+        return result
+
+    def get_range(self, key, offset, length=None):
+        """
+        return length bytes (None: all up to the end) of the value stored for
+        key, starting at offset, raise KeyError if key does not exist.
+
+        stores that can read a part of a value override this.
+        """
+        # generic: get the whole value
+        value = self[key]
+        if hasattr(value, 'read'):
+            return read_range(value, offset, length)
+        return slice_range(value, offset, length)
+
+    def iteritems(self):
+        """
+        iterate over (key, value) pairs of all keys present in the store
+
+        note: for file stores, the caller is responsible for closing the open
+              files we yield.
+
+        stores that can scan keys and values in one pass override this.
+        """
+        # generic: fetch the values of a batch of keys in one operation
+        for keys in batches(self, ITER_BATCH_SIZE):
+            values = self.get_many(keys)
+            for key in keys:
+                if key in values: # might have been deleted meanwhile
+                    yield key, values[key]
+
+    def iter_range(self, start=None, stop=None, limit=None):
+        """
+        iterate over keys k with start <= k < stop, in ascending order
+
+        :param start: first key (None: from the smallest key)
+        :param stop: stop before this key (None: up to the greatest key)
+        :param limit: yield at most that many keys (None: no limit)
+        """
+        # generic, but expensive: ordered stores override this
+        keys = sorted(self)
+        i = 0 if start is None else bisect_left(keys, start)
+        keys = keys[i:]
+        if stop is not None:
+            keys = keys[:bisect_left(keys, stop)]
+        if limit is not None:
+            keys = keys[:limit]
+        return iter(keys)
+
+    def iter_prefix(self, prefix, limit=None):
+        """
+        iterate over keys starting with prefix, in ascending order
+        """
+        return self.iter_range(prefix, prefix_stop(prefix), limit)
+
+    def _executor(self):
+        """
+        return the executor the a* methods run their blocking calls in
+        """
+        return get_executor()
+
+    def aget(self, key):
+        """
+        same as self[key], but return a future (call .get() on it for the result)
+        """
+        return self._executor().submit(self.__getitem__, key)
+
+    def aiter(self):
+        """
+        return a future for the list of keys present in the store
+        """
+        return self._executor().submit(list, self)
+
 
 class BytesStoreBase(StoreBase):
     @abstractmethod
@@ -105,6 +219,32 @@ class MutableStoreBase(StoreBase, MutableMapping):
         delete the key, dereference the related value in the store
         """
 
+    def set_many(self, items):
+        """
+        store many values, items is a dict or an iterable of (key, value) pairs
+
+        stores that can store many keys in one operation override this.
+        """
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        for key, value in items:
+            self[key] = value
+
+    def delete_many(self, keys):
+        """
+        delete all the given keys
+
+        stores that can delete many keys in one operation override this.
+        """
+        for key in keys:
+            del self[key]
+
+    def aset(self, key, value):
+        """
+        same as self[key] = value, but return a future
+        """
+        return self._executor().submit(self.__setitem__, key, value)
+
 
 class BytesMutableStoreBase(MutableStoreBase):
     @abstractmethod
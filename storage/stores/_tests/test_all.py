@@ -9,8 +9,12 @@ MoinMoin - store tests
 
 from __future__ import absolute_import, division
 
+from functools import partial
+
 import pytest
 
+from .conftest import STORES_PACKAGE, constructors
+
 def test_getitem_raises(store):
     with pytest.raises(KeyError):
         store['doesnotexist']
@@ -44,6 +48,14 @@ def test_iter(store):
     assert result == kvs
 
 
+def test_contains(store):
+    assert 'key' not in store
+    store['key'] = 'value'
+    assert 'key' in store
+    del store['key']
+    assert 'key' not in store
+
+
 def test_len(store):
     assert len(store) == 0
     store['foo'] = 'bar'
@@ -52,6 +64,110 @@ def test_len(store):
     assert len(store) == 0
 
 
+def test_get_set_delete_many(bst):
+    kvs = dict([('1', 'one'), ('2', 'two'), ('3', '\000\001\002'), ])
+    bst.set_many(kvs)
+    assert bst.get_many(['1', '2', '3', 'doesnotexist']) == kvs
+    bst.delete_many(['1', '3'])
+    assert sorted(bst) == ['2']
+    assert bst.get_many(['1', '3']) == {}
+
+
+def test_get_set_many_files(fst):
+    from StringIO import StringIO
+    kvs = dict([('1', 'one'), ('2', 'two'), ])
+    fst.set_many((k, StringIO(v)) for k, v in kvs.items())
+    result = fst.get_many(['1', '2', 'doesnotexist'])
+    assert sorted(result) == ['1', '2']
+    for k, f in result.items():
+        assert f.read() == kvs[k]
+        f.close()
+
+
+def test_iteritems(bst):
+    kvs = dict((str(i), 'value%d' % i) for i in range(250))
+    bst.set_many(kvs)
+    assert dict(bst.iteritems()) == kvs
+
+
+def test_iteritems_files(fst):
+    from StringIO import StringIO
+    kvs = dict([('1', 'one'), ('2', 'two'), ])
+    fst.set_many((k, StringIO(v)) for k, v in kvs.items())
+    result = {}
+    for k, f in fst.iteritems():
+        result[k] = f.read()
+        f.close()
+    assert result == kvs
+
+
+def test_iter_range(bst):
+    for k in ['a', 'b', 'ba', 'bb', 'c', 'd', ]:
+        bst[k] = k
+    assert list(bst.iter_range()) == ['a', 'b', 'ba', 'bb', 'c', 'd', ]
+    assert list(bst.iter_range('b', 'c')) == ['b', 'ba', 'bb', ]
+    assert list(bst.iter_range('b', limit=2)) == ['b', 'ba', ]
+    assert list(bst.iter_range(stop='b')) == ['a', ]
+    assert list(bst.iter_prefix('b')) == ['b', 'ba', 'bb', ]
+    assert list(bst.iter_prefix('bb')) == ['bb', ]
+    assert list(bst.iter_prefix('x')) == []
+
+
+def test_get_range(bst):
+    bst['key'] = '0123456789'
+    assert bst.get_range('key', 0) == '0123456789'
+    assert bst.get_range('key', 3) == '3456789'
+    assert bst.get_range('key', 3, 4) == '3456'
+    assert bst.get_range('key', 8, 4) == '89'
+    assert bst.get_range('key', 12) == ''
+    assert bst.get_range('key', 2, 0) == ''
+    with pytest.raises(KeyError):
+        bst.get_range('doesnotexist', 0, 1)
+
+
+def test_get_range_files(fst):
+    from StringIO import StringIO
+    fst['key'] = StringIO('\000\001\002' * 100)
+    assert fst.get_range('key', 1, 3) == '\001\002\000'
+    assert fst.get_range('key', 297) == '\000\001\002'
+    with pytest.raises(KeyError):
+        fst.get_range('doesnotexist', 0)
+
+
+def test_aget_aset(bst):
+    k, v = 'key', 'value'
+    bst.aset(k, v).get()
+    assert bst.aget(k).get() == v
+    assert bst.aiter().get() == [k]
+    with pytest.raises(KeyError):
+        bst.aget('doesnotexist').get()
+
+
+def _project(value):
+    name, mtime = value.split()
+    return dict(name=name, mtime=int(mtime))
+
+
+@pytest.mark.parametrize('storename', ['sqlite', 'sqlite:compressed', 'sqla'])
+def test_columns(tmpdir, storename):
+    # stores supporting projected columns
+    storemodule = pytest.importorskip(STORES_PACKAGE + '.' + storename.split(':')[0])
+    klass = partial(storemodule.BytesStore, columns=[('name', 'text'), ('mtime', 'integer')], projector=_project)
+    store = constructors[storename](klass, tmpdir)
+    store.create()
+    store.open()
+    store['a'] = 'foo 2'
+    store.set_many([('b', 'foo 1'), ('c', 'bar 3'), ('d', 'bar 3')])
+    assert store['a'] == 'foo 2'
+    assert list(store.query(name='foo', order_by='mtime')) == ['b', 'a']
+    assert list(store.query(name='foo', mtime=1)) == ['b']
+    assert list(store.query_latest('name', 'mtime')) == [('bar', 'c'), ('foo', 'a')]
+    assert sorted(store.iter_column('mtime')) == [('a', 2), ('b', 1), ('c', 3), ('d', 3)]
+    with pytest.raises(ValueError):
+        list(store.query(other='foo'))
+    store.close()
+
+
 def test_perf(store):
     # XXX: introduce perf test option
     pytest.skip("usually we do no performance tests")
@@ -64,4 +180,3 @@ def test_perf(store):
     for i in range(1000):
         key = str(i)
         del store[key]
-
@@ -27,4 +27,3 @@ def test_destroy(tmpdir, Store):
     store = test_create(tmpdir, Store)
     store.destroy()
     # XXX: check for dropped table
-
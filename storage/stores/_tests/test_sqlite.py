@@ -7,6 +7,9 @@ MoinMoin - sqlite store tests
 """
 
 
+import threading
+from sqlite3 import ProgrammingError
+
 import pytest
 
 from ..sqlite import BytesStore, FileStore
@@ -46,3 +49,36 @@ def test_destroy(tmpdir, Store):
     store.destroy()
     # XXX: check for dropped table
 
+
+def _project(value):
+    name, mtime = value.split()
+    return dict(name=name, mtime=int(mtime))
+
+def test_columns_invalid(tmpdir):
+    with pytest.raises(ValueError):
+        BytesStore(str(tmpdir.join('store.sqlite')), columns=[('name', 'text')]) # no projector
+    with pytest.raises(ValueError):
+        BytesStore(str(tmpdir.join('store.sqlite')), columns=[('drop table', 'text')], projector=_project)
+
+def test_memory_db_rejected():
+    with pytest.raises(ValueError):
+        BytesStore(':memory:')
+
+def test_close_thread_connections(tmpdir):
+    store = BytesStore(str(tmpdir.join('store.sqlite')))
+    store.create()
+    store.open()
+    conns = []
+    thread = threading.Thread(target=lambda: conns.append(store.conn))
+    thread.start()
+    thread.join()
+    executors = []
+    threads = [threading.Thread(target=lambda: executors.append(store._executor())) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(executors)) == 1
+    store.close()
+    with pytest.raises(ProgrammingError): # closed
+        conns[0].execute('select 1')
@@ -0,0 +1,150 @@
+# Copyright: 2011 MoinMoin:ThomasWaldmann
+# License: GNU GPL v2 (or any later version), see LICENSE.txt for details.
+
+"""
+MoinMoin - store wrapper tests
+"""
+
+
+from __future__ import absolute_import, division
+
+import os
+import json
+from uuid import uuid4
+from StringIO import StringIO
+
+import pytest
+
+from ..memory import BytesStore, FileStore
+from ..wrappers import CompressingBytesStore, CompressingFileStore, MAGIC, CODEC_STORED, CODEC_ZLIB, \
+                       DictCompressingBytesStore
+
+TEXT = 'some very compressible text. ' * 1000
+RANDOM = os.urandom(100000)
+PNG = '\x89PNG\r\n\x1a\n' + TEXT
+
+
+def make_store(Store, Wrapper):
+    st = Store()
+    store = Wrapper(st)
+    store.create()
+    store.open()
+    return st, store
+
+
+@pytest.mark.multi(Store=[BytesStore, FileStore])
+def test_codec_choice(Store):
+    Wrapper = CompressingBytesStore if Store is BytesStore else CompressingFileStore
+    st, store = make_store(Store, Wrapper)
+    for key, value, codec in [('text', TEXT, CODEC_ZLIB),
+                              ('random', RANDOM, CODEC_STORED),
+                              ('png', PNG, CODEC_STORED),
+                              ('small', 'tiny', CODEC_STORED),
+                              ('empty', '', CODEC_STORED), ]:
+        if Store is BytesStore:
+            store[key] = value
+            assert store[key] == value
+        else:
+            store[key] = StringIO(value)
+            assert store[key].read() == value
+        raw = st._st[key]
+        assert raw.startswith(MAGIC + codec)
+        if codec == CODEC_ZLIB:
+            assert len(raw) < len(value) // 10
+
+
+def test_unwrapped_values():
+    st, store = make_store(BytesStore, CompressingBytesStore)
+    st['legacy'] = 'stored without header'
+    assert store['legacy'] == 'stored without header'
+
+
+def test_file_read_seek():
+    st, store = make_store(FileStore, CompressingFileStore)
+    store['text'] = StringIO(TEXT)
+    f = store['text']
+    assert f.read(10) == TEXT[:10]
+    f.seek(20000)
+    assert f.tell() == 20000
+    assert f.read(10) == TEXT[20000:20010]
+    f.seek(5)
+    assert f.read() == TEXT[5:]
+    f.close()
+    with pytest.raises(ValueError):
+        f.read()
+
+
+@pytest.mark.multi(Store=[BytesStore, FileStore])
+def test_get_range(Store):
+    Wrapper = CompressingBytesStore if Store is BytesStore else CompressingFileStore
+    st, store = make_store(Store, Wrapper)
+    for key, value in [('text', TEXT), ('random', RANDOM), ]:
+        store[key] = value if Store is BytesStore else StringIO(value)
+        assert store.get_range(key, 10000, 100) == value[10000:10100]
+        assert store.get_range(key, len(value) - 5) == value[-5:]
+    st['legacy'] = 'stored without header' if Store is BytesStore else StringIO('stored without header')
+    assert store.get_range('legacy', 7, 7) == 'without'
+    with pytest.raises(KeyError):
+        store.get_range('doesnotexist', 0)
+
+
+def make_meta(i):
+    return json.dumps(dict(name=u'Item%d' % (i % 10), contenttype=u'text/x.moin.wiki;charset=utf-8',
+                           mtime=1300000000 + i, size=i, dataid=uuid4().hex, itemid=uuid4().hex,
+                           acl=u'All:read,write', comment=u''))
+
+
+def test_dict_compression():
+    st, dict_st = BytesStore(), BytesStore()
+    store = DictCompressingBytesStore(st, dict_st)
+    store.create()
+    store.open()
+    metas = dict(('old%d' % i, make_meta(i)) for i in range(100))
+    store.set_many(metas)
+    size_before = sum(len(st[key]) for key in metas)
+    assert store.current == 0
+    dict_id = store.train()
+    assert dict_id == store.current == 1
+    new_metas = dict(('new%d' % i, make_meta(i)) for i in range(100))
+    for key, value in new_metas.items():
+        store[key] = value
+    size_after = sum(len(st[key]) for key in new_metas)
+    assert size_after < size_before * 0.7
+    metas.update(new_metas)
+    assert store.get_many(metas) == metas
+    # rotate the dictionary
+    assert store.train() == 2
+    assert store.recompress() == 200
+    assert sorted(store.prune()) == [1]
+    store.close()
+    store.open()
+    for key, value in metas.items():
+        assert store[key] == value
+    assert store.get_range('new1', 2, 4) == metas['new1'][2:6]
+
+
+def test_dict_recompress_interrupted():
+    class CrashingStore(BytesStore):
+        crash = False
+        def __setitem__(self, key, value):
+            if self.crash:
+                raise KeyboardInterrupt
+            BytesStore.__setitem__(self, key, value)
+    st, dict_st = CrashingStore(), BytesStore()
+    store = DictCompressingBytesStore(st, dict_st)
+    store.create()
+    store.open()
+    metas = dict(('key%d' % i, make_meta(i)) for i in range(10))
+    store.set_many(metas)
+    store.train()
+    # crash after the old value was deleted, before the new one was written
+    st.crash = True
+    with pytest.raises(KeyboardInterrupt):
+        store.recompress()
+    st.crash = False
+    assert len(st) == 9
+    store.close()
+    store.open()
+    assert store.get_many(metas) == metas
+    assert sorted(dict_st) == ['1']
+    assert store.recompress() == 9
@@ -5,6 +5,9 @@
 MoinMoin - filesystem store
 
 Store into filesystem, one file per k/v pair.
+
+The *_many methods do their file operations in parallel, using the executor's
+worker threads (the os calls release the GIL, so this overlaps disk latency).
 """
 
 
@@ -14,8 +17,12 @@ import os
 import errno
 import shutil
 
+from storage._util import read_range
+
 from . import MutableStoreBase, BytesMutableStoreBase, FileMutableStoreBase
 
+BLOCKSIZE = 64 * 1024
+
 
 class _Store(MutableStoreBase):
     """
@@ -47,9 +54,48 @@ class _Store(MutableStoreBase):
         for key in os.listdir(self.path):
             yield key
 
+    def __contains__(self, key):
+        # do not open the file
+        return os.path.exists(self._mkpath(key))
+
     def __delitem__(self, key):
         os.remove(self._mkpath(key))
 
+    def _get_or_none(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            return None
+
+    def get_range(self, key, offset, length=None):
+        # seek, so we only read the bytes we need
+        try:
+            f = open(self._mkpath(key), 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(key)
+            raise
+        return read_range(f, offset, length)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        values = self._executor().map(self._get_or_none, keys)
+        return dict((key, value) for key, value in zip(keys, values) if value is not None)
+
+    def _set_item(self, item):
+        key, value = item
+        self[key] = value
+
+    def set_many(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        for _ in self._executor().map(self._set_item, items):
+            pass
+
+    def delete_many(self, keys):
+        for _ in self._executor().map(self.__delitem__, keys):
+            pass
+
 
 class BytesStore(_Store, BytesMutableStoreBase):
     def __getitem__(self, key):
@@ -77,6 +123,15 @@ class FileStore(_Store, FileMutableStoreBase):
 
     def __setitem__(self, key, stream):
         with open(self._mkpath(key), "wb") as f:
-            blocksize = 64 * 1024
-            shutil.copyfileobj(stream, f, blocksize)
+            if hasattr(stream, 'readinto'):
+                # reuse one buffer, no new string per block
+                buf = bytearray(BLOCKSIZE)
+                view = memoryview(buf)
+                while True:
+                    count = stream.readinto(buf)
+                    if not count:
+                        break
+                    f.write(view[:count])
+            else:
+                shutil.copyfileobj(stream, f, BLOCKSIZE)
 
@@ -73,9 +73,66 @@ class _Store(MutableStoreBase):
     def __iter__(self):
         return iter(self._db)
 
+    @property
+    def ordered(self):
+        # tree dbs (file tree, forest, cache tree, prototype tree) are ordered, hash dbs are not
+        path = self.path.split('#')[0]
+        return path.endswith(('.kct', '.kcf', '+', '%'))
+
+    def iter_range(self, start=None, stop=None, limit=None):
+        if not self.ordered:
+            return super(_Store, self).iter_range(start, stop, limit)
+        return self._iter_range(start, stop, limit)
+
+    def _iter_range(self, start, stop, limit):
+        cursor = self._db.cursor()
+        try:
+            if start is None:
+                cursor.jump()
+            else:
+                cursor.jump(start)
+            count = 0
+            while limit is None or count < limit:
+                key = cursor.get_key(True)
+                if key is None or stop is not None and key >= stop:
+                    break
+                yield key
+                count += 1
+        finally:
+            cursor.disable()
+
+    def _iteritems(self):
+        """
+        yield (key, value) for all keys, in one cursor pass
+        """
+        cursor = self._db.cursor()
+        try:
+            cursor.jump()
+            while True:
+                record = cursor.get(True)
+                if record is None:
+                    break
+                yield record
+        finally:
+            cursor.disable()
+
     def __delitem__(self, key):
         self._db.remove(key)
 
+    def delete_many(self, keys):
+        if self._db.remove_bulk(list(keys)) < 0:
+            raise KeyError("remove_bulk error: " + str(self._db.error()))
+
+    def _get_many(self, keys):
+        values = self._db.get_bulk(list(keys))
+        if values is None:
+            raise KeyError("get_bulk error: " + str(self._db.error()))
+        return values
+
+    def _set_many(self, items):
+        if self._db.set_bulk(dict(items)) < 0:
+            raise KeyError("set_bulk error: " + str(self._db.error()))
+
 
 class BytesStore(_Store, BytesMutableStoreBase):
     def __getitem__(self, key):
@@ -88,6 +145,17 @@ class BytesStore(_Store, BytesMutableStoreBase):
         if not self._db.set(key, value):
             raise KeyError("set error: " + str(self._db.error()))
 
+    def iteritems(self):
+        return self._iteritems()
+
+    def get_many(self, keys):
+        return self._get_many(keys)
+
+    def set_many(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        self._set_many(items)
+
 
 class FileStore(_Store, FileMutableStoreBase):
     def __getitem__(self, key):
@@ -100,3 +168,15 @@ class FileStore(_Store, FileMutableStoreBase):
         if not self._db.set(key, stream.read()):
             raise KeyError("set error: " + str(self._db.error()))
 
+    def iteritems(self):
+        for key, value in self._iteritems():
+            yield key, StringIO(value)
+
+    def get_many(self, keys):
+        values = self._get_many(keys)
+        return dict((key, StringIO(value)) for key, value in values.iteritems())
+
+    def set_many(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        self._set_many((key, stream.read()) for key, stream in items)
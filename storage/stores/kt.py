@@ -6,6 +6,11 @@ MoinMoin - kyoto tycoon store
 
 Stores k/v pairs into a Kyoto Tycoon server. Kyoto Tycoon is a network server
 for kyoto cabinet, remote or multi-process usage is possible).
+
+A HTTPConnection can only handle one request at a time, so every thread uses
+its own connection to the server. The a* methods run in a pool of
+max_connections threads owned by the store, so up to that many requests can be
+in flight concurrently.
 """
 
 
@@ -13,10 +18,15 @@ from __future__ import absolute_import, division
 
 import time
 import urllib
+import base64
+import quopri
+import threading
 from httplib import HTTPConnection
 
 from StringIO import StringIO
 
+from storage._util import Executor, slice_range
+
 from . import MutableStoreBase, BytesMutableStoreBase, FileMutableStoreBase
 
 
@@ -28,17 +38,23 @@ class _Store(MutableStoreBase):
     def from_uri(cls, uri):
         return cls(uri)
 
-    def __init__(self, host='127.0.0.1', port=1978, timeout=30):
+    def __init__(self, host='127.0.0.1', port=1978, timeout=30, max_connections=16):
         """
         Store params for .open().
 
         :param host: Tycoon server, host (default: '127.0.0.1')
         :param port: Tycoon server, port (default: 1978)
         :param timeout: timeout [s] (default: 30)
+        :param max_connections: max. concurrent connections used by the a* methods (default: 16)
         """
         self.host = host
         self.port = port
         self.timeout = timeout
+        self.max_connections = max_connections
+        self._local = threading.local()
+        self._clients = []
+        self._lock = threading.Lock()
+        self._async_executor = None
 
     def create(self):
         self.open()
@@ -51,10 +67,35 @@ class _Store(MutableStoreBase):
         self.close()
 
     def open(self):
-        self.client = HTTPConnection(self.host, self.port, False, self.timeout)
+        self._local = threading.local()
+        self._clients = []
 
     def close(self):
-        self.client.close()
+        with self._lock:
+            executor, self._async_executor = self._async_executor, None
+            clients, self._clients = self._clients, []
+        if executor is not None:
+            executor.shutdown()
+        for client in clients:
+            client.close()
+
+    @property
+    def client(self):
+        """
+        the connection of the current thread
+        """
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = HTTPConnection(self.host, self.port, False, self.timeout)
+            with self._lock:
+                self._clients.append(client)
+        return client
+
+    def _executor(self):
+        with self._lock:
+            if self._async_executor is None:
+                self._async_executor = Executor(workers=self.max_connections)
+            return self._async_executor
 
     def _rpc(self, method, **kw):
         # note: we use rpc for some stuff that is not possible with restful interface
@@ -70,6 +111,49 @@ class _Store(MutableStoreBase):
         status = response.status
         return status, result
 
+    def _rpc_bulk(self, method, records):
+        """
+        call a *_bulk rpc method, giving it many records in a POST request
+
+        :param records: list of (name, value) pairs, for key records the name
+                        must be prefixed by '_' (see kyoto tycoon docs)
+        :returns: status, dict name -> value (raw bytes, names are decoded, too)
+        """
+        def encode(s):
+            if isinstance(s, unicode):
+                s = s.encode('utf-8')
+            return base64.b64encode(s)
+        body = ''.join('%s\t%s\n' % (encode(name), encode(value)) for name, value in records)
+        headers = {'Content-Type': 'text/tab-separated-values; colenc=B'}
+        self.client.request("POST", '/rpc/%s' % method, body, headers)
+        response = self.client.getresponse()
+        body = response.read()
+        # the server may encode the columns of the result, it tells us how:
+        content_type = response.getheader('Content-Type', '')
+        colenc = content_type.partition('colenc=')[2][:1]
+        decode = dict(B=base64.b64decode, Q=quopri.decodestring, U=urllib.unquote).get(colenc, str)
+        result = {}
+        for line in body.split('\n'):
+            line = line.rstrip('\r')
+            if line:
+                name, value = line.split('\t', 1)
+                result[decode(name)] = decode(value)
+        return response.status, result
+
+    def _get_many(self, keys):
+        status, result = self._rpc_bulk('get_bulk', [('_' + key, '') for key in keys])
+        assert status == 200
+        # key records come back with a '_' prefix, other records are e.g. 'num'
+        return dict((name[1:], value) for name, value in result.items() if name.startswith('_'))
+
+    def _set_many(self, items):
+        status, _ = self._rpc_bulk('set_bulk', [('_' + key, value) for key, value in items])
+        assert status == 200
+
+    def delete_many(self, keys):
+        status, _ = self._rpc_bulk('remove_bulk', [('_' + key, '') for key in keys])
+        assert status == 200
+
     def _clear(self, DB=None):
         status, result = self._rpc('clear', DB=DB)
         assert status == 200
@@ -87,6 +171,25 @@ class _Store(MutableStoreBase):
         status, _ = self._rpc('remove', DB=None, key=key)
         assert status == 200
 
+    def get_range(self, key, offset, length=None):
+        if length == 0:
+            return ''
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        end = '' if length is None else '%d' % (offset + length - 1)
+        headers = {'Range': 'bytes=%d-%s' % (offset, end)}
+        self.client.request("GET", "/" + urllib.quote(key), None, headers)
+        response = self.client.getresponse()
+        body = response.read()
+        if response.status == 206:
+            return body
+        if response.status == 200:
+            # server ignored the range
+            return slice_range(body, offset, length)
+        if response.status == 416:
+            return '' # offset is beyond the end
+        raise KeyError(key)
+
 
 class BytesStore(_Store, BytesMutableStoreBase):
     def __getitem__(self, key):
@@ -98,6 +201,14 @@ class BytesStore(_Store, BytesMutableStoreBase):
     def __setitem__(self, key, value):
         self.set(key, value)
 
+    def get_many(self, keys):
+        return self._get_many(keys)
+
+    def set_many(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        self._set_many(items)
+
     def get(self, key):
         if isinstance(key, unicode):
             key = key.encode("utf-8")
@@ -133,6 +244,14 @@ class FileStore(_Store, FileMutableStoreBase):
     def __setitem__(self, key, stream):
         self.set(key, stream)
 
+    def get_many(self, keys):
+        return dict((key, StringIO(value)) for key, value in self._get_many(keys).items())
+
+    def set_many(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        self._set_many((key, stream.read()) for key, stream in items)
+
     def get(self, key):
         if isinstance(key, unicode):
             key = key.encode("utf-8")
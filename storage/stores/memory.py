@@ -35,12 +35,17 @@ class _Store(MutableStoreBase):
         self._st = None
 
     def __iter__(self):
-        for key in self._st:
+        # iterate over a copy, so the store may be modified meanwhile
+        for key in list(self._st):
             yield key
 
     def __delitem__(self, key):
         del self._st[key]
 
+    def _iteritems(self):
+        # iterate over a copy, so the store may be modified meanwhile
+        return self._st.items()
+
 
 class BytesStore(_Store, BytesMutableStoreBase):
     def __getitem__(self, key):
@@ -49,6 +54,9 @@ class BytesStore(_Store, BytesMutableStoreBase):
     def __setitem__(self, key, value):
         self._st[key] = value
 
+    def iteritems(self):
+        return iter(self._iteritems())
+
 
 class FileStore(_Store, FileMutableStoreBase):
     def __getitem__(self, key):
@@ -57,3 +65,7 @@ class FileStore(_Store, FileMutableStoreBase):
     def __setitem__(self, key, stream):
         self._st[key] = stream.read()
 
+    def iteritems(self):
+        for key, value in self._iteritems():
+            yield key, StringIO(value)
+
@@ -5,6 +5,10 @@
 MoinMoin - sqlalchemy store
 
 Stores k/v pairs into any database supported by sqlalchemy.
+
+Optionally, values can be projected into additional (indexed) columns, so
+they can be queried without reading and decoding all values, see query and
+query_latest. The stores backend has a projector for metadata.
 """
 
 
@@ -12,35 +16,54 @@ from __future__ import absolute_import, division
 
 from StringIO import StringIO
 
-from sqlalchemy import create_engine, select, MetaData, Table, Column, String, Binary
+from sqlalchemy import create_engine, select, and_, func, MetaData, Table, Column, String, Unicode, Integer, \
+                       Binary
 from sqlalchemy.pool import StaticPool
 
 from . import MutableStoreBase, BytesMutableStoreBase, FileMutableStoreBase
 
 KEY_LEN = 128
 VALUE_LEN = 1024 * 1024 # 1MB binary data
+BATCH_SIZE = 500 # max. number of keys we put into one sql statement
+TEXT_COLUMN_LEN = 255
+
+COLUMN_TYPES = {'text': lambda: Unicode(TEXT_COLUMN_LEN), 'integer': Integer}
 
 
 class _Store(MutableStoreBase):
     """
     A simple dict-based in-memory store. No persistence!
     """
+    ordered = True # keys are the primary key, so there is an index
+
     @classmethod
     def from_uri(cls, uri):
         return cls(uri)
 
-    def __init__(self, db_uri=None, table_name='store', verbose=False):
+    def __init__(self, db_uri=None, table_name='store', verbose=False, columns=None, projector=None):
         """
         :param db_uri: The database uri that we pass on to SQLAlchemy.
                        May contain user/password/host/port/etc.
         :param verbose: Verbosity setting. If set to True this will print all SQL queries
                         to the console.
+        :param columns: list of (name, type) of additional indexed columns
+                        (type is 'text' or 'integer'), must be the same as
+                        when the store was created
+        :param projector: callable, value -> dict with the column values
         """
         self.db_uri = db_uri
         self.verbose = verbose
         self.engine = None
         self.table = None
         self.table_name = table_name
+        self.columns = columns or []
+        for name, type_ in self.columns:
+            if name in ('key', 'value') or type_ not in COLUMN_TYPES:
+                raise ValueError("invalid column %r" % ((name, type_), ))
+        if self.columns and projector is None:
+            raise ValueError("columns need a projector")
+        self.projector = projector
+        self.column_names = [name for name, type_ in self.columns]
 
     def open(self):
         db_uri = self.db_uri
@@ -57,6 +80,7 @@ class _Store(MutableStoreBase):
         self.table = Table(self.table_name, metadata,
                            Column('key', String(KEY_LEN), primary_key=True),
                            Column('value', Binary(VALUE_LEN)),
+                           *[Column(name, COLUMN_TYPES[type_](), index=True) for name, type_ in self.columns]
                           )
 
     def close(self):
@@ -78,9 +102,122 @@ class _Store(MutableStoreBase):
         for row in rows:
             yield row[0]
 
+    def __contains__(self, key):
+        # keys only, do not fetch the value
+        return select([self.table.c.key], self.table.c.key == key).execute().fetchone() is not None
+
+    def iter_range(self, start=None, stop=None, limit=None):
+        key = self.table.c.key
+        conditions = []
+        if start is not None:
+            conditions.append(key >= start)
+        if stop is not None:
+            conditions.append(key < stop)
+        query = select([key]).order_by(key)
+        if conditions:
+            query = query.where(and_(*conditions))
+        if limit is not None:
+            query = query.limit(limit)
+        for row in query.execute():
+            yield row[0]
+
+    def _column(self, name, table=None):
+        if name not in self.column_names:
+            raise ValueError("no such column: %s" % name)
+        return (table if table is not None else self.table).c[name]
+
+    def iter_column(self, name):
+        """
+        yield (key, column value) for all keys
+        """
+        column = self._column(name)
+        for row in select([self.table.c.key, column]).execute():
+            yield row[0], row[1]
+
+    def query(self, order_by=None, **conditions):
+        """
+        yield the keys where the columns have the given values
+
+        :param order_by: column to sort by (ascending)
+        :param conditions: column name -> value
+        """
+        query = select([self.table.c.key])
+        if conditions:
+            query = query.where(and_(*[self._column(name) == value for name, value in conditions.items()]))
+        if order_by is not None:
+            query = query.order_by(self._column(order_by), self.table.c.key)
+        for row in query.execute():
+            yield row[0]
+
+    def query_latest(self, group_by, order_by):
+        """
+        yield (group value, key) of the row with the highest order_by value
+        for every value of the group_by column (e.g. latest revision per item)
+        """
+        a, b = self.table.alias('a'), self.table.alias('b')
+        latest = select([func.max(self._column(order_by, b))], self._column(group_by, b) == a.c[group_by])
+        query = select([a.c[group_by], a.c.key], a.c[order_by] == latest.as_scalar())
+        query = query.order_by(a.c[group_by], a.c.key)
+        last = None
+        for row in query.execute():
+            if row[0] != last: # same order_by value (e.g. mtime) for multiple rows: first key wins
+                last = row[0]
+                yield row[0], row[1]
+
+    def _row(self, key, value):
+        """
+        return the column values dict to insert
+        """
+        row = dict(key=key, value=value)
+        if self.columns:
+            projected = self.projector(value)
+            row.update((name, projected.get(name)) for name in self.column_names)
+        return row
+
     def __delitem__(self, key):
         self.table.delete().where(self.table.c.key == key).execute()
 
+    def delete_many(self, keys):
+        keys = list(keys)
+        for i in xrange(0, len(keys), BATCH_SIZE):
+            self.table.delete().where(self.table.c.key.in_(keys[i:i+BATCH_SIZE])).execute()
+
+    def get_range(self, key, offset, length=None):
+        # let the database cut out the part we want
+        args = [self.table.c.value, offset + 1]
+        if length is not None:
+            args.append(length)
+        row = select([func.substr(*args, type_=Binary)], self.table.c.key == key).execute().fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def _iteritems(self):
+        """
+        yield (key, value) for all keys, in one table scan
+        """
+        for row in select([self.table.c.key, self.table.c.value]).execute():
+            yield row[0], row[1]
+
+    def _get_many(self, keys):
+        """
+        yield (key, value) for all present keys, fetching BATCH_SIZE keys per query
+        """
+        keys = list(keys)
+        for i in xrange(0, len(keys), BATCH_SIZE):
+            rows = select([self.table.c.key, self.table.c.value],
+                          self.table.c.key.in_(keys[i:i+BATCH_SIZE])).execute().fetchall()
+            for row in rows:
+                yield row[0], row[1]
+
+    def _set_many(self, items):
+        """
+        store many (key, bytestring) pairs with a single executemany insert
+        """
+        rows = [self._row(key, value) for key, value in items]
+        if rows:
+            self.table.insert().execute(rows)
+
 
 class BytesStore(_Store, BytesMutableStoreBase):
     def __getitem__(self, key):
@@ -91,7 +228,18 @@ class BytesStore(_Store, BytesMutableStoreBase):
             raise KeyError(key)
 
     def __setitem__(self, key, value):
-        self.table.insert().execute(key=key, value=value)
+        self.table.insert().execute(self._row(key, value))
+
+    def iteritems(self):
+        return self._iteritems()
+
+    def get_many(self, keys):
+        return dict(self._get_many(keys))
+
+    def set_many(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        self._set_many(items)
 
 
 class FileStore(_Store, FileMutableStoreBase):
@@ -103,5 +251,16 @@ class FileStore(_Store, FileMutableStoreBase):
             raise KeyError(key)
 
     def __setitem__(self, key, stream):
-        self.table.insert().execute(key=key, value=stream.read())
+        self.table.insert().execute(self._row(key, stream.read()))
+
+    def iteritems(self):
+        for key, value in self._iteritems():
+            yield key, StringIO(value)
+
+    def get_many(self, keys):
+        return dict((key, StringIO(value)) for key, value in self._get_many(keys))
 
+    def set_many(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        self._set_many((key, stream.read()) for key, stream in items)
@@ -8,47 +8,94 @@ This store stores into sqlite3 table, using a single db file in the filesystem.
 You can use the same db file for multiple stores, just using a different table
 name.
 
-Optionally, you can use zlib/"gzip" compression.
+Optionally, you can use zlib/"gzip" compression. Note that this compresses
+every value, see the Compressing*Store wrappers for content-aware compression.
+get_range only reads the requested part of uncompressed values.
+
+A sqlite3 connection may only be used by the thread that created it, so every
+thread gets its own connection (thus an in-memory db, ':memory:', is not
+supported: every thread would see a different, empty db). The a* methods run in a single dedicated
+thread (writes to a sqlite db are serialized anyway, using more threads would
+just make them wait for the db lock).
+
+Optionally, values can be projected into additional (indexed) columns, so
+they can be queried without reading and decoding all values, see query and
+query_latest. The stores backend has a projector for metadata.
 """
 
 
 from __future__ import absolute_import, division
 
 from StringIO import StringIO
+import re
+import threading
 import zlib
 from sqlite3 import *
 
+from storage._util import Executor, slice_range
+
 from . import MutableStoreBase, BytesMutableStoreBase, FileMutableStoreBase
 
+# max. number of keys we put into one sql statement
+# (sqlite has a limit of 999 host parameters per statement)
+BATCH_SIZE = 500
+
+COLUMN_TYPES = {'text': 'text', 'integer': 'integer'}
+
+COLUMN_NAME_RE = re.compile(r'^[a-z_]+$')
+
 
 class _Store(MutableStoreBase):
     """
     A simple sqlite3 based store.
     """
+    ordered = True # keys are the primary key, so there is an index
+
     @classmethod
     def from_uri(cls, uri):
         return cls(uri)
 
-    def __init__(self, db_name, table_name='store', compression_level=0):
+    def __init__(self, db_name, table_name='store', compression_level=0, columns=None, projector=None):
         """
         Just store the params.
 
-        :param db_name: database (file)name
+        :param db_name: database (file)name (not ':memory:', see module docstring)
         :param table_name: table to use for this store (we only touch this table)
         :param compression_level: zlib compression level
                                   0 = no compr, 1 = fast/small, ..., 9 = slow/smaller
                                   we recommend 0 for low cpu usage, 1 for low disk space usage
                                   high compression levels don't give much better compression,
                                   but use lots of cpu (e.g. 6 is about 2x more cpu than 1).
+        :param columns: list of (name, type) of additional indexed columns
+                        (type is 'text' or 'integer'), must be the same as
+                        when the store was created
+        :param projector: callable, value -> dict with the column values
         """
+        if db_name == ':memory:':
+            raise ValueError("in-memory sqlite dbs are not supported (every thread would get its own db)")
         self.db_name = db_name
         self.table_name = table_name
         self.compression_level = compression_level
+        self.columns = columns or []
+        for name, type_ in self.columns:
+            if not COLUMN_NAME_RE.match(name) or name in ('key', 'value') or type_ not in COLUMN_TYPES:
+                raise ValueError("invalid column %r" % ((name, type_), ))
+        if self.columns and projector is None:
+            raise ValueError("columns need a projector")
+        self.projector = projector
+        self.column_names = [name for name, type_ in self.columns]
+        self._local = threading.local()
+        self._conns = []
+        self._lock = threading.Lock()
+        self._async_executor = None
 
     def create(self):
         conn = connect(self.db_name)
+        columns = ''.join(', %s %s' % (name, COLUMN_TYPES[type_]) for name, type_ in self.columns)
         with conn:
-            conn.execute('create table %s (key text primary key, value blob)' % self.table_name)
+            conn.execute('create table %s (key text primary key, value blob%s)' % (self.table_name, columns))
+            for name in self.column_names:
+                conn.execute('create index %s_%s on %s (%s)' % (self.table_name, name, self.table_name, name))
 
     def destroy(self):
         conn = connect(self.db_name)
@@ -56,20 +103,176 @@ class _Store(MutableStoreBase):
             conn.execute('drop table %s' % self.table_name)
 
     def open(self):
-        self.conn = connect(self.db_name)
-        self.conn.row_factory = Row # make column access by ['colname'] possible
+        self._local = threading.local()
+        self.conn # connect now, so we notice problems early
 
     def close(self):
-        pass
+        with self._lock:
+            executor, self._async_executor = self._async_executor, None
+            conns, self._conns = self._conns, []
+        if executor is not None:
+            executor.shutdown()
+        self._local = threading.local()
+        for conn in conns:
+            conn.close()
+
+    @property
+    def conn(self):
+        """
+        the db connection of the current thread
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # only used by this thread, but close() may close it from another one
+            conn = self._local.conn = connect(self.db_name, check_same_thread=False)
+            conn.row_factory = Row # make column access by ['colname'] possible
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def _executor(self):
+        with self._lock:
+            if self._async_executor is None:
+                self._async_executor = Executor(workers=1)
+            return self._async_executor
 
     def __iter__(self):
         for row in self.conn.execute("select key from %s" % self.table_name):
             yield row['key']
 
+    def __contains__(self, key):
+        # keys only, do not fetch the value
+        rows = list(self.conn.execute("select 1 from %s where key=?" % self.table_name, (key, )))
+        return bool(rows)
+
+    def iter_range(self, start=None, stop=None, limit=None):
+        conditions, args = [], []
+        if start is not None:
+            conditions.append('key >= ?')
+            args.append(start)
+        if stop is not None:
+            conditions.append('key < ?')
+            args.append(stop)
+        query = 'select key from %s' % self.table_name
+        if conditions:
+            query += ' where ' + ' and '.join(conditions)
+        query += ' order by key'
+        if limit is not None:
+            query += ' limit ?'
+            args.append(limit)
+        for row in self.conn.execute(query, args):
+            yield row['key']
+
+    def _check_columns(self, *names):
+        for name in names:
+            if name not in self.column_names:
+                raise ValueError("no such column: %s" % name)
+
+    def iter_column(self, name):
+        """
+        yield (key, column value) for all keys
+        """
+        self._check_columns(name)
+        for row in self.conn.execute("select key, %s from %s" % (name, self.table_name)):
+            yield row[0], row[1]
+
+    def query(self, order_by=None, **conditions):
+        """
+        yield the keys where the columns have the given values
+
+        :param order_by: column to sort by (ascending)
+        :param conditions: column name -> value
+        """
+        self._check_columns(*conditions)
+        query = 'select key from %s' % self.table_name
+        if conditions:
+            query += ' where ' + ' and '.join('%s=?' % name for name in conditions)
+        if order_by is not None:
+            self._check_columns(order_by)
+            query += ' order by %s, key' % order_by
+        for row in self.conn.execute(query, conditions.values()):
+            yield row['key']
+
+    def query_latest(self, group_by, order_by):
+        """
+        yield (group value, key) of the row with the highest order_by value
+        for every value of the group_by column (e.g. latest revision per item)
+        """
+        self._check_columns(group_by, order_by)
+        query = ('select a.%(g)s, a.key from %(t)s a where a.%(o)s = '
+                 '(select max(b.%(o)s) from %(t)s b where b.%(g)s = a.%(g)s) '
+                 'order by a.%(g)s, a.key' % dict(g=group_by, o=order_by, t=self.table_name))
+        last = None
+        for row in self.conn.execute(query):
+            if row[0] != last: # same order_by value (e.g. mtime) for multiple rows: first key wins
+                last = row[0]
+                yield row[0], row[1]
+
+    def _insert_statement(self):
+        names = ['key', 'value'] + self.column_names
+        return 'insert into %s (%s) values (%s)' % (self.table_name, ', '.join(names), ', '.join('?' * len(names)))
+
+    def _insert_row(self, key, value):
+        """
+        return the values for _insert_statement
+        """
+        row = [key, buffer(self._compress(value))]
+        if self.columns:
+            projected = self.projector(value)
+            row.extend(projected.get(name) for name in self.column_names)
+        return row
+
     def __delitem__(self, key):
         with self.conn:
             self.conn.execute('delete from %s where key=?' % self.table_name, (key, ))
 
+    def delete_many(self, keys):
+        with self.conn:
+            self.conn.executemany('delete from %s where key=?' % self.table_name,
+                                  [(key, ) for key in keys])
+
+    def get_range(self, key, offset, length=None):
+        # uncompressed values: let sqlite cut out the part we want
+        # (the stored value is "{{{GZ<level>|" + data + "}}}", see _compress)
+        query = ("select substr(value, 1, 7) as header, length(value) - 10 as size, "
+                 "substr(value, 8 + ?, coalesce(?, length(value))) as part from %s where key=?" % self.table_name)
+        rows = list(self.conn.execute(query, (offset, length, key)))
+        if not rows:
+            raise KeyError(key)
+        row = rows[0]
+        if str(row['header']) != "{{{GZ0|":
+            # compressed, we need the whole value
+            for key, value in self._get_many([key]):
+                return slice_range(value, offset, length)
+            raise KeyError(key)
+        # cut off the end marker
+        return str(row['part'])[:max(row['size'] - offset, 0)]
+
+    def _iteritems(self):
+        """
+        yield (key, value) for all keys, in one table scan
+        """
+        for row in self.conn.execute("select key, value from %s" % self.table_name):
+            yield row['key'], self._decompress(str(row['value']))
+
+    def _get_many(self, keys):
+        """
+        yield (key, value) for all present keys, fetching BATCH_SIZE keys per query
+        """
+        keys = list(keys)
+        for i in xrange(0, len(keys), BATCH_SIZE):
+            batch = keys[i:i+BATCH_SIZE]
+            query = "select key, value from %s where key in (%s)" % (self.table_name, ','.join('?' * len(batch)))
+            for row in self.conn.execute(query, batch):
+                yield row['key'], self._decompress(str(row['value']))
+
+    def _set_many(self, items):
+        """
+        store many (key, bytestring) pairs in a single transaction
+        """
+        with self.conn:
+            self.conn.executemany(self._insert_statement(), (self._insert_row(key, value) for key, value in items))
+
     def _compress(self, value):
         if self.compression_level:
             value = zlib.compress(value, self.compression_level)
@@ -96,9 +299,19 @@ class BytesStore(_Store, BytesMutableStoreBase):
         return self._decompress(value)
 
     def __setitem__(self, key, value):
-        value = self._compress(value)
         with self.conn:
-            self.conn.execute('insert into %s values (?, ?)' % self.table_name, (key, buffer(value)))
+            self.conn.execute(self._insert_statement(), self._insert_row(key, value))
+
+    def iteritems(self):
+        return self._iteritems()
+
+    def get_many(self, keys):
+        return dict(self._get_many(keys))
+
+    def set_many(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        self._set_many(items)
 
 
 class FileStore(_Store, FileMutableStoreBase):
@@ -111,7 +324,17 @@ class FileStore(_Store, FileMutableStoreBase):
 
     def __setitem__(self, key, stream):
         value = stream.read()
-        value = self._compress(value)
         with self.conn:
-            self.conn.execute('insert into %s values (?, ?)' % self.table_name, (key, buffer(value)))
+            self.conn.execute(self._insert_statement(), self._insert_row(key, value))
+
+    def iteritems(self):
+        for key, value in self._iteritems():
+            yield key, StringIO(value)
+
+    def get_many(self, keys):
+        return dict((key, StringIO(value)) for key, value in self._get_many(keys))
 
+    def set_many(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        self._set_many((key, stream.read()) for key, stream in items)
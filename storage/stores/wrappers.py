@@ -8,9 +8,15 @@ MoinMoin - store wrappers
 
 from __future__ import absolute_import, division
 
+import zlib
+import struct
 from io import BytesIO
 from collections import MutableMapping
 
+from storage._util import slice_range
+
+from . import MutableStoreBase, BytesMutableStoreBase, FileMutableStoreBase
+
 
 class ByteToStreamWrappingStore(MutableMapping):
     def __init__(self, stream_store):
@@ -36,3 +42,534 @@ class ByteToStreamWrappingStore(MutableMapping):
     def __len__(self):
         return len(self._st)
 
+
+# values we store via the compressing stores start with MAGIC + codec byte
+MAGIC = '\x00CZ'
+CODEC_STORED, CODEC_ZLIB = 'n', 'z'
+HEADER_LEN = len(MAGIC) + 1
+
+BLOCKSIZE = 64 * 1024
+SAMPLE_SIZE = 64 * 1024 # we look at that much data to decide about compression
+TRIAL_SIZE = 16 * 1024 # we trial-compress that much data to estimate compressibility
+
+# start of already compressed file formats (compressing them again is pointless)
+COMPRESSED_MAGICS = (
+    '\x89PNG', '\xff\xd8\xff', 'GIF8', # png, jpeg, gif
+    'PK\x03\x04', '\x1f\x8b', 'BZh', '\xfd7zXZ\x00', '7z\xbc\xaf\x27\x1c', 'Rar!', # archives
+    'OggS', 'ID3', 'fLaC', '\x1a\x45\xdf\xa3', # ogg, mp3, flac, matroska / webm
+)
+
+
+def is_compressed_format(head):
+    """
+    check the first bytes of some data whether it is a known compressed format
+    """
+    return (head.startswith(COMPRESSED_MAGICS) or
+            head[4:8] == 'ftyp' or # mp4, mov, ...
+            head.startswith('RIFF') and head[8:12] in ('WEBP', 'AVI ', ))
+
+
+class _CompressingReader(object):
+    """
+    file-like, reads from stream and returns the encoded (header + maybe
+    compressed) data. Memory usage is bounded, no matter how big stream is.
+    """
+    def __init__(self, stream, head, level):
+        """
+        :param stream: the file to read the remaining data from
+        :param head: data already read from stream
+        :param level: zlib compression level (0 = store uncompressed)
+        """
+        self._stream = stream
+        self._compressor = level and zlib.compressobj(level) or None
+        codec = CODEC_ZLIB if self._compressor else CODEC_STORED
+        self._buf = MAGIC + codec + self._encode(head)
+        self._eof = False
+
+    def _encode(self, data):
+        if self._compressor is None:
+            return data
+        return self._compressor.compress(data)
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or len(self._buf) < size):
+            block = self._stream.read(BLOCKSIZE)
+            if block:
+                self._buf += self._encode(block)
+            else:
+                if self._compressor is not None:
+                    self._buf += self._compressor.flush()
+                self._eof = True
+        if size is None or size < 0:
+            data, self._buf = self._buf, ''
+        else:
+            data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+
+class _DecompressingFile(object):
+    """
+    file-like, reads encoded data from a file of the wrapped store and
+    returns the decoded data. Memory usage is bounded (when reading with
+    a size), seeking backwards means reading again from the start.
+    """
+    def __init__(self, opener, f=None):
+        """
+        :param opener: callable returning the wrapped store's file for our key
+        :param f: an already opened file from opener (optional)
+        """
+        self._opener = opener
+        self._open(f)
+        self.closed = False
+
+    def _open(self, f=None):
+        self._f = f if f is not None else self._opener()
+        self._pos = 0
+        self._eof = False
+        self._decompressor = None
+        header = self._f.read(HEADER_LEN)
+        if header.startswith(MAGIC):
+            self._buf = ''
+            if header[-1] == CODEC_ZLIB:
+                self._decompressor = zlib.decompressobj()
+        else:
+            # not written by us, use as is
+            self._buf = header
+
+    def _fill(self, size):
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            if self._decompressor is None:
+                block = self._f.read(BLOCKSIZE)
+                if block:
+                    self._buf += block
+                else:
+                    self._eof = True
+            else:
+                block = self._decompressor.unconsumed_tail or self._f.read(BLOCKSIZE)
+                if block:
+                    self._buf += self._decompressor.decompress(block, BLOCKSIZE)
+                else:
+                    self._buf += self._decompressor.flush()
+                    self._eof = True
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if size is None:
+            size = -1
+        self._fill(size)
+        if size < 0:
+            data, self._buf = self._buf, ''
+        else:
+            data, self._buf = self._buf[:size], self._buf[size:]
+        self._pos += len(data)
+        return data
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence != 0:
+            raise IOError("only seeking relative to start or current position is supported")
+        if offset < self._pos:
+            self._f.close()
+            self._open()
+        while self._pos < offset:
+            if not self.read(min(offset - self._pos, BLOCKSIZE)):
+                break
+
+    def close(self):
+        if not self.closed:
+            self._f.close()
+            self.closed = True
+
+
+class _CompressingStore(MutableStoreBase):
+    """
+    Wraps a store and transparently compresses the values stored into it.
+
+    For every value, we decide whether and how hard to compress it:
+
+    - small values and already compressed formats (detected by their magic
+      bytes, e.g. PNG, JPEG, ZIP) are stored uncompressed
+    - otherwise we trial-compress a sample and only compress if this saves
+      enough space, values that compress only a bit use the fastest level
+
+    Values not written by us (no header) are returned as they are, so an
+    existing store can be wrapped.
+    """
+    def __init__(self, store, level=6, min_size=256):
+        """
+        :param store: the store to wrap
+        :param level: zlib level used for well-compressible values
+        :param min_size: values smaller than this are stored uncompressed
+        """
+        self._st = store
+        self.level = level
+        self.min_size = min_size
+
+    def _choose_level(self, head):
+        """
+        choose a zlib compression level (0 = no compression) for data starting with head
+        """
+        if len(head) < self.min_size or is_compressed_format(head):
+            return 0
+        trial = head[:TRIAL_SIZE]
+        ratio = len(zlib.compress(trial, 1)) / len(trial)
+        if ratio > 0.9:
+            return 0 # incompressible (random, encrypted, compressed, ...)
+        if ratio > 0.5:
+            return 1 # compressing harder would just burn cpu
+        return self.level
+
+    @property
+    def ordered(self):
+        return self._st.ordered
+
+    def open(self):
+        self._st.open()
+
+    def close(self):
+        self._st.close()
+
+    def create(self):
+        self._st.create()
+
+    def destroy(self):
+        self._st.destroy()
+
+    def __iter__(self):
+        return iter(self._st)
+
+    def __len__(self):
+        return len(self._st)
+
+    def iter_range(self, start=None, stop=None, limit=None):
+        return self._st.iter_range(start, stop, limit)
+
+    def __delitem__(self, key):
+        del self._st[key]
+
+    def delete_many(self, keys):
+        self._st.delete_many(keys)
+
+    def get_range(self, key, offset, length=None):
+        header = self._st.get_range(key, 0, HEADER_LEN)
+        if header == MAGIC + CODEC_STORED:
+            # uncompressed, the wrapped store can read just that part
+            return self._st.get_range(key, HEADER_LEN + offset, length)
+        if not header.startswith(MAGIC):
+            return self._st.get_range(key, offset, length) # not written by us
+        # compressed, decode from the start
+        return super(_CompressingStore, self).get_range(key, offset, length)
+
+
+class CompressingBytesStore(_CompressingStore, BytesMutableStoreBase):
+    """
+    compression wrapper for a bytes store
+    """
+    def _encode(self, value):
+        level = self._choose_level(value[:SAMPLE_SIZE])
+        if level:
+            return MAGIC + CODEC_ZLIB + zlib.compress(value, level)
+        return MAGIC + CODEC_STORED + value
+
+    def _decode(self, value):
+        if not value.startswith(MAGIC):
+            return value
+        if value[HEADER_LEN-1] == CODEC_ZLIB:
+            return zlib.decompress(value[HEADER_LEN:])
+        return value[HEADER_LEN:]
+
+    def __getitem__(self, key):
+        return self._decode(self._st[key])
+
+    def __setitem__(self, key, value):
+        self._st[key] = self._encode(value)
+
+    def get_many(self, keys):
+        return dict((key, self._decode(value)) for key, value in self._st.get_many(keys).iteritems())
+
+    def set_many(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        self._st.set_many((key, self._encode(value)) for key, value in items)
+
+
+class CompressingFileStore(_CompressingStore, FileMutableStoreBase):
+    """
+    compression wrapper for a file store (streaming, memory usage is bounded)
+    """
+    def __getitem__(self, key):
+        f = self._st[key]
+        return _DecompressingFile(lambda: self._st[key], f)
+
+    def __setitem__(self, key, stream):
+        head = stream.read(SAMPLE_SIZE)
+        self._st[key] = _CompressingReader(stream, head, self._choose_level(head))
+
+
+# values we store via DictCompressingBytesStore start with DICT_MAGIC + dictionary id
+DICT_MAGIC = '\x00CD'
+DICT_HEADER_LEN = len(DICT_MAGIC) + 2
+DICT_SIZE = 32 * 1024 # zlib can't make use of a bigger dictionary (window size)
+# dict store key prefix for values being replaced by DictCompressingBytesStore.recompress
+PENDING_PREFIX = 'pending.'
+
+
+def build_dictionary(samples, size=DICT_SIZE, k=8, segment_size=64):
+    """
+    build a zlib preset dictionary from some sample values
+
+    We count in how many samples each k-byte substring occurs and then greedily
+    pick the sample segments covering the most frequent substrings (not yet
+    covered by other picked segments). The best segments go to the end of the
+    dictionary, so the distances to them are shortest.
+
+    :param samples: list of bytestrings, typical values
+    :param size: max. dictionary size
+    :returns: dictionary (bytestring)
+    """
+    frequency = {}
+    for sample in samples:
+        for shingle in set(sample[i:i+k] for i in xrange(len(sample) - k + 1)):
+            frequency[shingle] = frequency.get(shingle, 0) + 1
+    segments = {}
+    for sample in samples:
+        for i in xrange(0, len(sample), segment_size):
+            segment = sample[i:i+segment_size]
+            if segment not in segments:
+                segments[segment] = set(segment[j:j+k] for j in xrange(len(segment) - k + 1))
+    score = lambda shingles: sum(frequency[shingle] for shingle in shingles)
+    covered = set()
+    chosen = []
+    total = 0
+    for segment in sorted(segments, key=lambda segment: score(segments[segment]), reverse=True):
+        if total + len(segment) > size:
+            continue
+        new_shingles = segments[segment] - covered
+        # only pick segments that still contribute substrings occurring in several samples
+        if score(new_shingles) <= len(new_shingles):
+            continue
+        chosen.append(segment)
+        covered |= new_shingles
+        total += len(segment)
+    chosen.reverse()
+    return ''.join(chosen)
+
+
+class _Dictionary(object):
+    """
+    zlib compression with a preset dictionary.
+
+    Python 2's zlib has no zdict support, but we can get the same effect:
+    we compress the dictionary once, sync-flush and then use copies of the
+    primed compressor / decompressor state for each value.
+    """
+    def __init__(self, data, level):
+        self._compressor = zlib.compressobj(level)
+        self._decompressor = zlib.decompressobj()
+        if data:
+            primer = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._decompressor.decompress(primer)
+
+    def compress(self, value):
+        compressor = self._compressor.copy()
+        return compressor.compress(value) + compressor.flush()
+
+    def decompress(self, value):
+        decompressor = self._decompressor.copy()
+        return decompressor.decompress(value) + decompressor.flush()
+
+
+class DictCompressingBytesStore(_CompressingStore, BytesMutableStoreBase):
+    """
+    compression wrapper for a bytes store with many small, similar values
+    (like revision metadata).
+
+    The values are compressed using a preset dictionary trained from existing
+    values, the dictionary id is stored in each value's header. Dictionaries
+    are kept in a separate bytes store (dict_store). Dictionary id 0 means
+    zlib without a dictionary (used until a dictionary was trained).
+
+    To rotate dictionaries, train() a new one (new values will use it), then
+    recompress() old values and prune() dictionaries not used any more.
+
+    While recompress() replaces a value, the new value is also kept in the
+    dict store, so if we crash between deleting and writing the value (not all
+    stores support overwriting), open() can finish the replacement.
+
+    If the wrapped store projects values into columns (see the sqlite and sqla
+    stores), its projector gets the plain value, not our compressed one, and
+    the column queries are passed through.
+    """
+    def __init__(self, store, dict_store, level=9):
+        """
+        :param store: the store to wrap
+        :param dict_store: bytes store for the dictionaries
+        :param level: zlib compression level
+        """
+        self._st = store
+        self._dict_store = dict_store
+        self.level = level
+        self._dicts = {}
+        self.current = 0
+        projector = getattr(store, 'projector', None)
+        if projector is not None:
+            store.projector = lambda raw: projector(self._decode(raw))
+
+    @property
+    def column_names(self):
+        return getattr(self._st, 'column_names', [])
+
+    def iter_column(self, name):
+        return self._st.iter_column(name)
+
+    def query(self, order_by=None, **conditions):
+        return self._st.query(order_by, **conditions)
+
+    def query_latest(self, group_by, order_by):
+        return self._st.query_latest(group_by, order_by)
+
+    def open(self):
+        self._st.open()
+        self._dict_store.open()
+        self._dicts = {0: _Dictionary('', self.level)}
+        for dict_id in self._dict_ids():
+            self._get_dict(dict_id)
+        self.current = max(self._dicts)
+        for key in list(self._dict_store):
+            if key.startswith(PENDING_PREFIX):
+                # interrupted recompress
+                self._finish_replace(key[len(PENDING_PREFIX):], self._dict_store[key])
+
+    def close(self):
+        self._st.close()
+        self._dict_store.close()
+
+    def create(self):
+        self._st.create()
+        self._dict_store.create()
+
+    def destroy(self):
+        self._st.destroy()
+        self._dict_store.destroy()
+
+    def _dict_ids(self):
+        """
+        yield the ids of the dictionaries in the dict store
+        """
+        for key in self._dict_store:
+            if not key.startswith(PENDING_PREFIX):
+                yield int(key)
+
+    def _get_dict(self, dict_id):
+        try:
+            return self._dicts[dict_id]
+        except KeyError:
+            # maybe trained by some other process
+            data = self._dict_store[str(dict_id)]
+            d = self._dicts[dict_id] = _Dictionary(data, self.level)
+            return d
+
+    def _dict_id(self, value):
+        if not value.startswith(DICT_MAGIC):
+            return None
+        return struct.unpack('!H', value[len(DICT_MAGIC):DICT_HEADER_LEN])[0]
+
+    def _encode(self, value):
+        header = DICT_MAGIC + struct.pack('!H', self.current)
+        return header + self._dicts[self.current].compress(value)
+
+    def _decode(self, value):
+        dict_id = self._dict_id(value)
+        if dict_id is None:
+            return value # not written by us
+        return self._get_dict(dict_id).decompress(value[DICT_HEADER_LEN:])
+
+    def __getitem__(self, key):
+        return self._decode(self._st[key])
+
+    def __setitem__(self, key, value):
+        self._st[key] = self._encode(value)
+
+    def get_range(self, key, offset, length=None):
+        # always compressed (and small)
+        return slice_range(self[key], offset, length)
+
+    def get_many(self, keys):
+        return dict((key, self._decode(value)) for key, value in self._st.get_many(keys).iteritems())
+
+    def set_many(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        self._st.set_many((key, self._encode(value)) for key, value in items)
+
+    def train(self, sample_count=1000, size=DICT_SIZE):
+        """
+        train a new dictionary from (up to) sample_count stored values and use
+        it for new values from now on.
+
+        :returns: id of the new dictionary
+        """
+        samples = []
+        for key in self._st:
+            if len(samples) >= sample_count:
+                break
+            samples.append(self[key])
+        data = build_dictionary(samples, size)
+        dict_id = max([self.current] + list(self._dict_ids())) + 1
+        if dict_id > 0xffff:
+            raise ValueError("no dictionary ids left, please recompress and rebuild the store")
+        self._dict_store[str(dict_id)] = data
+        self._dicts[dict_id] = _Dictionary(data, self.level)
+        self.current = dict_id
+        return dict_id
+
+    def recompress(self):
+        """
+        rewrite all values not compressed with the current dictionary
+
+        :returns: count of rewritten values
+        """
+        count = 0
+        for key in list(self._st):
+            raw = self._st[key]
+            if self._dict_id(raw) != self.current:
+                self._replace(key, self._encode(self._decode(raw)))
+                count += 1
+        return count
+
+    def _replace(self, key, raw):
+        """
+        replace the (encoded) value of key, never losing it: the new value is
+        written to the dict store before the old one is deleted
+        """
+        self._dict_store[PENDING_PREFIX + key] = raw
+        self._finish_replace(key, raw)
+
+    def _finish_replace(self, key, raw):
+        # not all stores support overwriting, so delete first:
+        if key in self._st:
+            del self._st[key]
+        self._st[key] = raw
+        del self._dict_store[PENDING_PREFIX + key]
+
+    def prune(self):
+        """
+        remove the dictionaries that are not used by any value (except the current one)
+
+        :returns: list of removed dictionary ids
+        """
+        used = set([self.current])
+        for key in self._st:
+            used.add(self._dict_id(self._st[key]))
+        removed = []
+        for dict_id in list(self._dict_ids()):
+            if dict_id not in used:
+                del self._dict_store[str(dict_id)]
+                self._dicts.pop(dict_id, None)
+                removed.append(dict_id)
+        return removed